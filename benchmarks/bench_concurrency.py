@@ -0,0 +1,126 @@
+"""
+Compare the throughput of the sync and the async versions of the API under
+concurrent clients.
+
+Each version is served by uvicorn in a subprocess on a copy of a seeded SQLite
+database, then N clients each keep one HTTP/1.1 connection open and send
+GET /users/{id} requests in a loop during a fixed time.
+
+    python benchmarks/bench_concurrency.py --clients 50 200 1000 --duration 10
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed(path: str, users: int):
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER NOT NULL PRIMARY KEY, full_name VARCHAR(50) NOT NULL UNIQUE, age INTEGER,
+            gender VARCHAR(1), email VARCHAR(50) NOT NULL UNIQUE, phone VARCHAR(50) UNIQUE,
+            salary INTEGER, job VARCHAR(50));
+    """)
+    connection.executemany(
+        "INSERT INTO users (full_name, email, age) VALUES (?, ?, ?)",
+        [("User %d" % i, "user%d@example.com" % i, 30) for i in range(users)])
+    connection.commit()
+    connection.close()
+
+
+async def wait_for_server(port: int, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("The server didn't start")
+
+
+async def run_client(port: int, users: int, stop_at: float, counters: dict):
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    except OSError:
+        counters["errors"] += 1
+        return
+    try:
+        while time.monotonic() < stop_at:
+            path = "/users/%d" % random.randint(1, users)
+            writer.write(("GET %s HTTP/1.1\r\nHost: bench\r\n\r\n" % path).encode())
+            await writer.drain()
+            status_line = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            if b" 200 " in status_line:
+                counters["ok"] += 1
+            else:
+                counters["errors"] += 1
+    except (OSError, asyncio.IncompleteReadError):
+        counters["errors"] += 1
+    finally:
+        writer.close()
+
+
+async def measure(port: int, clients: int, users: int, duration: float):
+    counters = {"ok": 0, "errors": 0}
+    stop_at = time.monotonic() + duration
+    await asyncio.gather(*(run_client(port, users, stop_at, counters) for _ in range(clients)))
+    return counters["ok"] / duration, counters["errors"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    seeded = os.path.join(workdir, "seed.db")
+    seed(seeded, args.users)
+    print("%-6s %8s %12s %8s" % ("mode", "clients", "requests/s", "errors"))
+    try:
+        for mode in ("sync", "async"):
+            path = os.path.join(workdir, "%s.db" % mode)
+            shutil.copy(seeded, path)
+            env = dict(os.environ, DATABASE_URL="sqlite:///%s" % path,
+                       ASYNC_MODE="1" if mode == "async" else "0")
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "myAPI.asgi:app", "--port", str(args.port),
+                 "--log-level", "warning", "--backlog", "4096"],
+                cwd=ROOT, env=env)
+            try:
+                asyncio.get_event_loop().run_until_complete(wait_for_server(args.port))
+                for clients in args.clients:
+                    throughput, errors = asyncio.get_event_loop().run_until_complete(
+                        measure(args.port, clients, args.users, args.duration))
+                    print("%-6s %8d %12.1f %8d" % (mode, clients, throughput, errors))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
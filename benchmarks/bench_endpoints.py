@@ -0,0 +1,542 @@
+"""
+Micro-benchmark of every path operation of main.py and every database function
+of crud.py: p50/p95/p99 latency and number of SQL statements per call.
+
+A SQLite database is seeded with --properties properties (1k, 100k, 1m, ...) and
+one user per --properties-per-user properties, then each case is called
+--iterations times. The path operations are called in process with the test
+client, the crud functions directly with a session. The response cache is
+disabled unless --cache is given, so the numbers measure the database path.
+
+The results are written as JSON with --output. With --baseline, the results are
+compared to a former JSON result and the suite exits with status 1 when the
+--metric latency of a case regresses by more than --threshold percent, or when
+a case needs more SQL statements than in the baseline.
+
+    python benchmarks/bench_endpoints.py --properties 1k --output bench.json
+    python benchmarks/bench_endpoints.py --properties 1k --baseline bench.json --threshold 20
+"""
+import argparse
+import inspect
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import closing
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+CITIES = ["Paris", "Lyon", "Marseille", "Toulouse", "Nice", "Nantes", "Strasbourg", "Montpellier",
+          "Bordeaux", "Lille", "Rennes", "Reims", "Toulon", "Grenoble", "Dijon", "Angers"]
+SEED_CHUNK_SIZE = 10000
+
+# The properties are located on a grid of GRID_SIZE x GRID_SIZE points GRID_STEP degrees
+# apart, from GRID_ORIGIN (Paris)
+GRID_ORIGIN = (48.80, 2.30)
+GRID_SIZE = 1000
+GRID_STEP = 0.0001
+
+# crud.py functions which don't query the database, they are not measured on their own
+CRUD_PURE_FUNCTIONS = {"unique_violation_column", "is_foreign_key_violation", "check_users_uniqueness",
+                       "property_filter_conditions", "property_search_order", "search_properties_query",
+                       "search_match_expression", "box_conditions", "booked_property_ids",
+                       "is_booking_overlap", "check_violation_name", "property_delete_conditions"}
+
+
+def parse_scale(value: str) -> int:
+    return SCALES[value.lower()] if value.lower() in SCALES else int(value)
+
+
+def user_row(i: int) -> dict:
+    return {"full_name": "User %d" % i, "email": "user%d@example.com" % i, "age": 18 + i % 80,
+            "gender": "MF"[i % 2], "phone": "06%08d" % i, "salary": 1500 + i % 5000, "job": "job %d" % (i % 50)}
+
+
+# Values of a property, without its adress and city which can't be updated
+def property_values(i: int, users: int) -> dict:
+    is_flat = i % 3 != 0
+    return {"surface": 20 + i % 180, "rooms": 1 + i % 6, "is_home": not is_flat, "is_flat": is_flat,
+            "age": i % 100, "selling_price": 50000 + (i * 7919) % 950000, "rental_price": 400 + i % 2000,
+            "is_sold": False, "is_rented": i % 4 == 1, "is_available": i % 4 != 1,
+            "availability_date": date(2021, 1 + i % 12, 1), "owner_id": 1 + i % users,
+            "latitude": GRID_ORIGIN[0] + i % GRID_SIZE * GRID_STEP,
+            "longitude": GRID_ORIGIN[1] + i // GRID_SIZE % GRID_SIZE * GRID_STEP}
+
+
+def property_row(i: int, users: int) -> dict:
+    return dict(property_values(i, users), adress="%d rue de la Paix" % i, city=CITIES[i % len(CITIES)])
+
+
+def seed(engine, models, users: int, properties: int):
+    with engine.begin() as connection:
+        for start in range(0, users, SEED_CHUNK_SIZE):
+            connection.execute(models.User.__table__.insert(), [
+                user_row(i) for i in range(start, min(start + SEED_CHUNK_SIZE, users))])
+        for start in range(0, properties, SEED_CHUNK_SIZE):
+            connection.execute(models.Property.__table__.insert(), [
+                property_row(i, users) for i in range(start, min(start + SEED_CHUNK_SIZE, properties))])
+
+
+# Random point of the grid of the properties
+def grid_point(rng: random.Random, properties: int) -> tuple:
+    i = rng.randrange(properties)
+    return (GRID_ORIGIN[0] + i % GRID_SIZE * GRID_STEP,
+            GRID_ORIGIN[1] + i // GRID_SIZE % GRID_SIZE * GRID_STEP)
+
+
+# Period of the i-th booking of the cases, two days long and distinct from the ones
+# of the other iterations so that a booking never overlaps another one
+def booking_period(i: int) -> dict:
+    start = date(2030, 1, 1) + timedelta(days=3 * i)
+    return {"start_date": start.isoformat(), "end_date": (start + timedelta(days=1)).isoformat()}
+
+
+def percentile(sorted_values: list, rank: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, int(round(rank / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+# A benchmark case: prepare(i) returns the arguments of the i-th call and isn't
+# measured, run(arguments) is measured, then cleanup(arguments, result) undoes the call.
+class Case:
+    def __init__(self, name, run, prepare=lambda i: i, cleanup=None, iterations=None):
+        self.name = name
+        self.run = run
+        self.prepare = prepare
+        self.cleanup = cleanup
+        self.iterations = iterations
+
+
+def measure(case: Case, iterations: int, warmup: int, statements: list):
+    iterations = min(iterations, case.iterations or iterations)
+    latencies = []
+    queries = 0
+    for i in range(-min(warmup, iterations), iterations):
+        arguments = case.prepare(i)
+        del statements[:]
+        start = time.perf_counter()
+        result = case.run(arguments)
+        elapsed = time.perf_counter() - start
+        if i >= 0:
+            latencies.append(elapsed * 1e3)
+            queries += len(statements)
+        if case.cleanup is not None:
+            case.cleanup(arguments, result)
+    latencies.sort()
+    return {"iterations": iterations, "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95), "p99_ms": percentile(latencies, 99),
+            "queries_per_call": queries / iterations}
+
+
+# Delete rows directly, to undo the bulk operations faster than with the API
+def delete_rows(engine, table, ids: list):
+    engine.execute(table.delete().where(table.c.id.in_(ids)))
+
+
+# Users deleted by the bulk delete cases, each with BULK_OWNED_PROPERTIES properties in
+# the city "Bulkville". Return the ids of the users.
+BULK_OWNERS = 10
+BULK_OWNED_PROPERTIES = 10
+
+
+def insert_owners(engine, models, i: int) -> list:
+    users = models.User.__table__
+    emails = ["bulk%d.%d@example.com" % (i, j) for j in range(BULK_OWNERS)]
+    with engine.begin() as connection:
+        connection.execute(users.insert(), [{"full_name": "Bulk Owner %d.%d" % (i, j), "email": email}
+                                            for j, email in enumerate(emails)])
+        ids = [row.id for row in connection.execute(users.select().where(users.c.email.in_(emails)))]
+        connection.execute(models.Property.__table__.insert(), [
+            {"adress": "%d.%d.%d rue du Lot" % (i, user_id, k), "city": "Bulkville", "is_available": True,
+             "owner_id": user_id} for user_id in ids for k in range(BULK_OWNED_PROPERTIES)])
+    return ids
+
+
+def check(response, status=200):
+    if response.status_code != status:
+        raise RuntimeError("%s %s: %d %s" % (response.request.method, response.request.url,
+                                             response.status_code, response.text))
+    return response
+
+
+def endpoint_cases(client, engine, models, users: int, properties: int, rng: random.Random):
+    from myAPI.pagination import encode_cursor
+
+    def user_id():
+        return rng.randint(1, users)
+
+    def property_id():
+        return rng.randint(1, properties)
+
+    def new_user(i):
+        return {"full_name": "Bench User %d" % i, "email": "bench%d@example.com" % i}
+
+    def new_property(i):
+        return {"adress": "%d avenue du Banc" % i, "city": "Benchville", "owner_id": user_id()}
+
+    def delete_user(i, response):
+        check(client.delete("/users/%d" % response.json()["id"]))
+
+    def delete_property(i, response):
+        check(client.delete("/properties/%d" % response.json()["id"]))
+
+    def created_user(i):
+        return check(client.post("/users/", json=new_user(i)), 201).json()["id"]
+
+    def created_property(i):
+        return check(client.post("/properties/", json=new_property(i)), 201).json()["id"]
+
+    def delete_booking(arguments, response):
+        check(client.delete("/properties/%d/bookings/%d" % (arguments[0], response.json()["id"])))
+
+    def created_booking(i):
+        property_id_ = property_id()
+        response = check(client.post("/properties/%d/bookings" % property_id_,
+                                     json=booking_period(i + 10 ** 4)), 201)
+        return "/properties/%d/bookings/%d" % (property_id_, response.json()["id"])
+
+    def bulk_cleanup(i, response):
+        delete_rows(engine, models.User.__table__, [result["id"] for result in response.json()["results"]])
+
+    def owner_change(i):
+        property_id_ = property_id()
+        return property_id_, user_id(), property_values(property_id_ - 1, users)["owner_id"]
+
+    def property_update(i):
+        property_id_ = property_id()
+        return property_id_, property_values(property_id_ - 1, users)
+
+    return [
+        Case("create_user", lambda i: check(client.post("/users/", json=new_user(i)), 201),
+             cleanup=delete_user),
+        Case("create_users_bulk", lambda i: check(client.post(
+            "/users/bulk", json=[new_user(i * 100 + j) for j in range(100)])),
+            prepare=lambda i: i + 1000, cleanup=bulk_cleanup),
+        Case("read_users", lambda after: check(client.get(
+            "/users/", params={"limit": 100, "cursor": encode_cursor(after)})),
+            prepare=lambda i: rng.randint(0, max(0, users - 100))),
+        Case("read_users_summary", lambda after: check(client.get(
+            "/users/", params={"limit": 100, "cursor": encode_cursor(after), "include": ""})),
+            prepare=lambda i: rng.randint(0, max(0, users - 100))),
+        Case("read_users_fields", lambda after: check(client.get("/users/", params={
+            "limit": 100, "cursor": encode_cursor(after), "include": "", "fields": "id,full_name,email"})),
+            prepare=lambda i: rng.randint(0, max(0, users - 100))),
+        Case("read_user", lambda user_id_: check(client.get("/users/%d" % user_id_)),
+             prepare=lambda i: user_id()),
+        Case("change_user", lambda user_id_: check(client.put(
+            "/users/%d" % user_id_, json=user_row(user_id_ - 1))), prepare=lambda i: user_id()),
+        Case("patch_user", lambda user_id_: check(client.patch(
+            "/users/%d" % user_id_, json={"job": user_row(user_id_ - 1)["job"]})), prepare=lambda i: user_id()),
+        Case("remove_user", lambda user_id_: check(client.delete("/users/%d" % user_id_)),
+             prepare=lambda i: created_user(i + 10 ** 6)),
+        Case("create_property", lambda i: check(client.post("/properties/", json=new_property(i)), 201),
+             cleanup=delete_property),
+        Case("read_properties", lambda city: check(client.get("/properties/", params={
+            "city": city, "is_available": True, "sort": "selling_price", "limit": 50})),
+            prepare=lambda i: rng.choice(CITIES)),
+        Case("read_properties_fields", lambda city: check(client.get("/properties/", params={
+            "city": city, "is_available": True, "sort": "selling_price", "limit": 50,
+            "fields": "id,adress,selling_price"})), prepare=lambda i: rng.choice(CITIES)),
+        Case("read_properties_near", lambda point: check(client.get("/properties/near", params={
+            "lat": point[0], "lon": point[1], "radius_km": 2, "limit": 50})),
+            prepare=lambda i: grid_point(rng, properties)),
+        Case("read_properties_in_bbox", lambda point: check(client.get("/properties/in-bbox", params={
+            "min_lat": point[0] - 0.005, "max_lat": point[0] + 0.005, "min_lon": point[1] - 0.005,
+            "max_lon": point[1] + 0.005, "is_available": True, "limit": 50})),
+            prepare=lambda i: grid_point(rng, properties)),
+        Case("read_property", lambda property_id_: check(client.get("/properties/%d" % property_id_)),
+             prepare=lambda i: property_id()),
+        Case("read_properties_from_user", lambda user_id_: check(
+            client.get("/users/%d/properties/" % user_id_)), prepare=lambda i: user_id()),
+        Case("change_property", lambda arguments: check(client.put(
+            "/properties/%d" % arguments[0], json=dict(arguments[1], availability_date="2021-01-01"))),
+            prepare=property_update),
+        Case("patch_property", lambda property_id_: check(client.patch("/properties/%d" % property_id_, json={
+            "selling_price": property_values(property_id_ - 1, users)["selling_price"]})),
+            prepare=lambda i: property_id()),
+        Case("change_property_owner", lambda arguments: check(client.put(
+            "/properties/%d/%d" % arguments[:2])), prepare=owner_change,
+            cleanup=lambda arguments, response: check(
+                client.put("/properties/%d/%d" % (arguments[0], arguments[2])))),
+        Case("remove_property", lambda property_id_: check(client.delete("/properties/%d" % property_id_)),
+             prepare=lambda i: created_property(i + 10 ** 6)),
+        Case("read_properties_available", lambda city: check(client.get("/properties/", params={
+            "city": city, "available_between": "2030-01-01/2030-01-31", "limit": 50})),
+            prepare=lambda i: rng.choice(CITIES)),
+        Case("create_booking", lambda arguments: check(client.post(
+            "/properties/%d/bookings" % arguments[0], json=booking_period(arguments[1])), 201),
+            prepare=lambda i: (property_id(), i), cleanup=delete_booking),
+        Case("read_bookings", lambda property_id_: check(client.get("/properties/%d/bookings" % property_id_)),
+             prepare=lambda i: property_id()),
+        Case("remove_booking", lambda path: check(client.delete(path)), prepare=created_booking),
+        Case("remove_users_bulk", lambda ids: check(client.post("/users/bulk-delete", json={
+            "ids": ids, "properties": "delete"})), prepare=lambda i: insert_owners(engine, models, i)),
+        Case("remove_properties_bulk", lambda ids: check(client.post("/properties/bulk-delete", json={
+            "filters": {"city": "Bulkville"}})), prepare=lambda i: insert_owners(engine, models, i + 10 ** 4),
+            cleanup=lambda ids, response: delete_rows(engine, models.User.__table__, ids)),
+        Case("transfer_properties", lambda ids: check(client.post("/users/%d/transfer/%d" % tuple(ids[:2]))),
+             prepare=lambda i: insert_owners(engine, models, i + 2 * 10 ** 4),
+             cleanup=lambda ids, response: check(client.post("/users/bulk-delete", json={
+                 "ids": ids, "properties": "delete"}))),
+        Case("export_table", lambda i: check(client.get("/export/users.ndjson")), iterations=5),
+        Case("search", lambda q: check(client.get("/search", params={"q": q})),
+             prepare=lambda i: "%d rue" % property_id()),
+        Case("read_city_stats", lambda i: check(client.get("/stats/cities"))),
+        Case("read_cache_stats", lambda i: check(client.get("/debug/cache"))),
+        Case("read_slow_queries", lambda i: check(client.get("/debug/slow-queries"))),
+        Case("read_metrics", lambda i: check(client.get("/metrics"))),
+    ]
+
+
+def crud_cases(session_factory, engine, crud, schemas, users: int, properties: int, rng: random.Random):
+    def call(function, **kwargs):
+        with closing(session_factory()) as db:
+            result = function(db=db, **kwargs)
+            if inspect.isgenerator(result):
+                result = list(result)
+            return result
+
+    def user_id():
+        return rng.randint(1, users)
+
+    def property_id():
+        return rng.randint(1, properties)
+
+    def created_user(i):
+        return call(crud.create_user, user=schemas.UserCreate(
+            full_name="Crud User %d" % i, email="crud%d@example.com" % i)).id
+
+    def created_property(i):
+        return call(crud.create_property, property=schemas.PropertyCreate(
+            adress="%d allee du Crud" % i, city="Crudville", owner_id=user_id())).id
+
+    return [
+        Case("create_user", lambda i: call(crud.create_user, user=schemas.UserCreate(
+            full_name="Crud User %d" % i, email="crud%d@example.com" % i)),
+            cleanup=lambda i, user: call(crud.delete_user, user_id=user.id)),
+        Case("create_users_bulk", lambda batch: call(crud.create_users_bulk, users=batch),
+             prepare=lambda i: [schemas.UserCreate(full_name="Crud Bulk %d" % (i * 100 + j),
+                                                   email="crud.bulk%d@example.com" % (i * 100 + j))
+                                for j in range(100)],
+             cleanup=lambda batch, ids: delete_rows(engine, crud.models.User.__table__, ids)),
+        Case("get_user", lambda user_id_: call(crud.get_user, user_id=user_id_, load_properties="joined"),
+             prepare=lambda i: user_id()),
+        Case("get_user_by_email", lambda i: call(crud.get_user_by_email, email="user%d@example.com" % i),
+             prepare=lambda i: user_id() - 1),
+        Case("get_user_by_full_name", lambda i: call(crud.get_user_by_full_name, full_name="User %d" % i),
+             prepare=lambda i: user_id() - 1),
+        Case("get_user_by_phone", lambda i: call(crud.get_user_by_phone, phone="06%08d" % i),
+             prepare=lambda i: user_id() - 1),
+        Case("get_users", lambda after: call(crud.get_users, limit=100, after_id=after),
+             prepare=lambda i: rng.randint(0, max(0, users - 100))),
+        Case("get_users_rows", lambda after: call(crud.get_users_rows, limit=100, after_id=after),
+             prepare=lambda i: rng.randint(0, max(0, users - 100))),
+        Case("get_row", lambda user_id_: call(crud.get_row, model=crud.models.User, row_id=user_id_,
+                                               columns=["id", "full_name", "email"]), prepare=lambda i: user_id()),
+        Case("get_user_row", lambda user_id_: call(crud.get_user_row, user_id=user_id_, columns=["id", "email"]),
+             prepare=lambda i: user_id()),
+        Case("get_property_row", lambda property_id_: call(
+            crud.get_property_row, property_id=property_id_, columns=["id", "city"]), prepare=lambda i: property_id()),
+        Case("search_properties_rows", lambda city: call(
+            crud.search_properties_rows, filters=schemas.PropertyFilter(city=city, is_available=True),
+            columns=["id", "adress"], sort=schemas.PropertySortEnum.selling_price, limit=50),
+            prepare=lambda i: rng.choice(CITIES)),
+        Case("update_user", lambda user_id_: call(crud.update_user, user_id=user_id_,
+                                                  user=schemas.UserUpdate(**user_row(user_id_ - 1))),
+             prepare=lambda i: user_id()),
+        Case("patch_user", lambda user_id_: call(crud.patch_user, user_id=user_id_,
+                                                 user=schemas.UserPatch(job=user_row(user_id_ - 1)["job"])),
+             prepare=lambda i: user_id()),
+        Case("delete_user", lambda user_id_: call(crud.delete_user, user_id=user_id_),
+             prepare=lambda i: created_user(i + 2 * 10 ** 6)),
+        Case("create_property", lambda i: call(crud.create_property, property=schemas.PropertyCreate(
+            adress="%d allee du Crud" % i, city="Crudville")),
+            cleanup=lambda i, property: call(crud.delete_property, property_id=property.id)),
+        Case("get_property", lambda property_id_: call(crud.get_property, property_id=property_id_),
+             prepare=lambda i: property_id()),
+        Case("get_properties_by_owner", lambda user_id_: call(crud.get_properties_by_owner, owner_id=user_id_),
+             prepare=lambda i: user_id()),
+        Case("get_property_ids_by_owner", lambda user_id_: call(crud.get_property_ids_by_owner, owner_id=user_id_),
+             prepare=lambda i: user_id()),
+        Case("get_properties_by_owner_rows", lambda user_id_: call(
+            crud.get_properties_by_owner_rows, owner_id=user_id_), prepare=lambda i: user_id()),
+        Case("get_properties_by_owners_rows", lambda ids: call(crud.get_properties_by_owners_rows, owner_ids=ids),
+             prepare=lambda i: [user_id() for _ in range(100)]),
+        Case("search_properties", lambda city: call(crud.search_properties, filters=schemas.PropertyFilter(
+            city=city, is_available=True), sort=schemas.PropertySortEnum.selling_price, limit=50),
+            prepare=lambda i: rng.choice(CITIES)),
+        Case("get_properties_near", lambda point: call(
+            crud.get_properties_near, latitude=point[0], longitude=point[1], radius_km=2,
+            filters=schemas.PropertyFilter(), limit=50), prepare=lambda i: grid_point(rng, properties)),
+        Case("get_properties_in_bbox", lambda point: call(
+            crud.get_properties_in_bbox, min_latitude=point[0] - 0.005, max_latitude=point[0] + 0.005,
+            min_longitude=point[1] - 0.005, max_longitude=point[1] + 0.005,
+            filters=schemas.PropertyFilter(is_available=True), limit=50),
+            prepare=lambda i: grid_point(rng, properties)),
+        Case("get_property_by_city_and_adress", lambda i: call(
+            crud.get_property_by_city_and_adress, city=CITIES[i % len(CITIES)], adress="%d rue de la Paix" % i),
+            prepare=lambda i: property_id() - 1),
+        Case("update_property", lambda property_id_: call(
+            crud.update_property, property_id=property_id_,
+            property=schemas.PropertyUpdate(**property_values(property_id_ - 1, users))),
+            prepare=lambda i: property_id()),
+        Case("patch_property", lambda property_id_: call(
+            crud.patch_property, property_id=property_id_, property=schemas.PropertyPatch(
+                selling_price=property_values(property_id_ - 1, users)["selling_price"])),
+            prepare=lambda i: property_id()),
+        Case("update_property_owner", lambda arguments: call(
+            crud.update_property_owner, property_id=arguments[0], owner_id=arguments[1]),
+            prepare=lambda i: (property_id(), user_id()),
+            cleanup=lambda arguments, property: call(
+                crud.update_property_owner, property_id=arguments[0],
+                owner_id=property_values(arguments[0] - 1, users)["owner_id"])),
+        Case("delete_property", lambda property_id_: call(crud.delete_property, property_id=property_id_),
+             prepare=lambda i: created_property(i + 2 * 10 ** 6)),
+        Case("create_booking", lambda arguments: call(
+            crud.create_booking, property_id=arguments[0],
+            booking=schemas.BookingCreate(**booking_period(arguments[1]))),
+            prepare=lambda i: (property_id(), i + 2 * 10 ** 4),
+            cleanup=lambda arguments, booking: call(
+                crud.delete_booking, property_id=booking.property_id, booking_id=booking.id)),
+        Case("get_bookings", lambda property_id_: call(crud.get_bookings, property_id=property_id_),
+             prepare=lambda i: property_id()),
+        Case("delete_booking", lambda booking: call(
+            crud.delete_booking, property_id=booking.property_id, booking_id=booking.id),
+            prepare=lambda i: call(crud.create_booking, property_id=property_id(),
+                                   booking=schemas.BookingCreate(**booking_period(i + 3 * 10 ** 4)))),
+        Case("delete_users_bulk", lambda ids: call(crud.delete_users_bulk, ids=ids),
+             prepare=lambda i: insert_owners(engine, crud.models, i + 2 * 10 ** 4),
+             cleanup=lambda ids, counts: delete_rows(engine, crud.models.Property.__table__, [
+                 row.id for row in engine.execute(crud.models.Property.__table__.select().where(
+                     crud.models.Property.city == "Bulkville"))])),
+        Case("delete_properties_bulk", lambda ids: call(
+            crud.delete_properties_bulk, filters=schemas.PropertyDeleteFilter(owner_id=ids[0])),
+            prepare=lambda i: insert_owners(engine, crud.models, i + 3 * 10 ** 4),
+            cleanup=lambda ids, counts: call(crud.delete_users_bulk, ids=ids, properties="delete")),
+        Case("transfer_properties", lambda ids: call(
+            crud.transfer_properties, from_owner_id=ids[0], to_owner_id=ids[1]),
+            prepare=lambda i: insert_owners(engine, crud.models, i + 4 * 10 ** 4),
+            cleanup=lambda ids, moved: call(crud.delete_users_bulk, ids=ids, properties="delete")),
+        Case("iter_table_chunks", lambda i: call(crud.iter_table_chunks, table=crud.models.User.__table__),
+             iterations=5),
+        Case("get_version", lambda user_id_: call(crud.get_version, model=crud.models.User, row_id=user_id_),
+             prepare=lambda i: user_id()),
+        Case("get_user_version", lambda user_id_: call(crud.get_user_version, user_id=user_id_),
+             prepare=lambda i: user_id()),
+        Case("get_property_version", lambda property_id_: call(crud.get_property_version, property_id=property_id_),
+             prepare=lambda i: property_id()),
+        Case("search_properties_text", lambda q: call(crud.search_properties_text, text_query=q),
+             prepare=lambda i: rng.choice(["rue", "Par", "%d rue" % property_id()])),
+        Case("search_users_text", lambda q: call(crud.search_users_text, text_query=q),
+             prepare=lambda i: rng.choice(["user", "User %d" % user_id()])),
+        Case("get_city_stats", lambda i: call(crud.get_city_stats)),
+        Case("get_median_selling_price", lambda arguments: call(
+            crud.get_median_selling_price, city=arguments[0], count=arguments[1]),
+            prepare=lambda i: tuple(engine.execute(
+                "SELECT city, selling_price_count FROM city_stats WHERE city = ?", rng.choice(CITIES)).first()
+                or ("Unknown", 0))),
+    ]
+
+
+# Cases whose latency or number of queries regressed compared to the baseline
+def regressions(results: dict, baseline: dict, metric: str, threshold: float):
+    found = []
+    for group, cases in results["cases"].items():
+        for name, result in cases.items():
+            former = baseline.get("cases", {}).get(group, {}).get(name)
+            if former is None:
+                continue
+            if result[metric] > former[metric] * (1 + threshold / 100):
+                found.append("%s.%s: %s %.3f ms > %.3f ms + %g%%" % (
+                    group, name, metric, result[metric], former[metric], threshold))
+            if result["queries_per_call"] > former["queries_per_call"]:
+                found.append("%s.%s: %.1f queries per call > %.1f" % (
+                    group, name, result["queries_per_call"], former["queries_per_call"]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--properties", type=parse_scale, default="1k", help="1k, 100k, 1m or a number")
+    parser.add_argument("--properties-per-user", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--cache", action="store_true", help="keep the response cache enabled")
+    parser.add_argument("--only", nargs="+", help="names of the cases to run")
+    parser.add_argument("--output", help="JSON file of the results")
+    parser.add_argument("--baseline", help="JSON file of former results to compare to")
+    parser.add_argument("--metric", choices=["p50_ms", "p95_ms", "p99_ms"], default="p95_ms")
+    parser.add_argument("--threshold", type=float, default=20, help="accepted regression in percent")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = "sqlite:///%s" % os.path.join(workdir, "bench.db")
+    if not args.cache:
+        os.environ["CACHE_SIZE"] = "0"
+    try:
+        from fastapi.routing import APIRoute
+        from fastapi.testclient import TestClient
+        from sqlalchemy import event
+        from myAPI import crud, database, main as api, migrations, models, schemas
+
+        migrations.upgrade(database.engine)
+        users = max(1, args.properties // args.properties_per_user)
+        start = time.perf_counter()
+        seed(database.engine, models, users, args.properties)
+        print("seeded %d users and %d properties in %.1f s" % (users, args.properties, time.perf_counter() - start))
+
+        statements = []
+        for engine in {database.engine, database.read_engine}:
+            event.listen(engine, "before_cursor_execute",
+                         lambda conn, cursor, statement, *rest: statements.append(statement))
+
+        rng = random.Random(args.seed)
+        groups = {
+            "endpoints": endpoint_cases(TestClient(api.app), database.engine, models, users, args.properties, rng),
+            "crud": crud_cases(database.SessionLocal, database.engine, crud, schemas, users, args.properties, rng),
+        }
+        handlers = {route.endpoint.__name__ for route in api.app.routes if isinstance(route, APIRoute)}
+        functions = {name for name, function in inspect.getmembers(crud, inspect.isfunction)
+                     if function.__module__ == crud.__name__ and not name.startswith("_")}
+        uncovered = sorted((handlers - {case.name for case in groups["endpoints"]}) |
+                           (functions - CRUD_PURE_FUNCTIONS - {case.name for case in groups["crud"]}))
+        if uncovered:
+            print("not measured: %s" % ", ".join(uncovered))
+
+        results = {"properties": args.properties, "users": users, "iterations": args.iterations,
+                   "cache": args.cache, "uncovered": uncovered, "cases": {}}
+        print("%-10s %-34s %9s %9s %9s %9s" % ("group", "case", "p50 ms", "p95 ms", "p99 ms", "queries"))
+        for group, cases in groups.items():
+            results["cases"][group] = {}
+            for case in cases:
+                if args.only and case.name not in args.only:
+                    continue
+                result = measure(case, args.iterations, args.warmup, statements)
+                results["cases"][group][case.name] = result
+                print("%-10s %-34s %9.3f %9.3f %9.3f %9.1f" % (
+                    group, case.name, result["p50_ms"], result["p95_ms"], result["p99_ms"],
+                    result["queries_per_call"]))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            found = regressions(results, json.load(baseline), args.metric, args.threshold)
+        for regression in found:
+            print("REGRESSION %s" % regression)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
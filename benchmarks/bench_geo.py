@@ -0,0 +1,118 @@
+"""
+Compare the radius and map viewport searches through the R*Tree index
+(GET /properties/near and GET /properties/in-bbox) to a naive scan of the
+properties which computes the distance of every located property.
+
+The database is generated with python -m myAPI.generate unless --database-url
+is given. The results of both methods are checked to be the same.
+
+    python benchmarks/bench_geo.py --properties 1000000 --queries 50
+"""
+import argparse
+import heapq
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.orm import Session  # noqa: E402
+
+from myAPI import crud, database, generate, geo, models, schemas  # noqa: E402
+
+Property = models.Property
+
+
+def naive_near(db: Session, latitude: float, longitude: float, radius_km: float,
+               filters: schemas.PropertyFilter, limit: int):
+    located = db.query(Property.id, Property.latitude, Property.longitude).filter(
+        *crud.property_filter_conditions(filters), Property.latitude.isnot(None), Property.longitude.isnot(None))
+    distances = [(geo.distance_km(latitude, longitude, row.latitude, row.longitude), row.id) for row in located]
+    return [property_id for distance, property_id in heapq.nsmallest(limit, distances) if distance <= radius_km]
+
+
+def naive_in_bbox(db: Session, min_latitude: float, max_latitude: float, min_longitude: float,
+                  max_longitude: float, filters: schemas.PropertyFilter, limit: int):
+    return [row.id for row in db.query(Property.id).filter(
+        *crud.property_filter_conditions(filters), Property.latitude.between(min_latitude, max_latitude),
+        Property.longitude.between(min_longitude, max_longitude)).order_by(Property.id).limit(limit)]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def percentile(values, rank: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(rank * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database-url", help="database of python -m myAPI.generate, generated if not set")
+    parser.add_argument("--properties", type=int, default=200000, help="properties of the generated database")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--radius-km", type=float, default=2)
+    parser.add_argument("--bbox-degrees", type=float, default=0.02, help="height and width of the viewports")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        url = args.database_url
+        if url is None:
+            url = "sqlite:///%s" % os.path.join(workdir, "bench.db")
+            generate.main(["--database-url", url, "--users", str(args.properties // 10),
+                           "--properties", str(args.properties)])
+        engine = database.create_sqlite_engine(url)
+        db = Session(bind=engine)
+        rng = random.Random(args.seed)
+        centres = list(generate.CITY_COORDINATES.values())
+        searches = {
+            "all": schemas.PropertyFilter(),
+            "available": schemas.PropertyFilter(is_available=True),
+        }
+        print("%-7s %-10s %8s %12s %12s %12s %12s" % (
+            "search", "filters", "results", "rtree ms", "rtree p95", "scan ms", "scan p95"))
+        for name, filters in searches.items():
+            timings = {"near": ([], [], []), "in-bbox": ([], [], [])}
+            for _ in range(args.queries):
+                latitude, longitude = rng.choice(centres)
+                latitude += rng.gauss(0, generate.CITY_SPREAD)
+                longitude += rng.gauss(0, generate.CITY_SPREAD)
+                indexed, near = timed(crud.get_properties_near, db, latitude, longitude, args.radius_km,
+                                      filters, args.limit)
+                scanned, expected = timed(naive_near, db, latitude, longitude, args.radius_km, filters, args.limit)
+                assert [db_property.id for db_property, _ in near] == expected
+                timings["near"][0].append(indexed)
+                timings["near"][1].append(scanned)
+                timings["near"][2].append(len(near))
+
+                box = (latitude - args.bbox_degrees / 2, latitude + args.bbox_degrees / 2,
+                       longitude - args.bbox_degrees / 2, longitude + args.bbox_degrees / 2)
+                indexed, in_bbox = timed(crud.get_properties_in_bbox, db, *box, filters, args.limit)
+                scanned, expected = timed(naive_in_bbox, db, *box, filters, args.limit)
+                assert [db_property.id for db_property in in_bbox] == expected
+                timings["in-bbox"][0].append(indexed)
+                timings["in-bbox"][1].append(scanned)
+                timings["in-bbox"][2].append(len(in_bbox))
+                db.expunge_all()
+            for search, (indexed, scanned, results) in timings.items():
+                print("%-7s %-10s %8.1f %12.2f %12.2f %12.2f %12.2f" % (
+                    search, name, sum(results) / len(results), sum(indexed) * 1e3 / len(indexed),
+                    percentile(indexed, 0.95) * 1e3, sum(scanned) * 1e3 / len(scanned),
+                    percentile(scanned, 0.95) * 1e3))
+        db.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
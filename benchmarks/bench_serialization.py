@@ -0,0 +1,74 @@
+"""
+Compare the cost per row of the standard serialization (ORM objects validated by the
+response models) and of the fast path (Core rows to dicts encoded with orjson) on
+GET /users/ and GET /users/{user_id}/properties/.
+
+The API is called in process with the test client on a seeded SQLite database,
+the time per row is the time of a request divided by the number of rows it returns.
+
+    python benchmarks/bench_serialization.py --users 1000 --properties 3 --owned 1000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def seed(engine, models, users: int, properties: int, owned: int):
+    engine.execute(models.User.__table__.insert(), [
+        {"full_name": "User %d" % i, "email": "user%d@example.com" % i, "age": 30, "gender": "F",
+         "phone": "07%08d" % i, "salary": 2000, "job": "waiter"} for i in range(users)])
+    engine.execute(models.Property.__table__.insert(), [
+        {"adress": "%d rue de la Paix" % i, "city": "Paris", "surface": 45.5, "rooms": 2,
+         "is_home": False, "is_flat": True, "age": 10, "selling_price": 250000,
+         "rental_price": 1200, "is_available": True, "availability_date": date(2021, 1, 1),
+         "owner_id": 1 if i < owned else 1 + i % users} for i in range(users * properties)])
+
+
+def measure(client, url: str, repeat: int):
+    client.get(url)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        response = client.get(url)
+    elapsed = (time.perf_counter() - start) / repeat
+    return elapsed, len(response.json())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--properties", type=int, default=3, help="properties per user")
+    parser.add_argument("--owned", type=int, default=1000, help="properties of the user 1")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = "sqlite:///%s" % os.path.join(workdir, "bench.db")
+    try:
+        from fastapi.testclient import TestClient
+        from myAPI import database, main as api, migrations, models, serialization
+
+        migrations.upgrade(database.engine)
+        seed(database.engine, models, args.users, args.properties, args.owned)
+        client = TestClient(api.app)
+        urls = {"read_users": "/users/?limit=%d" % args.users,
+                "read_properties_from_user": "/users/1/properties/"}
+        print("%-26s %-9s %6s %12s %12s" % ("endpoint", "path", "rows", "ms/request", "us/row"))
+        for name, url in urls.items():
+            for fast in (False, True):
+                serialization.FAST_SERIALIZATION = fast
+                elapsed, rows = measure(client, url, args.repeat)
+                print("%-26s %-9s %6d %12.2f %12.2f" % (
+                    name, "fast" if fast else "standard", rows, elapsed * 1e3, elapsed * 1e6 / rows))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
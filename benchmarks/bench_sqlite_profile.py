@@ -0,0 +1,106 @@
+"""
+Compare the read throughput of the default SQLite setup and of the WAL profile
+with separate reader and writer pools (database.create_sqlite_engine) while a
+writer keeps committing.
+
+    python benchmarks/bench_sqlite_profile.py --readers 8 --duration 5
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from myAPI import database, migrations, models  # noqa: E402
+
+users = models.User.__table__
+
+
+def seed(url: str, count: int):
+    seed_engine = create_engine(url)
+    migrations.upgrade(seed_engine)
+    seed_engine.execute(users.insert(), [
+        {"full_name": "User %d" % i, "email": "user%d@example.com" % i} for i in range(count)])
+    seed_engine.dispose()
+
+
+def run(read_engine, write_engine, readers: int, duration: float, count: int):
+    stop_at = time.monotonic() + duration
+    counters = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def read():
+        done = 0
+        statement = select([users]).where(users.c.id == random.randint(1, count))
+        while time.monotonic() < stop_at:
+            try:
+                with read_engine.connect() as connection:
+                    connection.execute(statement).fetchall()
+                done += 1
+            except Exception:
+                with lock:
+                    counters["errors"] += 1
+        with lock:
+            counters["reads"] += done
+
+    def write():
+        done = 0
+        while time.monotonic() < stop_at:
+            try:
+                with write_engine.begin() as connection:
+                    connection.execute(users.update().where(
+                        users.c.id == random.randint(1, count)).values(age=random.randint(18, 99)))
+                done += 1
+            except Exception:
+                with lock:
+                    counters["errors"] += 1
+        with lock:
+            counters["writes"] += done
+
+    threads = [threading.Thread(target=read) for _ in range(readers)]
+    threads.append(threading.Thread(target=write))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--users", type=int, default=10000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        print("%-8s %10s %10s %8s" % ("profile", "reads/s", "writes/s", "errors"))
+        for profile in ("default", "wal"):
+            url = "sqlite:///%s" % os.path.join(workdir, "%s.db" % profile)
+            seed(url, args.users)
+            if profile == "default":
+                write_engine = read_engine = create_engine(
+                    url, connect_args={"check_same_thread": False})
+            else:
+                write_engine = database.create_sqlite_engine(url)
+                read_engine = database.create_sqlite_engine(
+                    url, pool_size=args.readers, read_only=True)
+            counters = run(read_engine, write_engine, args.readers, args.duration, args.users)
+            print("%-8s %10.1f %10.1f %8d" % (profile, counters["reads"] / args.duration,
+                                              counters["writes"] / args.duration, counters["errors"]))
+            write_engine.dispose()
+            read_engine.dispose()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
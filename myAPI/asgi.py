@@ -0,0 +1,10 @@
+from .database import ASYNC_MODE
+
+# Entry point selecting the sync or the async version of the API with the
+# ASYNC_MODE setting: uvicorn myAPI.asgi:app
+if ASYNC_MODE:
+    from .async_main import app
+else:
+    from .main import app
+
+__all__ = ["app"]
@@ -0,0 +1,480 @@
+import heapq
+from types import SimpleNamespace
+from typing import List, Optional
+
+from sqlalchemy import and_, select
+
+from . import geo, models, schemas, stats
+from .cache import property_key, response_cache, user_key
+from .crud import (BULK_CHUNK_SIZE, NEAR_STEPS, USER_UNIQUE_FIELDS, DeleteReturning, StaleVersionError,
+                   UpdateReturning, box_conditions, check_users_uniqueness, city_stats_query, located_query, median,
+                   median_prices_query, owners_count_query, patch_statement, properties_by_owner_query,
+                   property_delete_conditions, property_filter_conditions, row_query, rtree_properties,
+                   search_properties_statement, search_text_query, transfer_statement, users_rows_query,
+                   within_radius)
+from .database import AsyncConnection
+
+
+# Async variants of the operations of crud.py, with the same names and arguments,
+# they run on a connection of the "databases" library and return records instead
+# of ORM objects. The records read with the attributes of the ORM objects, a user
+# with its properties is a SimpleNamespace. They run the same statements as their
+# sync variants, and invalidate the response cache the same way. The SQLite backend of "databases" doesn't support the
+# expanding IN parameters, the lists of ids are bound value by value.
+#
+# Its result of a write is the last inserted row id, even for an UPDATE or a DELETE
+# when an INSERT ran before on the connection, so the writes which need the rows
+# they changed return them with RETURNING.
+
+users = models.User.__table__
+properties = models.Property.__table__
+bookings = models.Booking.__table__
+
+# SQLite can bind at most 999 parameters per statement (before version 3.32),
+# the bulk inserts use a multi-row VALUES clause sized to stay under this limit
+SQLITE_MAX_VARIABLES = 999
+
+
+def _chunks(values: list, size: int):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+# Filter a write on the expected versions of the row, if any, see crud._with_version
+def _with_version(statement, table, expected_versions: Optional[List[int]]):
+    if expected_versions is None:
+        return statement
+    return statement.where(table.c.version.in_(expected_versions))
+
+
+# See crud._check_not_updated
+async def _check_not_updated(db: AsyncConnection, table, row_id: int, expected_versions: Optional[List[int]]):
+    if expected_versions is not None and await get_version(db=db, table=table, row_id=row_id) is not None:
+        raise StaleVersionError()
+
+
+async def get_version(db: AsyncConnection, table, row_id: int):
+    return await db.fetch_val(select([table.c.version]).where(table.c.id == row_id))
+
+
+async def get_user_version(db: AsyncConnection, user_id: int):
+    return await get_version(db=db, table=users, row_id=user_id)
+
+
+async def get_property_version(db: AsyncConnection, property_id: int):
+    return await get_version(db=db, table=properties, row_id=property_id)
+
+
+# Attach the properties of the users, loaded with a single extra SELECT like the
+# "selectin" loader of crud.get_users
+async def _with_properties(db: AsyncConnection, db_users: list):
+    db_users = [SimpleNamespace(properties=[], **db_user) for db_user in db_users]
+    if db_users:
+        by_id = {db_user.id: db_user for db_user in db_users}
+        db_properties = await db.fetch_all(
+            select([properties]).where(properties.c.owner_id.in_(list(by_id))).order_by(properties.c.id))
+        for db_property in db_properties:
+            by_id[db_property["owner_id"]].properties.append(db_property)
+    return db_users
+
+
+# A user and its properties read at once with a LEFT OUTER JOIN, like the "joined"
+# loader of crud.get_user
+async def _get_user_joined(db: AsyncConnection, user_id: int):
+    query = select([users, properties]).apply_labels() \
+        .select_from(users.outerjoin(properties, properties.c.owner_id == users.c.id)) \
+        .where(users.c.id == user_id).order_by(properties.c.id)
+    rows = await db.fetch_all(query)
+    if not rows:
+        return None
+    db_user = SimpleNamespace(**{column.name: rows[0]["users_%s" % column.name] for column in users.c})
+    db_user.properties = [SimpleNamespace(**{column.name: row["properties_%s" % column.name]
+                                             for column in properties.c})
+                          for row in rows if row["properties_id"] is not None]
+    return db_user
+
+
+# CREATE operation, the database checks the uniqueness of the email, the full name and the phone
+async def create_user(db: AsyncConnection, user: schemas.UserCreate):
+    user_id = await db.execute(users.insert().values(**user.dict()))
+    # a new user has no properties, there is no need to load them
+    return SimpleNamespace(properties=[], **await get_user(db=db, user_id=user_id))
+
+
+# READ operation
+# With load_properties ("joined" or "selectin") the user has its properties, read with a join
+async def get_user(db: AsyncConnection, user_id: int, load_properties: Optional[str] = None):
+    if load_properties is not None:
+        return await _get_user_joined(db, user_id)
+    return await db.fetch_one(select([users]).where(users.c.id == user_id))
+
+
+async def get_users(db: AsyncConnection, skip: int = 0, limit: int = 100, after_id: Optional[int] = None,
+                    load_properties: Optional[str] = "selectin"):
+    query = select([users]).order_by(users.c.id).limit(limit)
+    if after_id is not None:
+        query = query.where(users.c.id > after_id)
+    else:
+        query = query.offset(skip)
+    db_users = await db.fetch_all(query)
+    if load_properties is None:
+        return db_users
+    return await _with_properties(db, db_users)
+
+
+# Bulk CREATE operation, see crud.create_users_bulk
+async def create_users_bulk(db: AsyncConnection, users_to_create: List[schemas.UserCreate],
+                            chunk_size: int = BULK_CHUNK_SIZE):
+    rows = [dict(user) for user in users_to_create]
+    taken = {}
+    for field, _ in USER_UNIQUE_FIELDS:
+        column = users.c[field]
+        values = list({row[field] for row in rows if row[field] is not None})
+        taken[field] = set()
+        for chunk in _chunks(values, chunk_size):
+            db_rows = await db.fetch_all(select([column]).where(column.in_(chunk)))
+            taken[field].update(db_row[0] for db_row in db_rows)
+    results, valid_rows = check_users_uniqueness(rows, taken)
+    rows_per_statement = SQLITE_MAX_VARIABLES // len(users.columns)
+    async with db.transaction():
+        for chunk in _chunks(valid_rows, rows_per_statement):
+            await db.execute(users.insert().values([rows[index] for index in chunk]))
+            emails = [rows[index]["email"] for index in chunk]
+            db_rows = await db.fetch_all(
+                select([users.c.email, users.c.id]).where(users.c.email.in_(emails)))
+            ids = {db_row[0]: db_row[1] for db_row in db_rows}
+            for index in chunk:
+                results[index] = ids[rows[index]["email"]]
+    return results
+
+
+# UPDATE operation, a single UPDATE statement. Return None if the user doesn't exist.
+async def update_user(db: AsyncConnection, user: schemas.UserUpdate, user_id: int,
+                      expected_versions: Optional[List[int]] = None):
+    statement = UpdateReturning(users, [users.c.id]).where(users.c.id == user_id).values(**user.dict())
+    updated = await db.fetch_one(_with_version(statement, users, expected_versions))
+    if updated is None:
+        await _check_not_updated(db, users, user_id, expected_versions)
+        return None
+    response_cache.invalidate(user_key(user_id))
+    return await get_user(db=db, user_id=user_id, load_properties="joined")
+
+
+# PATCH operation, see crud._patch
+async def _patch(db: AsyncConnection, table, row_id: int, values: dict, expected_versions: Optional[List[int]]):
+    if not values:
+        row = await db.fetch_one(select([table]).where(table.c.id == row_id))
+        if row is not None and expected_versions is not None and row["version"] not in expected_versions:
+            raise StaleVersionError()
+        return row
+    row = await db.fetch_one(patch_statement(table, row_id, values, expected_versions))
+    if row is None:
+        await _check_not_updated(db, table, row_id, expected_versions)
+    return row
+
+
+async def patch_user(db: AsyncConnection, user: schemas.UserPatch, user_id: int,
+                     expected_versions: Optional[List[int]] = None):
+    values = user.dict(exclude_unset=True)
+    row = await _patch(db, users, user_id, values, expected_versions)
+    if values and row is not None:
+        response_cache.invalidate(user_key(user_id))
+    return row
+
+
+# DELETE operation, see crud.delete_user. The properties of the user are detached
+# from it in the same transaction, the triggers update the counters.
+async def delete_user(db: AsyncConnection, user_id: int, expected_versions: Optional[List[int]] = None):
+    async with db.transaction():
+        db_user = await get_user(db=db, user_id=user_id, load_properties="joined")
+        if db_user is None:
+            return None
+        if expected_versions is not None and db_user.version not in expected_versions:
+            raise StaleVersionError()
+        if db_user.properties:
+            await db.execute(properties.update().where(properties.c.owner_id == user_id).values(owner_id=None))
+        await db.execute(users.delete().where(users.c.id == user_id))
+    response_cache.invalidate(user_key(user_id), *(property_key(p.id) for p in db_user.properties))
+    return db_user
+
+
+# The database checks that the owner exists
+async def create_property(db: AsyncConnection, property: schemas.PropertyCreate):
+    property_id = await db.execute(properties.insert().values(**property.dict()))
+    if property.owner_id is not None:
+        response_cache.invalidate(user_key(property.owner_id))
+    return await get_property(db=db, property_id=property_id)
+
+
+async def get_property(db: AsyncConnection, property_id: int):
+    return await db.fetch_one(select([properties]).where(properties.c.id == property_id))
+
+
+async def get_properties_by_owner(db: AsyncConnection, owner_id: int, limit: Optional[int] = None,
+                                  after_id: Optional[int] = None):
+    return await get_properties_by_owner_rows(db=db, owner_id=owner_id, limit=limit, after_id=after_id)
+
+
+async def get_property_ids_by_owner(db: AsyncConnection, owner_id: int) -> List[int]:
+    rows = await db.fetch_all(select([properties.c.id]).where(properties.c.owner_id == owner_id))
+    return [row[0] for row in rows]
+
+
+# A row with only some columns, see crud.get_row
+async def get_row(db: AsyncConnection, table, row_id: int, columns: List[str]):
+    return await db.fetch_one(row_query(table, row_id, columns))
+
+
+async def get_user_row(db: AsyncConnection, user_id: int, columns: List[str]):
+    return await get_row(db=db, table=users, row_id=user_id, columns=columns)
+
+
+async def get_property_row(db: AsyncConnection, property_id: int, columns: List[str]):
+    return await get_row(db=db, table=properties, row_id=property_id, columns=columns)
+
+
+# See crud.get_users_rows
+async def get_users_rows(db: AsyncConnection, skip: int = 0, limit: int = 100, after_id: Optional[int] = None,
+                         columns: Optional[List[str]] = None):
+    return await db.fetch_all(users_rows_query(skip=skip, limit=limit, after_id=after_id, columns=columns))
+
+
+# See crud.get_properties_by_owner_rows
+async def get_properties_by_owner_rows(db: AsyncConnection, owner_id: int, limit: Optional[int] = None,
+                                       after_id: Optional[int] = None, columns: Optional[List[str]] = None):
+    return await db.fetch_all(properties_by_owner_query(
+        owner_id=owner_id, limit=limit, after_id=after_id, columns=columns))
+
+
+# The properties of many users, with one SELECT per chunk of BULK_CHUNK_SIZE users
+async def get_properties_by_owners_rows(db: AsyncConnection, owner_ids: List[int]):
+    rows = []
+    for ids in _chunks(owner_ids, BULK_CHUNK_SIZE):
+        rows.extend(await db.fetch_all(
+            select([properties]).where(properties.c.owner_id.in_(ids)).order_by(properties.c.id)))
+    return rows
+
+
+async def search_properties(db: AsyncConnection, filters: schemas.PropertyFilter,
+                            sort: schemas.PropertySortEnum = schemas.PropertySortEnum.id,
+                            limit: int = 100, after: Optional[List[int]] = None):
+    return await db.fetch_all(search_properties_statement(filters=filters, sort=sort, limit=limit, after=after))
+
+
+# Only the columns are read, see crud.search_properties_rows
+async def search_properties_rows(db: AsyncConnection, filters: schemas.PropertyFilter, columns: List[str],
+                                 sort: schemas.PropertySortEnum = schemas.PropertySortEnum.id,
+                                 limit: int = 100, after: Optional[List[int]] = None):
+    return await db.fetch_all(search_properties_statement(
+        filters=filters, sort=sort, limit=limit, after=after, columns=columns))
+
+
+# See crud.get_properties_in_bbox
+async def get_properties_in_bbox(db: AsyncConnection, min_latitude: float, max_latitude: float,
+                                 min_longitude: float, max_longitude: float, filters: schemas.PropertyFilter,
+                                 limit: int = 100, after_id: Optional[int] = None):
+    db_properties = []
+    for box in geo.viewport_boxes(min_latitude, max_latitude, min_longitude, max_longitude):
+        conditions = property_filter_conditions(filters) + box_conditions(box)
+        if after_id is not None:
+            conditions.append(properties.c.id > after_id)
+        db_properties += await db.fetch_all(select([properties]).select_from(rtree_properties)
+                                            .where(and_(*conditions)).order_by(properties.c.id).limit(limit))
+    return sorted(db_properties, key=lambda db_property: db_property["id"])[:limit]
+
+
+async def _located_within(db: AsyncConnection, latitude: float, longitude: float, radius_km: float,
+                          conditions: list):
+    distances = []
+    for box in geo.radius_boxes(latitude, longitude, radius_km):
+        distances += within_radius(latitude, longitude, radius_km, await db.fetch_all(located_query(box, conditions)))
+    return distances
+
+
+# See crud.get_properties_near
+async def get_properties_near(db: AsyncConnection, latitude: float, longitude: float, radius_km: float,
+                              filters: schemas.PropertyFilter, limit: int = 100):
+    conditions = property_filter_conditions(filters)
+    for step in NEAR_STEPS:
+        distances = await _located_within(db, latitude, longitude, radius_km * step, conditions)
+        if len(distances) >= limit:
+            break
+    nearest = heapq.nsmallest(limit, distances)
+    if not nearest:
+        return []
+    db_properties = {db_property["id"]: db_property for db_property in await db.fetch_all(
+        select([properties]).where(properties.c.id.in_([property_id for _, property_id in nearest])))}
+    return [(db_properties[property_id], distance) for distance, property_id in nearest]
+
+
+# A single UPDATE statement, the database checks that the owner exists, see crud.update_property
+async def update_property(db: AsyncConnection, property: schemas.PropertyUpdate, property_id: int,
+                          expected_versions: Optional[List[int]] = None):
+    statement = UpdateReturning(properties, [properties.c.id]).where(
+        properties.c.id == property_id).values(**property.dict())
+    updated = await db.fetch_one(_with_version(statement, properties, expected_versions))
+    if updated is None:
+        await _check_not_updated(db, properties, property_id, expected_versions)
+        return None
+    tags = [property_key(property_id)]
+    if property.owner_id is not None:
+        tags.append(user_key(property.owner_id))
+    response_cache.invalidate(*tags)
+    return await get_property(db=db, property_id=property_id)
+
+
+async def patch_property(db: AsyncConnection, property: schemas.PropertyPatch, property_id: int,
+                         expected_versions: Optional[List[int]] = None):
+    values = property.dict(exclude_unset=True)
+    row = await _patch(db, properties, property_id, values, expected_versions)
+    if values and row is not None:
+        tags = [property_key(property_id)]
+        if values.get("owner_id") is not None:
+            tags.append(user_key(values["owner_id"]))
+        response_cache.invalidate(*tags)
+    return row
+
+
+async def update_property_owner(db: AsyncConnection, property_id: int, owner_id: int,
+                                expected_versions: Optional[List[int]] = None):
+    statement = UpdateReturning(properties, [properties.c.id]).where(
+        properties.c.id == property_id).values(owner_id=owner_id)
+    updated = await db.fetch_one(_with_version(statement, properties, expected_versions))
+    if updated is None:
+        await _check_not_updated(db, properties, property_id, expected_versions)
+        return None
+    response_cache.invalidate(property_key(property_id), user_key(owner_id))
+    return await get_property(db=db, property_id=property_id)
+
+
+# A single DELETE statement filtered on the expected versions, which returns the deleted property
+async def delete_property(db: AsyncConnection, property_id: int, expected_versions: Optional[List[int]] = None):
+    statement = DeleteReturning(properties, list(properties.c)).where(properties.c.id == property_id)
+    db_property = await db.fetch_one(_with_version(statement, properties, expected_versions))
+    if db_property is None:
+        await _check_not_updated(db, properties, property_id, expected_versions)
+        return None
+    response_cache.invalidate(property_key(property_id))
+    return db_property
+
+
+# See crud.transfer_properties
+async def transfer_properties(db: AsyncConnection, from_owner_id: int, to_owner_id: int,
+                              ids: Optional[List[int]] = None,
+                              filters: Optional[schemas.PropertyFilter] = None) -> Optional[List[int]]:
+    owners = {from_owner_id, to_owner_id}
+    if await db.fetch_val(owners_count_query(owners)) != len(owners):
+        return None
+    statement = transfer_statement(from_owner_id, to_owner_id, filters)
+    async with db.transaction():
+        if ids is None:
+            moved = [row["id"] for row in await db.fetch_all(statement)]
+        else:
+            moved = []
+            for chunk in _chunks(sorted(set(ids)), BULK_CHUNK_SIZE):
+                moved += [row["id"] for row in await db.fetch_all(statement.where(properties.c.id.in_(chunk)))]
+    response_cache.invalidate(user_key(from_owner_id), user_key(to_owner_id),
+                              *(property_key(property_id) for property_id in moved))
+    return sorted(moved)
+
+
+# Bulk DELETE operations, see crud.delete_users_bulk. The rows are counted from the
+# ids returned by the statements.
+async def _count_in_chunks(db: AsyncConnection, statement, column, ids: List[int]) -> int:
+    count = 0
+    for chunk in _chunks(ids, BULK_CHUNK_SIZE):
+        count += len(await db.fetch_all(statement.where(column.in_(chunk))))
+    return count
+
+
+async def delete_users_bulk(db: AsyncConnection, ids: List[int],
+                            properties: schemas.OwnedPropertiesEnum = schemas.OwnedPropertiesEnum.detach):
+    property_table = models.Property.__table__
+    if properties == schemas.OwnedPropertiesEnum.delete:
+        properties_statement = DeleteReturning(property_table, [property_table.c.id])
+    else:
+        properties_statement = UpdateReturning(property_table, [property_table.c.id]).values(owner_id=None)
+    ids = sorted(set(ids))
+    async with db.transaction():
+        property_count = await _count_in_chunks(db, properties_statement, property_table.c.owner_id, ids)
+        deleted = await _count_in_chunks(db, DeleteReturning(users, [users.c.id]), users.c.id, ids)
+    response_cache.clear()
+    key = "properties_deleted" if properties == schemas.OwnedPropertiesEnum.delete else "properties_detached"
+    return {"deleted": deleted, key: property_count}
+
+
+async def delete_properties_bulk(db: AsyncConnection, ids: Optional[List[int]] = None,
+                                 filters: Optional[schemas.PropertyDeleteFilter] = None):
+    statement = DeleteReturning(properties, [properties.c.id])
+    conditions = property_delete_conditions(filters) if filters is not None else []
+    if conditions:
+        statement = statement.where(and_(*conditions))
+    async with db.transaction():
+        if ids is None:
+            deleted = len(await db.fetch_all(statement))
+        else:
+            deleted = await _count_in_chunks(db, statement, properties.c.id, sorted(set(ids)))
+    response_cache.clear()
+    return {"deleted": deleted}
+
+
+# The database checks that the property exists and that the booking doesn't overlap
+# another booking of the property
+async def create_booking(db: AsyncConnection, property_id: int, booking: schemas.BookingCreate):
+    booking_id = await db.execute(bookings.insert().values(property_id=property_id, **booking.dict()))
+    return await db.fetch_one(select([bookings]).where(bookings.c.id == booking_id))
+
+
+async def get_bookings(db: AsyncConnection, property_id: int):
+    return await db.fetch_all(
+        select([bookings]).where(bookings.c.property_id == property_id).order_by(bookings.c.start_date))
+
+
+async def delete_booking(db: AsyncConnection, property_id: int, booking_id: int):
+    db_booking = await db.fetch_one(select([bookings]).where(
+        and_(bookings.c.id == booking_id, bookings.c.property_id == property_id)))
+    if db_booking is None:
+        return None
+    await db.execute(bookings.delete().where(bookings.c.id == booking_id))
+    return db_booking
+
+
+# Read a whole table in chunks of chunk_size rows, see crud.iter_table_chunks
+async def iter_table_chunks(db: AsyncConnection, table, chunk_size: int = 1000, columns: Optional[List] = None):
+    query = select(columns or [table]).order_by(table.c.id).limit(chunk_size)
+    rows = await db.fetch_all(query)
+    while rows:
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        rows = await db.fetch_all(query.where(table.c.id > rows[-1]["id"]))
+
+
+async def get_median_selling_price(db: AsyncConnection, city: str, count: int) -> Optional[float]:
+    if not count:
+        return None
+    return median([row[0] for row in await db.fetch_all(median_prices_query(city, count))])
+
+
+# See crud.get_city_stats
+async def get_city_stats(db: AsyncConnection, city: Optional[str] = None) -> List[dict]:
+    city_stats = []
+    for row in await db.fetch_all(city_stats_query(city)):
+        median_selling_price = await stats.medians.aget(
+            row["city"], row["version"],
+            lambda row=row: get_median_selling_price(db, row["city"], row["selling_price_count"]))
+        city_stats.append(stats.city_summary(row, median_selling_price))
+    return city_stats
+
+
+async def _search_text(db: AsyncConnection, indexed, text_query: str, limit: int):
+    query = search_text_query(indexed, text_query, limit)
+    return [] if query is None else await db.fetch_all(query)
+
+
+async def search_properties_text(db: AsyncConnection, text_query: str, limit: int = 10):
+    return await _search_text(db, properties, text_query, limit)
+
+
+async def search_users_text(db: AsyncConnection, text_query: str, limit: int = 10):
+    return await _search_text(db, users, text_query, limit)
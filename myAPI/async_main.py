@@ -0,0 +1,74 @@
+from functools import partial
+
+from fastapi import Depends, FastAPI
+
+from . import async_crud, export, metrics, migrations, routes, slow_queries
+from .database import SQLALCHEMY_DATABASE_URL, AsyncConnection, AsyncDatabase, async_connection, engine
+
+
+# Async version of the API, served when ASYNC_MODE=1 (see asgi.py). The path operations
+# are the ones of main.py (see routes.py), but their store awaits an async database driver
+# instead of blocking a thread of the threadpool during each query. The tests of main.py
+# run against both versions.
+
+database = AsyncDatabase(SQLALCHEMY_DATABASE_URL)
+
+app = FastAPI(title="Property management API",
+              description="This is a small API to control properties and their owners in a real estate park.")
+
+# Record the latency, the status code and the SQL queries of the requests, see GET /metrics.
+# The queries of the async connections are counted under the "async" pool.
+if metrics.METRICS_ENABLED:
+    metrics.instrument_async_queries()
+    app.add_middleware(metrics.MetricsMiddleware, api=app)
+
+# Log the statements slower than SLOW_QUERY_MS with their plan, see GET /debug/slow-queries
+slow_queries.instrument_async_queries()
+
+
+# Create the database tables and indexes when the server starts, like in main.py
+@app.on_event("startup")
+def upgrade_database():
+    migrations.upgrade(engine)
+
+
+@app.on_event("startup")
+async def startup():
+    await database.connect()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await database.disconnect()
+
+
+# Dependency giving a single connection of the pool per request, with the profile of the sync engines
+async def get_async_db():
+    async with async_connection(database) as connection:
+        yield connection
+
+
+class AsyncCrudStore:
+    """
+    Store of the path operations of routes.py on an async connection, the functions
+    of async_crud.py are awaited directly.
+    """
+
+    def __init__(self, db: AsyncConnection):
+        self.db = db
+
+    def __getattr__(self, name: str):
+        return partial(getattr(async_crud, name), self.db)
+
+    def stream_export(self, format: export.ExportFormatEnum, table):
+        chunks = async_crud.iter_table_chunks(db=self.db, table=table, chunk_size=export.EXPORT_CHUNK_SIZE,
+                                              columns=export.export_columns(table))
+        return export.astream_export(format, table, chunks)
+
+
+async def get_store(db: AsyncConnection = Depends(get_async_db)):
+    return AsyncCrudStore(db)
+
+
+# The reads and the writes share the pool of connections
+routes.include_routes(app, get_store, get_store)
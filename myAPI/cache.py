@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Size of the response cache (0 disables it) and time to live of its entries in seconds.
+# The cache lives in the API process: with several workers, a write only invalidates
+# the cache of the worker which served it and the others serve their entries until
+# they expire, so keep the TTL short in that setup.
+CACHE_SIZE = int(os.environ.get("CACHE_SIZE", 1024))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 60))
+
+
+# Bounded LRU cache whose entries expire after ttl seconds. Each entry has tags,
+# for instance ("user", 1), and invalidating a tag removes all the entries having it.
+class TaggedCache:
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: float = CACHE_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self._tags = {}  # tag -> keys
+        self._lock = threading.Lock()
+        # incremented by each invalidation, see set()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    # Store a value read from the database. "generation" is the one read before
+    # the database: if a write invalidated the cache since, the value may be
+    # older than that write and is not stored.
+    def set(self, key, value, tags=(), generation: int = None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            tags = frozenset(tags)
+            self._entries[key] = (self.clock() + self.ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "expirations": self.expirations, "invalidations": self.invalidations}
+
+
+# Cache of the serialized responses of GET /users/{user_id} and GET /properties/{property_id}.
+# The write operations of crud.py invalidate it.
+response_cache = TaggedCache()
+
+
+def user_key(user_id: int):
+    return ("user", user_id)
+
+
+# Key of GET /users/{user_id} without the properties, invalidated by the user tag
+def user_summary_key(user_id: int):
+    return ("user_summary", user_id)
+
+
+def property_key(property_id: int):
+    return ("property", property_id)
+
+
+# Key of the response of key reduced to some fields
+def fields_key(key, fields):
+    return key + (tuple(fields),)
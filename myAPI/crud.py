@@ -1,6 +1,110 @@
-from sqlalchemy.orm import Session
+import heapq
+import re
+import sqlite3
+from datetime import date
+from typing import List, Optional
 
-from . import models, schemas
+from sqlalchemy import and_, bindparam, column, func, literal_column, select, table, text, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.expression import Delete, Join, Update
+
+from . import geo, migrations, models, schemas, stats
+from .cache import property_key, response_cache, user_key
+
+
+# The write operations let the database check the unique and foreign key
+# constraints in the same statement as the write, instead of running a SELECT
+# per constraint beforehand. An IntegrityError is raised when one is violated,
+# these helpers tell which one from the SQLite error message. The errors are the
+# IntegrityError of SQL Alchemy or, in the async mode, the one of the sqlite3 module.
+INTEGRITY_ERRORS = (IntegrityError, sqlite3.IntegrityError)
+UNIQUE_VIOLATION = re.compile(r"UNIQUE constraint failed: \w+\.(\w+)")
+
+
+def _error_message(exc) -> str:
+    return str(getattr(exc, "orig", exc))
+
+
+def unique_violation_column(exc: IntegrityError) -> Optional[str]:
+    match = UNIQUE_VIOLATION.search(_error_message(exc))
+    return match.group(1) if match else None
+
+
+def is_foreign_key_violation(exc: IntegrityError) -> bool:
+    return "FOREIGN KEY constraint failed" in _error_message(exc)
+
+
+CHECK_VIOLATION = re.compile(r"CHECK constraint failed: (\w+)")
+
+
+def check_violation_name(exc: IntegrityError) -> Optional[str]:
+    match = CHECK_VIOLATION.search(_error_message(exc))
+    return match.group(1) if match else None
+
+
+# The overlap of the bookings of a property is checked by triggers (see migrations.py)
+def is_booking_overlap(exc: IntegrityError) -> bool:
+    return migrations.BOOKING_OVERLAP in _error_message(exc)
+
+
+def _commit(db: Session):
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise
+
+
+# Raised by a write given the expected versions of the row (If-Match) when
+# the current version isn't one of them
+class StaleVersionError(Exception):
+    pass
+
+
+# Filter a write on the expected versions of the row, if any
+def _with_version(query, model, expected_versions: Optional[List[int]]):
+    if expected_versions is None:
+        return query
+    return query.filter(model.version.in_(expected_versions))
+
+
+# A write which updated no row either targets a missing row (None is returned
+# by the caller) or a row whose version isn't an expected one
+def _check_not_updated(db: Session, model, row_id: int, expected_versions: Optional[List[int]]):
+    if expected_versions is not None and get_version(db=db, model=model, row_id=row_id) is not None:
+        raise StaleVersionError()
+
+
+# Version of a row, a single primary key lookup. Return None if the row doesn't exist.
+def get_version(db: Session, model, row_id: int):
+    return db.query(model.version).filter(model.id == row_id).scalar()
+
+
+def get_user_version(db: Session, user_id: int):
+    return get_version(db=db, model=models.User, row_id=user_id)
+
+
+def get_property_version(db: Session, property_id: int):
+    return get_version(db=db, model=models.Property, row_id=property_id)
+
+
+# Eager loading strategies of the user properties. Without one the properties of
+# each user are lazy loaded with one SELECT per user when the response is
+# serialized. "selectin" loads the properties of all the users of a list with a
+# single extra SELECT, "joined" loads a single user and its properties at once.
+PROPERTIES_LOADERS = {
+    "selectin": selectinload,
+    "joined": joinedload,
+}
+
+
+def _load_properties(query, strategy: Optional[str]):
+    if strategy is None:
+        return query
+    return query.options(PROPERTIES_LOADERS[strategy](models.User.properties))
 
 
 # CREATE operation, here we use the Pydantic UserCreate schema for data creation
@@ -8,16 +112,20 @@ def create_user(db: Session, user: schemas.UserCreate):
     db_user = models.User(**user.dict())
     # Add the new SQL alchemy model instance to the database session
     db.add(db_user)
-    # commit the changes to the database so they are saved
-    db.commit()
+    # commit the changes to the database so they are saved, the database
+    # checks the uniqueness of the email, the full name and the phone
+    _commit(db)
     # refresh the instance so it contains generated data by the database like an ID
     db.refresh(db_user)
+    # a new user has no properties, there is no need to load them
+    set_committed_value(db_user, "properties", [])
     return db_user
 
 
 # READ operation
-def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+def get_user(db: Session, user_id: int, load_properties: Optional[str] = None):
+    query = _load_properties(db.query(models.User), load_properties)
+    return query.filter(models.User.id == user_id).first()
 
 
 def get_user_by_email(db: Session, email: str):
@@ -32,34 +140,202 @@ def get_user_by_phone(db: Session, phone: str):
     return db.query(models.User).filter(models.User.phone == phone).first()
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+# When after_id is given the page starts right after this id (keyset pagination),
+# this costs an index seek whatever the depth of the page, unlike OFFSET.
+def get_users(db: Session, skip: int = 0, limit: int = 100, after_id: Optional[int] = None,
+              load_properties: Optional[str] = "selectin"):
+    query = _load_properties(db.query(models.User), load_properties)
+    query = query.order_by(models.User.id)
+    if after_id is not None:
+        query = query.filter(models.User.id > after_id)
+    else:
+        query = query.offset(skip)
+    return query.limit(limit).all()
 
 
-# UPDATE operation, here we use the Pydantic UserUpdate schema for data updating
-def update_user(db: Session, user: schemas.UserUpdate, user_id: int):
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
-    for key, val in user.dict().items():
-        setattr(db_user, key, val)
-    db.commit()
-    return db_user
+# Unique columns of the users, with their name in the error messages
+USER_UNIQUE_FIELDS = (("email", "email"), ("full_name", "full name"), ("phone", "phone"))
+
+# Columns of the unique constraint of the properties, a property is identified by its city and adress
+PROPERTY_UNIQUE_COLUMNS = ("city", "adress")
+
+# Maximal number of rows of a single statement in the bulk operations,
+# it stays under the SQLite limit of bound parameters per statement
+BULK_CHUNK_SIZE = 500
+
+
+def _chunks(values: list, size: int):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+# Check the uniqueness of users to create, against the values already taken in the
+# database, given by unique column, and against the other users of the batch.
+# Return the error of each user, None if it is valid, and the positions of the valid users.
+def check_users_uniqueness(rows: List[dict], taken: dict):
+    seen = {field: set() for field, _ in USER_UNIQUE_FIELDS}
+    results = [None] * len(rows)
+    valid_rows = []
+    for index, row in enumerate(rows):
+        for field, label in USER_UNIQUE_FIELDS:
+            value = row[field]
+            if value is None:
+                continue
+            if value in taken[field]:
+                results[index] = "User with the same %s is already registered" % label
+                break
+            if value in seen[field]:
+                results[index] = "User with the same %s is already in the batch" % label
+                break
+        else:
+            for field, _ in USER_UNIQUE_FIELDS:
+                seen[field].add(row[field])
+            valid_rows.append(index)
+    return results, valid_rows
+
+
+# Bulk CREATE operation. The uniqueness is checked for the whole batch with one
+# SELECT ... IN per column and chunk, then the valid users are inserted with
+# executemany in chunks and everything is committed in a single transaction.
+# Return for each user either its id or the reason why it was not created.
+def create_users_bulk(db: Session, users: List[schemas.UserCreate], chunk_size: int = BULK_CHUNK_SIZE):
+    # dict(user) is a shallow copy of the fields, much cheaper than user.dict()
+    rows = [dict(user) for user in users]
+    taken = {}
+    for field, _ in USER_UNIQUE_FIELDS:
+        column = getattr(models.User, field)
+        values = list({row[field] for row in rows if row[field] is not None})
+        # an expanding IN parameter avoids building a bound parameter per value
+        statement = select([column]).where(column.in_(bindparam("values", expanding=True)))
+        taken[field] = set()
+        for chunk in _chunks(values, chunk_size):
+            taken[field].update(
+                value for (value,) in db.execute(statement, {"values": chunk}))
+    results, valid_rows = check_users_uniqueness(rows, taken)
+    email = models.User.email
+    ids_statement = select([email, models.User.id]).where(
+        email.in_(bindparam("emails", expanding=True)))
+    try:
+        for chunk in _chunks(valid_rows, chunk_size):
+            db.execute(models.User.__table__.insert(), [rows[index] for index in chunk])
+            emails = [rows[index]["email"] for index in chunk]
+            ids = dict(db.execute(ids_statement, {"emails": emails}).fetchall())
+            for index in chunk:
+                results[index] = ids[rows[index]["email"]]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return results
+
+
+# UPDATE operation, here we use the Pydantic UserUpdate schema for data updating.
+# A single UPDATE statement, return None if the user doesn't exist.
+def update_user(db: Session, user: schemas.UserUpdate, user_id: int, expected_versions: Optional[List[int]] = None):
+    query = db.query(models.User).filter(models.User.id == user_id)
+    updated = _with_version(query, models.User, expected_versions).update(
+        user.dict(), synchronize_session=False)
+    _commit(db)
+    response_cache.invalidate(user_key(user_id))
+    if not updated:
+        _check_not_updated(db, models.User, user_id, expected_versions)
+        return None
+    return get_user(db=db, user_id=user_id, load_properties="joined")
 
 
-# DELETE operation
-def delete_user(db: Session, user_id: int):
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
+# UPDATE and DELETE ... RETURNING the given columns. SQLite supports it since 3.35
+# (checked at startup, see database.py) but the SQLite dialect of SQL Alchemy 1.3
+# doesn't compile it, only the statements of these classes have the clause.
+class UpdateReturning(Update):
+    def __init__(self, table, returning_columns: list):
+        super().__init__(table)
+        self.returning_columns = returning_columns
+
+
+class DeleteReturning(Delete):
+    def __init__(self, table, returning_columns: list):
+        super().__init__(table)
+        self.returning_columns = returning_columns
+
+
+@compiles(UpdateReturning)
+@compiles(DeleteReturning)
+def _compile_returning(statement, compiler, **kw):
+    visit = getattr(compiler, "visit_%s" % statement.__visit_name__)
+    return "%s RETURNING %s" % (visit(statement, **kw), ", ".join(
+        compiler.process(column, within_columns_clause=True, include_table=False, **kw)
+        for column in statement.returning_columns))
+
+
+# UPDATE of the set fields of a PATCH returning the updated row. The version is bumped
+# by a trigger after the UPDATE (see migrations.py), which RETURNING doesn't see.
+def patch_statement(table, row_id: int, values: dict, expected_versions: Optional[List[int]]):
+    returning = [column for column in table.c if column.name != "version"] + [(table.c.version + 1).label("version")]
+    statement = UpdateReturning(table, returning).where(table.c.id == row_id).values(**values)
+    if expected_versions is not None:
+        statement = statement.where(table.c.version.in_(expected_versions))
+    return statement
+
+
+# PATCH operation, a single UPDATE of the set fields returning the updated row, the
+# constraints of the table check the merged row. Without fields to set the row is
+# only read.
+def _patch(db: Session, model, row_id: int, values: dict, expected_versions: Optional[List[int]]):
+    table = model.__table__
+    if not values:
+        row = db.execute(select([table]).where(table.c.id == row_id)).first()
+        if row is not None and expected_versions is not None and row.version not in expected_versions:
+            raise StaleVersionError()
+        return row
+    statement = patch_statement(table, row_id, values, expected_versions)
+    try:
+        row = db.execute(statement).first()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise
+    if row is None:
+        _check_not_updated(db, model, row_id, expected_versions)
+    return row
+
+
+def patch_user(db: Session, user: schemas.UserPatch, user_id: int, expected_versions: Optional[List[int]] = None):
+    values = user.dict(exclude_unset=True)
+    row = _patch(db, models.User, user_id, values, expected_versions)
+    if values:
+        response_cache.invalidate(user_key(user_id))
+    return row
+
+
+# DELETE operation. The properties of the user are detached from it, the user
+# and its properties are returned as they were before the deletion.
+def delete_user(db: Session, user_id: int, expected_versions: Optional[List[int]] = None):
+    db_user = get_user(db=db, user_id=user_id, load_properties="joined")
     if db_user:
-        db.delete(db_user)
+        if expected_versions is not None and db_user.version not in expected_versions:
+            db.rollback()
+            raise StaleVersionError()
+        if db_user.properties:
+            db.query(models.Property).filter(models.Property.owner_id == user_id).update(
+                {models.Property.owner_id: None}, synchronize_session=False)
+        db.query(models.User).filter(models.User.id == user_id).delete(synchronize_session=False)
+        # keep the loaded state of the objects, the commit would expire them
+        db.expunge_all()
         db.commit()
+        response_cache.invalidate(
+            user_key(user_id), *(property_key(p.id) for p in db_user.properties))
         return db_user
     else:
         return None
 
 
+# The database checks that the owner exists
 def create_property(db: Session, property: schemas.PropertyCreate):
     db_property = models.Property(**property.dict())
     db.add(db_property)
-    db.commit()
+    _commit(db)
+    if property.owner_id is not None:
+        response_cache.invalidate(user_key(property.owner_id))
     db.refresh(db_property)
     return db_property
 
@@ -68,37 +344,575 @@ def get_property(db: Session, property_id: int):
     return db.query(models.Property).filter(models.Property.id == property_id).first()
 
 
-def get_properties_by_owner(db: Session, owner_id: int):
-    return db.query(models.Property).filter(models.Property.owner_id == owner_id).all()
+def get_properties_by_owner(db: Session, owner_id: int, limit: Optional[int] = None, after_id: Optional[int] = None):
+    query = db.query(models.Property).filter(
+        models.Property.owner_id == owner_id).order_by(models.Property.id)
+    if after_id is not None:
+        query = query.filter(models.Property.id > after_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+# Ids of the properties of an owner, read from the owner_id index without loading the properties
+def get_property_ids_by_owner(db: Session, owner_id: int) -> List[int]:
+    return [row[0] for row in db.query(models.Property.id).filter(models.Property.owner_id == owner_id)]
+
+
+# Columns of a table to read, all of them unless the names of some are given
+def _columns(table, names: Optional[List[str]] = None):
+    return [table] if names is None else [table.c[name] for name in names]
+
+
+def row_query(table, row_id: int, columns: List[str]):
+    return select(_columns(table, columns)).where(table.c.id == row_id)
+
+
+# A row with only some columns, a single primary key lookup. Return None if the row doesn't exist.
+def get_row(db: Session, model, row_id: int, columns: List[str]):
+    return db.execute(row_query(model.__table__, row_id, columns)).first()
+
+
+def get_user_row(db: Session, user_id: int, columns: List[str]):
+    return get_row(db=db, model=models.User, row_id=user_id, columns=columns)
+
+
+def get_property_row(db: Session, property_id: int, columns: List[str]):
+    return get_row(db=db, model=models.Property, row_id=property_id, columns=columns)
+
+
+# Core variants of get_users and get_properties_by_owner for the fast serialization
+# path (serialization.py) and the sparse fieldsets, they return rows instead of ORM
+# objects. With columns only these columns are read.
+def users_rows_query(skip: int = 0, limit: int = 100, after_id: Optional[int] = None,
+                     columns: Optional[List[str]] = None):
+    users = models.User.__table__
+    query = select(_columns(users, columns)).order_by(users.c.id)
+    if after_id is not None:
+        query = query.where(users.c.id > after_id)
+    else:
+        query = query.offset(skip)
+    return query.limit(limit)
+
+
+def get_users_rows(db: Session, skip: int = 0, limit: int = 100, after_id: Optional[int] = None,
+                   columns: Optional[List[str]] = None):
+    return db.execute(users_rows_query(skip=skip, limit=limit, after_id=after_id, columns=columns)).fetchall()
+
+
+# The properties of many users, with one SELECT per chunk of BULK_CHUNK_SIZE users
+def get_properties_by_owners_rows(db: Session, owner_ids: List[int]):
+    properties = models.Property.__table__
+    query = select([properties]).where(
+        properties.c.owner_id.in_(bindparam("ids", expanding=True))).order_by(properties.c.id)
+    rows = []
+    for ids in _chunks(owner_ids, BULK_CHUNK_SIZE):
+        rows.extend(db.execute(query, {"ids": ids}).fetchall())
+    return rows
+
+
+def properties_by_owner_query(owner_id: int, limit: Optional[int] = None, after_id: Optional[int] = None,
+                              columns: Optional[List[str]] = None):
+    properties = models.Property.__table__
+    query = select(_columns(properties, columns)).where(properties.c.owner_id == owner_id).order_by(properties.c.id)
+    if after_id is not None:
+        query = query.where(properties.c.id > after_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def get_properties_by_owner_rows(db: Session, owner_id: int, limit: Optional[int] = None,
+                                 after_id: Optional[int] = None, columns: Optional[List[str]] = None):
+    return db.execute(properties_by_owner_query(
+        owner_id=owner_id, limit=limit, after_id=after_id, columns=columns)).fetchall()
+
+
+# Interval index of the booked periods (see migrations.py), the days are counted from EPOCH
+bookings_rtree = table("bookings_rtree", column("id"), column("min_day"), column("max_day"), column("property_id"))
+EPOCH = date(1970, 1, 1)
+
+
+# Ids of the properties with a booking during a period, from the interval index:
+# its search only reads the bookings overlapping the period
+def booked_property_ids(start: date, end: date):
+    return select([bookings_rtree.c.property_id]).where(and_(
+        bookings_rtree.c.max_day >= (start - EPOCH).days, bookings_rtree.c.min_day <= (end - EPOCH).days))
+
+
+# Without statistics, SQLite expects a bound of a range to match a quarter of the table:
+# for a price or surface range alone it would rather scan the whole table in id order
+# than read the range from its index and sort it. The ranges of the search are declared
+# selective so their index is used.
+RANGE_LIKELIHOOD = 0.01
+
+
+def _selective(condition):
+    # the probability must be a constant of the statement, not a parameter
+    return func.likelihood(condition, literal_column(repr(RANGE_LIKELIHOOD)))
+
+
+# SQL conditions of the filters set in a PropertyFilter schema
+def property_filter_conditions(filters: schemas.PropertyFilter):
+    conditions = []
+    if filters.city is not None:
+        conditions.append(models.Property.city == filters.city)
+    if filters.is_available is not None:
+        conditions.append(models.Property.is_available == filters.is_available)
+    if filters.is_flat is not None:
+        conditions.append(models.Property.is_flat == filters.is_flat)
+    if filters.rooms is not None:
+        conditions.append(models.Property.rooms == filters.rooms)
+    if filters.min_price is not None:
+        conditions.append(_selective(models.Property.selling_price >= filters.min_price))
+    if filters.max_price is not None:
+        conditions.append(_selective(models.Property.selling_price <= filters.max_price))
+    if filters.min_surface is not None:
+        conditions.append(_selective(models.Property.surface >= filters.min_surface))
+    if filters.available_between is not None:
+        # the booked properties are listed once, then looked up for each property
+        conditions.append(models.Property.id.notin_(booked_property_ids(*filters.available_between)))
+    return conditions
+
+
+# SQL conditions of the filters set in a PropertyDeleteFilter schema
+def property_delete_conditions(filters: schemas.PropertyDeleteFilter):
+    conditions = property_filter_conditions(filters)
+    for name in ("owner_id", "is_sold", "is_rented"):
+        value = getattr(filters, name)
+        if value is not None:
+            conditions.append(getattr(models.Property, name) == value)
+    return conditions
+
+
+# Keyset conditions and ORDER BY clauses of a property search, "after" holds the sort
+# key of the last property of the previous page: [id] when sorting by id,
+# [selling_price, id] when sorting by price. Properties without a selling price
+# can't be ordered by price, so they are left out of the price sorted searches.
+def property_search_order(sort: schemas.PropertySortEnum, after: Optional[List[int]] = None):
+    if sort == schemas.PropertySortEnum.id:
+        conditions = [] if after is None else [models.Property.id > after[0]]
+        return conditions, [models.Property.id]
+    price = models.Property.selling_price
+    key = tuple_(price, models.Property.id)
+    conditions = [price.isnot(None)]
+    if sort == schemas.PropertySortEnum.selling_price:
+        if after is not None:
+            conditions.append(key > tuple_(*after))
+        return conditions, [price, models.Property.id]
+    if after is not None:
+        conditions.append(key < tuple_(*after))
+    return conditions, [price.desc(), models.Property.id.desc()]
+
+
+def search_properties_query(db: Session, filters: schemas.PropertyFilter,
+                            sort: schemas.PropertySortEnum = schemas.PropertySortEnum.id,
+                            after: Optional[List[int]] = None):
+    conditions, order_by = property_search_order(sort, after)
+    return db.query(models.Property).filter(
+        *property_filter_conditions(filters), *conditions).order_by(*order_by)
+
+
+def search_properties(db: Session, filters: schemas.PropertyFilter,
+                      sort: schemas.PropertySortEnum = schemas.PropertySortEnum.id,
+                      limit: int = 100, after: Optional[List[int]] = None):
+    return search_properties_query(db=db, filters=filters, sort=sort, after=after).limit(limit).all()
+
+
+# Columns of a property search reading only some columns, the sort key of the cursor is read too
+def search_columns(sort: schemas.PropertySortEnum, columns: List[str]) -> List[str]:
+    if sort != schemas.PropertySortEnum.id and "selling_price" not in columns:
+        return columns + ["selling_price"]
+    return columns
+
+
+# search_properties reading only some columns as rows
+def search_properties_rows(db: Session, filters: schemas.PropertyFilter, columns: List[str],
+                           sort: schemas.PropertySortEnum = schemas.PropertySortEnum.id,
+                           limit: int = 100, after: Optional[List[int]] = None):
+    query = search_properties_query(db=db, filters=filters, sort=sort, after=after)
+    return db.execute(query.with_entities(*_columns(models.Property.__table__, search_columns(sort, columns)))
+                      .limit(limit).statement).fetchall()
+
+
+# Core statement of a property search, for the async mode (see async_crud.py)
+def search_properties_statement(filters: schemas.PropertyFilter,
+                                sort: schemas.PropertySortEnum = schemas.PropertySortEnum.id,
+                                limit: int = 100, after: Optional[List[int]] = None,
+                                columns: Optional[List[str]] = None):
+    conditions, order_by = property_search_order(sort, after)
+    selected = _columns(models.Property.__table__, None if columns is None else search_columns(sort, columns))
+    return select(selected).where(and_(*property_filter_conditions(filters), *conditions)) \
+        .order_by(*order_by).limit(limit)
+
+
+# R*Tree of the locations of the properties (see migrations.py)
+properties_rtree = table("properties_rtree", column("id"), column("min_latitude"), column("max_latitude"),
+                         column("min_longitude"), column("max_longitude"))
+
+
+# Join whose left table is read first, SQLite doesn't reorder the tables of a CROSS JOIN
+class CrossJoin(Join):
+    pass
+
+
+@compiles(CrossJoin)
+def _compile_cross_join(join, compiler, asfrom=True, **kw):
+    return "%s CROSS JOIN %s ON %s" % (join.left._compiler_dispatch(compiler, asfrom=True, **kw),
+                                       join.right._compiler_dispatch(compiler, asfrom=True, **kw),
+                                       join.onclause._compiler_dispatch(compiler, **kw))
+
+
+# The properties of a box are looked up by id from the R*Tree. Otherwise SQLite may
+# prefer the index of a filter, e.g. is_available, and check the box for each
+# property of this index (5 times slower for the available properties of Paris).
+rtree_properties = CrossJoin(properties_rtree, models.Property.__table__,
+                             properties_rtree.c.id == models.Property.id)
+
+
+# Conditions of the properties of rtree_properties located in a box (see geo.py). The
+# bounds of the R*Tree preselect the box, then the exact locations are compared.
+def box_conditions(box: geo.Box):
+    min_latitude, max_latitude, min_longitude, max_longitude = box
+    return [properties_rtree.c.max_latitude >= min_latitude, properties_rtree.c.min_latitude <= max_latitude,
+            properties_rtree.c.max_longitude >= min_longitude, properties_rtree.c.min_longitude <= max_longitude,
+            models.Property.latitude.between(min_latitude, max_latitude),
+            models.Property.longitude.between(min_longitude, max_longitude)]
+
+
+# Properties of a map viewport ordered by id, see geo.viewport_boxes. The R*Tree is
+# searched once per box.
+def get_properties_in_bbox(db: Session, min_latitude: float, max_latitude: float, min_longitude: float,
+                           max_longitude: float, filters: schemas.PropertyFilter, limit: int = 100,
+                           after_id: Optional[int] = None):
+    db_properties = []
+    for box in geo.viewport_boxes(min_latitude, max_latitude, min_longitude, max_longitude):
+        query = db.query(models.Property).select_from(rtree_properties).filter(
+            *property_filter_conditions(filters), *box_conditions(box))
+        if after_id is not None:
+            query = query.filter(models.Property.id > after_id)
+        db_properties += query.order_by(models.Property.id).limit(limit).all()
+    return sorted(db_properties, key=lambda db_property: db_property.id)[:limit]
+
+
+# Radii of the successive searches of get_properties_near, as parts of radius_km
+NEAR_STEPS = (1 / 16, 1 / 4, 1)
+
+
+# Ids and locations of the properties of a box matching the conditions, read from the R*Tree
+def located_query(box: geo.Box, conditions: list):
+    return select([models.Property.id, models.Property.latitude, models.Property.longitude]) \
+        .select_from(rtree_properties).where(and_(*box_conditions(box), *conditions))
+
+
+# Distances in km and ids of the located rows within radius_km of a point
+def within_radius(latitude: float, longitude: float, radius_km: float, rows) -> list:
+    distances = []
+    for row in rows:
+        distance = geo.distance_km(latitude, longitude, row["latitude"], row["longitude"])
+        if distance <= radius_km:
+            distances.append((distance, row["id"]))
+    return distances
+
+
+# Distances in km and ids of the properties within radius_km of a point, the
+# properties of the boxes around the circle are read from the R*Tree
+def _located_within(db: Session, latitude: float, longitude: float, radius_km: float, conditions: list):
+    distances = []
+    for box in geo.radius_boxes(latitude, longitude, radius_km):
+        distances += within_radius(latitude, longitude, radius_km, db.execute(located_query(box, conditions)))
+    return distances
+
+
+# Properties within radius_km of a point, nearest first, with their distance in km.
+# The circle is searched with growing radii (NEAR_STEPS) until it holds limit
+# properties, those are the nearest ones: in a dense city the nearest properties
+# are found without computing the distance of every property of the radius. Only
+# the nearest properties are then loaded.
+def get_properties_near(db: Session, latitude: float, longitude: float, radius_km: float,
+                        filters: schemas.PropertyFilter, limit: int = 100):
+    conditions = property_filter_conditions(filters)
+    for step in NEAR_STEPS:
+        distances = _located_within(db, latitude, longitude, radius_km * step, conditions)
+        if len(distances) >= limit:
+            break
+    nearest = heapq.nsmallest(limit, distances)
+    if not nearest:
+        return []
+    db_properties = {db_property.id: db_property for db_property in db.query(models.Property).filter(
+        models.Property.id.in_([property_id for _, property_id in nearest]))}
+    return [(db_properties[property_id], distance) for distance, property_id in nearest]
 
 
 def get_property_by_city_and_adress(db: Session, city: str, adress: str):
     return db.query(models.Property).filter(models.Property.city == city).filter(models.Property.adress == adress).first()
 
 
-def update_property(db: Session, property: schemas.PropertyUpdate, property_id: int):
-    db_property = db.query(models.Property).filter(
-        models.Property.id == property_id).first()
-    for key, val in property.dict().items():
-        setattr(db_property, key, val)
-    db.commit()
-    return db_property
+# A single UPDATE statement, the database checks that the owner exists.
+# Return None if the property doesn't exist. The cached former owner has the
+# property tag, only the new owner has to be invalidated in addition.
+def update_property(db: Session, property: schemas.PropertyUpdate, property_id: int,
+                    expected_versions: Optional[List[int]] = None):
+    query = db.query(models.Property).filter(models.Property.id == property_id)
+    updated = _with_version(query, models.Property, expected_versions).update(
+        property.dict(), synchronize_session=False)
+    _commit(db)
+    tags = [property_key(property_id)]
+    if property.owner_id is not None:
+        tags.append(user_key(property.owner_id))
+    response_cache.invalidate(*tags)
+    if not updated:
+        _check_not_updated(db, models.Property, property_id, expected_versions)
+        return None
+    return get_property(db=db, property_id=property_id)
 
 
-def update_property_owner(db: Session, property_id: int, owner_id: int):
-    db_property = db.query(models.Property).filter(
-        models.Property.id == property_id).first()
-    db_property.owner_id = owner_id
-    db.commit()
-    return db_property
+def patch_property(db: Session, property: schemas.PropertyPatch, property_id: int,
+                   expected_versions: Optional[List[int]] = None):
+    values = property.dict(exclude_unset=True)
+    row = _patch(db, models.Property, property_id, values, expected_versions)
+    if values:
+        tags = [property_key(property_id)]
+        if values.get("owner_id") is not None:
+            tags.append(user_key(values["owner_id"]))
+        response_cache.invalidate(*tags)
+    return row
 
 
-def delete_property(db: Session, property_id: int):
+def update_property_owner(db: Session, property_id: int, owner_id: int,
+                          expected_versions: Optional[List[int]] = None):
+    query = db.query(models.Property).filter(models.Property.id == property_id)
+    updated = _with_version(query, models.Property, expected_versions).update(
+        {models.Property.owner_id: owner_id}, synchronize_session=False)
+    _commit(db)
+    response_cache.invalidate(property_key(property_id), user_key(owner_id))
+    if not updated:
+        _check_not_updated(db, models.Property, property_id, expected_versions)
+        return None
+    return get_property(db=db, property_id=property_id)
+
+
+def delete_property(db: Session, property_id: int, expected_versions: Optional[List[int]] = None):
     db_property = db.query(models.Property).filter(
         models.Property.id == property_id).first()
     if db_property:
+        if expected_versions is not None and db_property.version not in expected_versions:
+            db.rollback()
+            raise StaleVersionError()
         db.delete(db_property)
         db.commit()
+        response_cache.invalidate(property_key(property_id))
         return db_property
     else:
         return None
+
+
+# Ownership transfer of the properties of an owner, optionally limited to some ids or
+# filters. Both users are checked with one SELECT, then the properties are moved by a
+# single UPDATE (one per chunk of ids) in one transaction, which returns their ids. The
+# triggers keep the counters and the versions of both owners up to date. Return None
+# if one of the users doesn't exist.
+def owners_count_query(owner_ids: set):
+    users = models.User.__table__
+    return select([func.count()]).where(users.c.id.in_(owner_ids))
+
+
+def transfer_statement(from_owner_id: int, to_owner_id: int, filters: Optional[schemas.PropertyFilter] = None):
+    properties = models.Property.__table__
+    conditions = [properties.c.owner_id == from_owner_id]
+    if filters is not None:
+        conditions.extend(property_filter_conditions(filters))
+    return UpdateReturning(properties, [properties.c.id]).where(and_(*conditions)).values(owner_id=to_owner_id)
+
+
+def transfer_properties(db: Session, from_owner_id: int, to_owner_id: int, ids: Optional[List[int]] = None,
+                        filters: Optional[schemas.PropertyFilter] = None) -> Optional[List[int]]:
+    owners = {from_owner_id, to_owner_id}
+    if db.execute(owners_count_query(owners)).scalar() != len(owners):
+        return None
+    properties = models.Property.__table__
+    statement = transfer_statement(from_owner_id, to_owner_id, filters)
+    try:
+        if ids is None:
+            moved = [row.id for row in db.execute(statement)]
+        else:
+            statement = statement.where(properties.c.id.in_(bindparam("ids", expanding=True)))
+            moved = [row.id for chunk in _chunks(sorted(set(ids)), BULK_CHUNK_SIZE)
+                     for row in db.execute(statement, {"ids": chunk})]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    response_cache.invalidate(user_key(from_owner_id), user_key(to_owner_id),
+                              *(property_key(property_id) for property_id in moved))
+    return sorted(moved)
+
+
+# Bulk DELETE operations, set-based statements in a single transaction: one statement per
+# chunk of ids (or one for a filter) instead of a SELECT and a DELETE per row. The triggers
+# keep the counters, the statistics and the indexes up to date. The whole response cache
+# is cleared rather than the tags of every deleted row. Return the counts of rows.
+def _execute_in_chunks(db: Session, statement, ids: List[int]) -> int:
+    return sum(db.execute(statement, {"ids": chunk}).rowcount for chunk in _chunks(ids, BULK_CHUNK_SIZE))
+
+
+def delete_users_bulk(db: Session, ids: List[int],
+                      properties: schemas.OwnedPropertiesEnum = schemas.OwnedPropertiesEnum.detach):
+    users = models.User.__table__
+    property_table = models.Property.__table__
+    owned = property_table.c.owner_id.in_(bindparam("ids", expanding=True))
+    if properties == schemas.OwnedPropertiesEnum.delete:
+        properties_statement = property_table.delete().where(owned)
+    else:
+        properties_statement = property_table.update().where(owned).values(owner_id=None)
+    ids = sorted(set(ids))
+    try:
+        property_count = _execute_in_chunks(db, properties_statement, ids)
+        deleted = _execute_in_chunks(db, users.delete().where(users.c.id.in_(bindparam("ids", expanding=True))), ids)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    response_cache.clear()
+    key = "properties_deleted" if properties == schemas.OwnedPropertiesEnum.delete else "properties_detached"
+    return {"deleted": deleted, key: property_count}
+
+
+def delete_properties_bulk(db: Session, ids: Optional[List[int]] = None,
+                           filters: Optional[schemas.PropertyDeleteFilter] = None):
+    property_table = models.Property.__table__
+    statement = property_table.delete()
+    conditions = property_delete_conditions(filters) if filters is not None else []
+    if conditions:
+        statement = statement.where(and_(*conditions))
+    try:
+        if ids is None:
+            deleted = db.execute(statement).rowcount
+        else:
+            deleted = _execute_in_chunks(
+                db, statement.where(property_table.c.id.in_(bindparam("ids", expanding=True))), sorted(set(ids)))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    response_cache.clear()
+    return {"deleted": deleted}
+
+
+# The database checks that the property exists and that the booking doesn't overlap
+# another booking of the property
+def create_booking(db: Session, property_id: int, booking: schemas.BookingCreate):
+    db_booking = models.Booking(property_id=property_id, **booking.dict())
+    db.add(db_booking)
+    _commit(db)
+    db.refresh(db_booking)
+    return db_booking
+
+
+# Bookings of a property in order, read from the ix_bookings_property_start index
+def get_bookings(db: Session, property_id: int):
+    return db.query(models.Booking).filter(models.Booking.property_id == property_id) \
+        .order_by(models.Booking.start_date).all()
+
+
+def delete_booking(db: Session, property_id: int, booking_id: int):
+    db_booking = db.query(models.Booking).filter(
+        models.Booking.id == booking_id, models.Booking.property_id == property_id).first()
+    if db_booking is None:
+        return None
+    db.delete(db_booking)
+    db.commit()
+    return db_booking
+
+
+# Read a whole table in chunks of chunk_size rows. Each chunk is a keyset query
+# starting after the last id of the previous chunk, so the memory used doesn't
+# depend on the size of the table and no cursor stays open while a chunk is
+# being sent to a slow client.
+def iter_table_chunks(db: Session, table, chunk_size: int = 1000, columns: Optional[List] = None):
+    statement = select(columns or [table]).order_by(table.c.id).limit(chunk_size)
+    next_statement = statement.where(table.c.id > bindparam("after_id"))
+    rows = db.execute(statement).fetchall()
+    while rows:
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        rows = db.execute(next_statement, {"after_id": rows[-1].id}).fetchall()
+
+
+# The one or two middle selling prices of a city. They are read from the covering index of the
+# search on (city, is_available, selling_price) and sorted, the medians are cached per version
+# of the city statistics. count is the number of properties of the city with a selling price.
+def median_prices_query(city: str, count: int):
+    price = models.Property.selling_price
+    return select([price]).where(and_(models.Property.city == city, price.isnot(None))) \
+        .order_by(price).offset((count - 1) // 2).limit(2 - count % 2)
+
+
+def median(prices: List) -> Optional[float]:
+    return sum(prices) / len(prices) if prices else None
+
+
+def get_median_selling_price(db: Session, city: str, count: int) -> Optional[float]:
+    if not count:
+        return None
+    return median([row[0] for row in db.execute(median_prices_query(city, count))])
+
+
+# Statistics of the cities, ordered by city
+def city_stats_query(city: Optional[str] = None):
+    city_stats = models.CityStats.__table__
+    query = select([city_stats]).order_by(city_stats.c.city)
+    return query if city is None else query.where(city_stats.c.city == city)
+
+
+# The medians are computed again only for the cities whose statistics changed since
+# they were last computed.
+def get_city_stats(db: Session, city: Optional[str] = None) -> List[dict]:
+    return [stats.city_summary(row, stats.medians.get(
+        row.city, row.version, lambda row=row: get_median_selling_price(db, row.city, row.selling_price_count)))
+        for row in db.execute(city_stats_query(city))]
+
+
+# Words of a full text search, at most SEARCH_MAX_WORDS are used
+SEARCH_WORD = re.compile(r"\w+")
+SEARCH_MAX_WORDS = 8
+
+
+# FTS5 query matching the rows with a word starting with each word of the text,
+# e.g. '"rue"* "marg"*' for "rue Marg". None if the text has no word.
+def search_match_expression(text_query: str) -> Optional[str]:
+    words = SEARCH_WORD.findall(text_query)[:SEARCH_MAX_WORDS]
+    if not words:
+        return None
+    return " ".join('"%s"*' % word for word in words)
+
+
+# Rows of a table matching a text in its FTS5 table (see migrations.py), best ranked
+# first. The matches are ranked by FTS5 with bm25, which favours the rows matching
+# the words in more columns and the shorter texts, and only the best "limit" ones
+# are read from the table. The rank of every match is computed, a common prefix
+# costs a few milliseconds at a million rows. None if the text has no word.
+def search_text_query(indexed, text_query: str, limit: int):
+    match = search_match_expression(text_query)
+    if match is None:
+        return None
+    fts = "%s_fts" % indexed.name
+    matches = select([literal_column("rowid").label("id"), literal_column("rank").label("rank")]) \
+        .select_from(table(fts)).where(text("%s MATCH :match" % fts).bindparams(match=match)) \
+        .order_by(literal_column("rank")).limit(limit).alias("matches")
+    return select([indexed]).select_from(indexed.join(matches, indexed.c.id == matches.c.id)) \
+        .order_by(matches.c.rank, indexed.c.id)
+
+
+def _search_text(db: Session, indexed, text_query: str, limit: int):
+    query = search_text_query(indexed, text_query, limit)
+    return [] if query is None else db.execute(query).fetchall()
+
+
+def search_properties_text(db: Session, text_query: str, limit: int = 10):
+    return _search_text(db, models.Property.__table__, text_query, limit)
+
+
+def search_users_text(db: Session, text_query: str, limit: int = 10):
+    return _search_text(db, models.User.__table__, text_query, limit)
@@ -1,6 +1,17 @@
-from sqlalchemy import create_engine
+import asyncio
+import os
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+import databases
+from databases.backends.sqlite import SQLiteBackend
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.dialects.sqlite import pysqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 # Here I choose SQLite because it doesn't require any installation on your side
 # if you want to test my API. In a real world I would choose of course a better
@@ -11,13 +22,225 @@ from sqlalchemy.orm import sessionmaker
 # - support high volumes of data
 # - support high concurrency
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./database.db"
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./database.db")
+
+
+# The API only runs on SQLite: the versions of the ETags, the counters of the owners and
+# the statistics of the cities are maintained by SQLite triggers, and the search and the
+# geographic queries read FTS5 and R*Tree tables. On another database the writes would
+# leave them stale, so its URL is rejected at startup.
+def check_database_url(url: str):
+    if not url.startswith("sqlite"):
+        raise RuntimeError("Only SQLite databases are supported, DATABASE_URL is a %s URL" % url.split(":", 1)[0])
+
+
+check_database_url(SQLALCHEMY_DATABASE_URL)
+
+# The PATCH operations and the ownership transfer use UPDATE ... RETURNING (see
+# crud.UpdateReturning), which SQLite supports since 3.35. An older SQLite library
+# is rejected at startup rather than failing on these requests.
+SQLITE_MIN_VERSION = (3, 35, 0)
+
+
+def check_sqlite_version(version_info: tuple = sqlite3.sqlite_version_info):
+    if version_info < SQLITE_MIN_VERSION:
+        raise RuntimeError("SQLite %s or later is required, the sqlite3 module uses SQLite %s" % (
+            ".".join(map(str, SQLITE_MIN_VERSION)), ".".join(map(str, version_info))))
+
+
+check_sqlite_version()
+
+# Set ASYNC_MODE=1 to serve the API with async path operations (async_main.py)
+# on the aiosqlite async driver
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "0") == "1"
+
+# SQLite profile, set on every new connection. With the WAL journal the readers
+# don't block the writer and the writer doesn't block the readers, and
+# synchronous=NORMAL is safe in WAL mode (a commit can only be lost on power failure).
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    # bytes of the database file read through a memory mapping
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    # page cache per connection, in KiB when negative
+    "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", -64 * 1024)),
+    # milliseconds to wait for a lock before failing with "database is locked"
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000)),
+    # enforce the foreign keys, the writes rely on them to check the owner ids
+    "foreign_keys": "ON",
+}
+
+# Number of connections of the read pool
+READ_POOL_SIZE = int(os.environ.get("READ_POOL_SIZE", 8))
+
+# Number of connections of the pool of the async mode
+ASYNC_POOL_SIZE = int(os.environ.get("ASYNC_POOL_SIZE", 8))
+
+
+# Create a SQL Alchemy engine on a SQLite database with the SQLITE_PRAGMAS profile.
+# The connections of a read only engine can't write (query_only), and with a
+# pool of a single connection the writes of all the threads are serialized.
+def create_sqlite_engine(url: str, pool_size: int = 1, read_only: bool = False, pragmas: dict = None):
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+    sqlite_engine = create_engine(url, connect_args={"check_same_thread": False},
+                                  poolclass=QueuePool, pool_size=pool_size, max_overflow=0)
+
+    @event.listens_for(sqlite_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        if read_only:
+            cursor.execute("PRAGMA query_only = ON")
+        cursor.close()
+
+    return sqlite_engine
+
+
+# Coroutines awaited after each statement of the async connections with the connection,
+# the statement and its duration in seconds, the counterpart of the cursor execution
+# events of the SQL Alchemy engines (see metrics.py and slow_queries.py)
+async_query_listeners = []
+
+# Dialect of the SQLite backend of the "databases" library
+_async_dialect = pysqlite.dialect(paramstyle="qmark")
+
+
+# SQL string and parameters of a statement of an async connection, compiled like the
+# SQLite backend of the "databases" library does. Only the listeners which need them
+# compile the statements.
+def compile_async_query(query, values: dict = None):
+    if isinstance(query, str):
+        query = text(query)
+        if values is not None:
+            query = query.bindparams(**values)
+    compiled = query.compile(dialect=_async_dialect)
+    processors = compiled._bind_processors
+    parameters = [processors[key](value) if key in processors else value
+                  for key, value in compiled.construct_params().items()]
+    return compiled.string, parameters
+
+
+# Connection of the "databases" library timing its statements for the async_query_listeners.
+# The statements which fail are reported too.
+class AsyncConnection:
+    def __init__(self, connection):
+        self.connection = connection
+
+    @property
+    def raw_connection(self):
+        return self.connection.raw_connection
+
+    def transaction(self):
+        return self.connection.transaction()
+
+    async def _run(self, method, query, values: dict = None):
+        start = time.perf_counter()
+        try:
+            return await method(query, values)
+        finally:
+            elapsed = time.perf_counter() - start
+            for listener in async_query_listeners:
+                await listener(self, query, values, elapsed)
+
+    async def fetch_all(self, query, values: dict = None):
+        return await self._run(self.connection.fetch_all, query, values)
+
+    async def fetch_one(self, query, values: dict = None):
+        return await self._run(self.connection.fetch_one, query, values)
+
+    async def fetch_val(self, query, values: dict = None):
+        return await self._run(self.connection.fetch_val, query, values)
+
+    async def execute(self, query, values: dict = None):
+        return await self._run(self.connection.execute, query, values)
+
+
+# Pool of the async mode, the counterpart of the QueuePool of create_sqlite_engine. The SQLite
+# backend of the "databases" library opens a new aiosqlite connection, and its thread, for
+# every request. This pool keeps up to size connections open, the profile is set once on
+# each new connection, and the requests wait for a free connection beyond size.
+class SQLiteAsyncPool:
+    def __init__(self, url: databases.DatabaseURL, size: int, pragmas: dict, **options):
+        self._url = url
+        self._options = options
+        self._script = "".join("PRAGMA %s = %s;" % (name, value) for name, value in pragmas.items())
+        self.size = size
+        self.opened = 0
+        self._idle = []
+        self._available = None
+
+    # the semaphore is created on the event loop of the application
+    async def connect(self):
+        self._available = asyncio.Semaphore(self.size)
+
+    async def disconnect(self):
+        while self._idle:
+            await self._idle.pop().close()
+        self.opened = 0
+
+    async def _open(self) -> aiosqlite.Connection:
+        connection = await aiosqlite.connect(database=self._url.database, isolation_level=None, **self._options)
+        await connection.executescript(self._script)
+        self.opened += 1
+        return connection
+
+    async def acquire(self) -> aiosqlite.Connection:
+        await self._available.acquire()
+        try:
+            return self._idle.pop() if self._idle else await self._open()
+        except BaseException:
+            self._available.release()
+            raise
+
+    async def release(self, connection: aiosqlite.Connection):
+        try:
+            if connection.in_transaction:
+                await connection.rollback()
+            self._idle.append(connection)
+        except sqlite3.Error:
+            self.opened -= 1
+            await connection.close()
+        finally:
+            self._available.release()
+
+
+# SQLite backend of the "databases" library on a SQLiteAsyncPool
+class PooledSQLiteBackend(SQLiteBackend):
+    def __init__(self, database_url, size: int = ASYNC_POOL_SIZE, pragmas: dict = None, **options):
+        super().__init__(database_url, **options)
+        self._pool = self.pool = SQLiteAsyncPool(self._database_url, size,
+                                                 SQLITE_PRAGMAS if pragmas is None else pragmas, **options)
+
+    async def connect(self):
+        await self.pool.connect()
+
+    async def disconnect(self):
+        await self.pool.disconnect()
+
+
+# Database of the "databases" library for the async mode, its connections come from a
+# SQLiteAsyncPool of size connections with the SQLITE_PRAGMAS profile
+class AsyncDatabase(databases.Database):
+    SUPPORTED_BACKENDS = {"sqlite": "%s:PooledSQLiteBackend" % __name__}
+
+    def __init__(self, url: str, size: int = ASYNC_POOL_SIZE, pragmas: dict = None):
+        super().__init__(url, size=size, pragmas=pragmas)
+
+
+# Connection of an AsyncDatabase for the duration of a request
+@asynccontextmanager
+async def async_connection(async_database: AsyncDatabase):
+    async with async_database.connection() as connection:
+        yield AsyncConnection(connection)
+
 
-# Create a SQL Alchemy engine
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-# Create a sessionmaker to create later database session
+# Create the SQL Alchemy engines, writes go through "engine" and the read only
+# path operations use "read_engine"
+engine = create_sqlite_engine(SQLALCHEMY_DATABASE_URL)
+read_engine = create_sqlite_engine(SQLALCHEMY_DATABASE_URL, pool_size=READ_POOL_SIZE, read_only=True)
+# Create sessionmakers to create later database sessions
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 # Create a base class to create later SQL Alchemy models
 Base = declarative_base()
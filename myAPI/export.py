@@ -0,0 +1,105 @@
+import csv
+import io
+import json
+from datetime import date
+from decimal import Decimal
+from enum import Enum
+from typing import AsyncIterator, Iterable, Iterator, List
+
+from sqlalchemy import Table
+
+from . import models
+
+
+# Tables which can be exported, by name
+EXPORT_TABLES = {
+    "users": models.User.__table__,
+    "properties": models.Property.__table__,
+}
+
+# Internal and derived columns left out of the exports
+EXPORT_EXCLUDED_COLUMNS = {"version", "property_count", "rented_count", "total_rental_income"}
+
+# Number of rows read from the database and written to the response at once
+EXPORT_CHUNK_SIZE = 1000
+
+
+class ExportTableEnum(str, Enum):
+    users = 'users'
+    properties = 'properties'
+
+
+class ExportFormatEnum(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormatEnum.ndjson: "application/x-ndjson",
+    ExportFormatEnum.csv: "text/csv",
+}
+
+
+def export_columns(table: Table) -> List:
+    return [column for column in table.columns if column.name not in EXPORT_EXCLUDED_COLUMNS]
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def ndjson_header(table: Table) -> str:
+    return ""
+
+
+def ndjson_rows(table: Table, rows: List) -> str:
+    """
+    Format rows of a table as NDJSON, one JSON object per row.
+    """
+    columns = [column.name for column in export_columns(table)]
+    return "".join(json.dumps(dict(zip(columns, row)), default=_json_default) + "\n"
+                   for row in rows)
+
+
+def csv_header(table: Table) -> str:
+    return csv_rows(table, [[column.name for column in export_columns(table)]])
+
+
+def csv_rows(table: Table, rows: List) -> str:
+    """
+    Format rows of a table as CSV lines.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+EXPORT_FORMATTERS = {
+    ExportFormatEnum.ndjson: (ndjson_header, ndjson_rows),
+    ExportFormatEnum.csv: (csv_header, csv_rows),
+}
+
+
+def stream_export(format: ExportFormatEnum, table: Table, chunks: Iterable[List]) -> Iterator[str]:
+    """
+    Format the row chunks of a table one after the other.
+    """
+    header, format_rows = EXPORT_FORMATTERS[format]
+    yield header(table)
+    for rows in chunks:
+        yield format_rows(table, rows)
+
+
+async def astream_export(format: ExportFormatEnum, table: Table,
+                         chunks: AsyncIterator[List]) -> AsyncIterator[str]:
+    """
+    Format the row chunks of a table read by an async iterator one after the other.
+    """
+    header, format_rows = EXPORT_FORMATTERS[format]
+    yield header(table)
+    async for rows in chunks:
+        yield format_rows(table, rows)
@@ -0,0 +1,207 @@
+"""
+Fill a database with synthetic users and properties for scale testing.
+
+    python -m myAPI.generate --users 100000 --properties 1000000 --seed 42
+
+The database is the one of the DATABASE_URL setting (./database.db by default)
+or --database-url. The rows respect the constraints of models.py and schemas.py:
+unique full name, email and phone, unique adress per city, a property is either
+a home or a flat, is never both sold and rented and is only available when it is
+neither. The properties are located around the centre of their city. For a
+given seed and a given database the same rows are generated.
+
+The rows are inserted by chunks with executemany in a single transaction. The
+secondary indexes and the triggers are dropped during the load and created
+again afterwards, which is much faster than updating them row by row.
+"""
+import argparse
+import itertools
+import random
+import sys
+import time
+from datetime import date, timedelta
+from typing import Iterator, List
+
+from sqlalchemy.engine import Engine
+
+from . import migrations, models
+from .database import SQLALCHEMY_DATABASE_URL, create_sqlite_engine
+
+FIRST_NAMES = ["Pierre", "Lucas", "Sophie", "Marie", "Julien", "Camille", "Nicolas", "Emma", "Thomas",
+               "Chloe", "Antoine", "Lea", "Hugo", "Manon", "Louis", "Sarah", "Paul", "Ines", "Jules", "Clara"]
+LAST_NAMES = ["Dumont", "Parac", "Pressieux", "Martin", "Bernard", "Dubois", "Thomas", "Robert", "Richard",
+              "Petit", "Durand", "Leroy", "Moreau", "Simon", "Laurent", "Lefebvre", "Michel", "Garcia"]
+JOBS = ["serveur", "chef de projet", "developpeur", "infirmier", "professeur", "comptable", "architecte",
+        "boulanger", "avocat", "medecin", "commercial", "ingenieur"]
+CITIES = ["Paris", "Marseille", "Lyon", "Toulouse", "Nice", "Nantes", "Montpellier", "Strasbourg",
+          "Bordeaux", "Lille", "Rennes", "Reims", "Toulon", "Saint-Etienne", "Le Havre", "Grenoble",
+          "Dijon", "Angers", "Nimes", "Villeurbanne"]
+# Latitude and longitude of the centre of the cities, the other cities are placed at random in France
+CITY_COORDINATES = {
+    "Paris": (48.8566, 2.3522), "Marseille": (43.2965, 5.3698), "Lyon": (45.7640, 4.8357),
+    "Toulouse": (43.6047, 1.4442), "Nice": (43.7102, 7.2620), "Nantes": (47.2184, -1.5536),
+    "Montpellier": (43.6108, 3.8767), "Strasbourg": (48.5734, 7.7521), "Bordeaux": (44.8378, -0.5792),
+    "Lille": (50.6292, 3.0573), "Rennes": (48.1173, -1.6778), "Reims": (49.2583, 4.0317),
+    "Toulon": (43.1242, 5.9280), "Saint-Etienne": (45.4397, 4.3872), "Le Havre": (49.4944, 0.1079),
+    "Grenoble": (45.1885, 5.7245), "Dijon": (47.3220, 5.0415), "Angers": (47.4784, -0.5632),
+    "Nimes": (43.8367, 4.3601), "Villeurbanne": (45.7719, 4.8902),
+}
+# Standard deviation of the distance of the properties to the centre of their city, in degrees
+CITY_SPREAD = 0.03
+STREETS = ["rue de la Paix", "avenue des Champs", "boulevard Saint Martin", "rue Victor Hugo",
+           "place de la Republique", "rue du Moulin", "allee des Tilleuls", "chemin des Vignes"]
+
+FIRST_DATE = date(2000, 1, 1)
+DATE_RANGE_DAYS = 365 * 21
+CHUNK_SIZE = 50000
+
+
+# Cumulated weights of a Zipf distribution over n ranks, a skew of 0 is uniform
+def zipf_cum_weights(n: int, skew: float) -> List[float]:
+    return list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, n + 1)))
+
+
+class Generator:
+    def __init__(self, args, first_user_id: int, first_property_id: int):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.first_user_id = first_user_id
+        self.first_property_id = first_property_id
+        self.cities = CITIES[:args.cities] + ["City %d" % i for i in range(len(CITIES), args.cities)]
+        self.centres = {city: CITY_COORDINATES.get(city) or (self.rng.uniform(43, 50), self.rng.uniform(-1, 7))
+                        for city in self.cities}
+
+    def nullable(self, value):
+        return None if self.rng.random() < self.args.null_rate else value
+
+    def random_date(self):
+        return (FIRST_DATE + timedelta(days=self.rng.randrange(DATE_RANGE_DAYS))).isoformat()
+
+    def users(self) -> Iterator[tuple]:
+        rng = self.rng
+        for user_id in range(self.first_user_id, self.first_user_id + self.args.users):
+            first_name = rng.choice(FIRST_NAMES)
+            last_name = rng.choice(LAST_NAMES)
+            # the id makes the unique values unique
+            yield (user_id, "%s %s %d" % (first_name, last_name, user_id),
+                   self.nullable(rng.randint(18, 120)), self.nullable(rng.choice("MF")),
+                   "%s.%s.%d@example.com" % (first_name.lower(), last_name.lower(), user_id),
+                   self.nullable("+336%08d" % user_id), self.nullable(rng.randint(1000, 10000)),
+                   self.nullable(rng.choice(JOBS)))
+
+    def properties(self) -> Iterator[tuple]:
+        rng = self.rng
+        args = self.args
+        count = args.properties
+        cities = rng.choices(self.cities, cum_weights=zipf_cum_weights(len(self.cities), args.city_skew), k=count)
+        if args.users:
+            owners = rng.choices(range(self.first_user_id, self.first_user_id + args.users),
+                                 cum_weights=zipf_cum_weights(args.users, args.owner_skew), k=count)
+        else:
+            owners = [None] * count
+        for index, property_id in enumerate(range(self.first_property_id, self.first_property_id + count)):
+            status = rng.random()
+            is_sold = status < args.sold_rate
+            is_rented = not is_sold and status < args.sold_rate + args.rented_rate
+            is_available = not is_sold and not is_rented
+            is_flat = rng.random() < args.flat_rate
+            surface = round(rng.uniform(9, 40) if is_flat else rng.uniform(40, 300), 1)
+            owner_id = None if rng.random() < args.unowned_rate else owners[index]
+            latitude, longitude = self.centres[cities[index]]
+            location = self.nullable((round(rng.gauss(latitude, CITY_SPREAD), 6),
+                                      round(rng.gauss(longitude, CITY_SPREAD), 6))) or (None, None)
+            yield (property_id, "%d %s" % (property_id, rng.choice(STREETS)), cities[index],
+                   self.nullable(surface), self.nullable(max(1, int(surface // 20))),
+                   not is_flat, is_flat, self.nullable(rng.randint(0, 150)),
+                   self.nullable(int(surface * rng.randint(2000, 12000))),
+                   self.random_date() if is_sold else None, is_sold,
+                   self.nullable(int(surface * rng.randint(10, 40))),
+                   self.random_date() if is_rented else None, is_rented,
+                   self.random_date() if is_available else None, is_available, owner_id) + location
+
+
+USER_COLUMNS = ["id", "full_name", "age", "gender", "email", "phone", "salary", "job"]
+PROPERTY_COLUMNS = ["id", "adress", "city", "surface", "rooms", "is_home", "is_flat", "age",
+                    "selling_price", "sale_date", "is_sold", "rental_price", "rental_start_date",
+                    "is_rented", "availability_date", "is_available", "owner_id", "latitude", "longitude"]
+
+
+def _insert_chunks(cursor, table: str, columns: List[str], rows: Iterator[tuple]) -> int:
+    statement = "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns), ", ".join("?" * len(columns)))
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, CHUNK_SIZE))
+        if not chunk:
+            return count
+        cursor.executemany(statement, chunk)
+        count += len(chunk)
+
+
+# Drop the secondary indexes and the triggers, they are created again by migrations.upgrade
+def _defer_indexes(cursor):
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            cursor.execute("DROP INDEX IF EXISTS %s" % index.name)
+    for name in migrations.SQLITE_TRIGGERS:
+        cursor.execute("DROP TRIGGER IF EXISTS %s" % name)
+
+
+def generate(engine: Engine, args) -> dict:
+    migrations.upgrade(engine)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA synchronous = OFF")
+        if args.reset:
+            cursor.execute("DELETE FROM properties")
+            cursor.execute("DELETE FROM users")
+        next_ids = [(cursor.execute("SELECT MAX(id) FROM %s" % table).fetchone()[0] or 0) + 1
+                    for table in ("users", "properties")]
+        generator = Generator(args, *next_ids)
+        _defer_indexes(cursor)
+        timings = {}
+        start = time.perf_counter()
+        users = _insert_chunks(cursor, "users", USER_COLUMNS, generator.users())
+        properties = _insert_chunks(cursor, "properties", PROPERTY_COLUMNS, generator.properties())
+        timings["insert_s"] = time.perf_counter() - start
+        connection.commit()
+    finally:
+        connection.close()
+    start = time.perf_counter()
+    migrations.upgrade(engine)
+    timings["indexes_s"] = time.perf_counter() - start
+    return dict(timings, users=users, properties=properties)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database-url", default=SQLALCHEMY_DATABASE_URL)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--properties", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reset", action="store_true", help="delete the existing users and properties first")
+    parser.add_argument("--cities", type=int, default=len(CITIES), help="number of cities")
+    parser.add_argument("--city-skew", type=float, default=1.0,
+                        help="Zipf exponent of the distribution of the properties among the cities, 0 is uniform")
+    parser.add_argument("--owner-skew", type=float, default=0.0,
+                        help="Zipf exponent of the distribution of the properties among the owners, 0 is uniform")
+    parser.add_argument("--unowned-rate", type=float, default=0.1, help="part of the properties without owner")
+    parser.add_argument("--null-rate", type=float, default=0.1, help="part of null values in the nullable fields")
+    parser.add_argument("--flat-rate", type=float, default=0.6, help="part of flats, the others are homes")
+    parser.add_argument("--sold-rate", type=float, default=0.2)
+    parser.add_argument("--rented-rate", type=float, default=0.3)
+    args = parser.parse_args(argv)
+    if args.sold_rate + args.rented_rate > 1:
+        parser.error("--sold-rate + --rented-rate must not exceed 1")
+    if not args.database_url.startswith("sqlite"):
+        parser.error("only SQLite databases are supported")
+
+    engine = create_sqlite_engine(args.database_url)
+    result = generate(engine, args)
+    engine.dispose()
+    print("inserted %d users and %d properties in %.1f s, indexes created in %.1f s" % (
+        result["users"], result["properties"], result["insert_s"], result["indexes_s"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,46 @@
+import math
+from typing import List, Tuple
+
+# Mean radius of the Earth in km
+EARTH_RADIUS_KM = 6371.0088
+
+# A box is (min_latitude, max_latitude, min_longitude, max_longitude) in degrees,
+# its min_longitude is never greater than its max_longitude
+Box = Tuple[float, float, float, float]
+
+
+# Great circle distance between two points in km (haversine formula)
+def distance_km(latitude1: float, longitude1: float, latitude2: float, longitude2: float) -> float:
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+# Boxes of a map viewport, its min_longitude is greater than its max_longitude when
+# it crosses the antimeridian (e.g. 170 to -170), it is then split in two boxes
+def viewport_boxes(min_latitude: float, max_latitude: float, min_longitude: float,
+                   max_longitude: float) -> List[Box]:
+    if min_longitude <= max_longitude:
+        return [(min_latitude, max_latitude, min_longitude, max_longitude)]
+    return [(min_latitude, max_latitude, min_longitude, 180.0), (min_latitude, max_latitude, -180.0, max_longitude)]
+
+
+# Smallest boxes holding the points within radius_km of a point, see "Finding Points
+# Within a Distance of a Latitude/Longitude Using Bounding Coordinates" (J. Matuschek).
+# A circle around a pole holds all the longitudes.
+def radius_boxes(latitude: float, longitude: float, radius_km: float) -> List[Box]:
+    angle = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_latitude = latitude - angle
+    max_latitude = latitude + angle
+    if min_latitude <= -90 or max_latitude >= 90 or angle >= 90:
+        return [(max(min_latitude, -90.0), min(max_latitude, 90.0), -180.0, 180.0)]
+    delta = math.degrees(math.asin(min(1.0, math.sin(math.radians(angle)) / math.cos(math.radians(latitude)))))
+    min_longitude = longitude - delta
+    max_longitude = longitude + delta
+    if min_longitude < -180:
+        min_longitude += 360
+    if max_longitude > 180:
+        max_longitude -= 360
+    return viewport_boxes(min_latitude, max_latitude, min_longitude, max_longitude)
@@ -0,0 +1,294 @@
+import json
+from datetime import date
+from typing import List, Optional
+
+from fastapi import HTTPException, Query, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+
+from . import crud, migrations, schemas
+from .cache import response_cache
+from .pagination import NEXT_CURSOR_HEADER, decode_id_cursor, decode_int_cursor, encode_cursor
+
+
+# Request parsing and response helpers of the path operations of routes.py, shared by
+# the sync (main.py) and the async (async_main.py) apps.
+
+
+# The rows are ORM objects in the sync path and database records or dicts in the async path
+def row_value(row, name: str):
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+# Field and message of the validation error of the check constraints of the properties,
+# they are violated by a PATCH setting one of the fields of a rule
+CHECK_CONSTRAINT_ERRORS = {
+    "_is_home_is_flat_cc": ("is_flat", schemas.IS_HOME_IS_FLAT_ERROR),
+    "_is_sold_is_rented_cc": ("is_rented", schemas.IS_SOLD_IS_RENTED_ERROR),
+    "_latitude_longitude_cc": ("longitude", schemas.LATITUDE_LONGITUDE_ERROR),
+}
+
+
+# Map a constraint violated by a write to the response of the former pre-checks:
+# a duplicated user field is a 400 and an unknown owner id a 404. An overlapping
+# booking is a 409 and a check constraint the 422 of the validation of the body.
+def raise_integrity_error(exc):
+    column = crud.unique_violation_column(exc)
+    labels = dict(crud.USER_UNIQUE_FIELDS)
+    if column in labels:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="User with the same %s is already registered" % labels[column])
+    if column in crud.PROPERTY_UNIQUE_COLUMNS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Property already registered")
+    check = crud.check_violation_name(exc)
+    if check in CHECK_CONSTRAINT_ERRORS:
+        field, message = CHECK_CONSTRAINT_ERRORS[check]
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=[{"loc": ["body", field], "msg": message, "type": "value_error"}])
+    if crud.is_booking_overlap(exc):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=migrations.BOOKING_OVERLAP)
+    if crud.is_foreign_key_violation(exc):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="The owner id doesn't match any user")
+    raise exc
+
+
+# Decode the "cursor" query parameter of the paginated endpoints
+def parse_cursor(cursor: Optional[str]):
+    if cursor is None:
+        return None
+    try:
+        return decode_id_cursor(cursor)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+# Relationships which can be embedded in the user responses with the "include" query parameter
+USER_INCLUDES = {"properties"}
+
+
+# Decode the "include" query parameter, a comma separated list of relationships
+def parse_include(include: str, allowed: set) -> set:
+    names = {name.strip() for name in include.split(",") if name.strip()}
+    unknown = names - allowed
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Unknown include: %s" % ", ".join(sorted(unknown)))
+    return names
+
+
+# Fields which can be selected with the "fields" query parameter, the ones of the responses
+# without their relationships
+USER_FIELDS = list(schemas.UserSummary.__fields__)
+PROPERTY_FIELDS = list(schemas.Property.__fields__)
+
+
+# Decode the "fields" query parameter, a comma separated list of fields, into the fields
+# to return in the order of the response model. The id is always returned, it is the key
+# of the pages and of the relationships. None when the parameter isn't given.
+def parse_fields(fields: Optional[str], allowed: List[str]) -> Optional[List[str]]:
+    if fields is None:
+        return None
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = names - set(allowed)
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Unknown field: %s" % ", ".join(sorted(unknown)))
+    return [name for name in allowed if name in names or name == "id"]
+
+
+# Decode the cursor of the property search, its sort key depends on the sort order.
+# Return the decoded key and the function giving the sort key of a property.
+def parse_search_cursor(sort: schemas.PropertySortEnum, cursor: Optional[str]):
+    if sort == schemas.PropertySortEnum.id:
+        key, key_size = (lambda row: (row_value(row, "id"),)), 1
+    else:
+        key, key_size = (lambda row: (row_value(row, "selling_price"), row_value(row, "id"))), 2
+    if cursor is None:
+        return None, key
+    try:
+        return decode_int_cursor(cursor, size=key_size), key
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+# Trim the extra row fetched to know if there is a next page and
+# give the cursor of this next page in the response headers. An empty
+# page has no last row to start the next page from.
+def paginate(rows: list, limit: int, response: Response, key=lambda row: (row_value(row, "id"),)):
+    if len(rows) <= limit:
+        return rows
+    rows = rows[:limit]
+    if rows:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(*key(rows[-1]))
+    return rows
+
+
+# Media types of the bulk request bodies made of one JSON document per line
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/jsonl")
+
+
+# Split the body of a bulk request, a JSON array or NDJSON, into its items.
+# A NDJSON line which is not valid JSON gives a ValueError item so that
+# the other lines are still processed.
+def parse_bulk_body(body: bytes, content_type: str):
+    if content_type.split(";")[0].strip() in NDJSON_MEDIA_TYPES:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(ValueError("Invalid JSON"))
+        return items
+    try:
+        items = json.loads(body)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid JSON")
+    if not isinstance(items, list):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="A JSON array is expected")
+    return items
+
+
+def format_validation_error(exc: ValidationError):
+    return "; ".join("%s: %s" % (".".join(str(loc) for loc in error["loc"]), error["msg"])
+                     for error in exc.errors())
+
+
+# Validate the items of a bulk user import. Return the result of each item and the
+# valid users with their result. The results are plain dicts returned as is,
+# validating and encoding tens of thousands of result models would cost more
+# than the import itself.
+def validate_bulk_users(items: list):
+    results = [{"index": index, "id": None, "error": None} for index in range(len(items))]
+    valid_users = []
+    for result, item in zip(results, items):
+        if isinstance(item, ValueError):
+            result["error"] = str(item)
+            continue
+        try:
+            valid_users.append((result, schemas.UserCreate.parse_obj(item)))
+        except ValidationError as exc:
+            result["error"] = format_validation_error(exc)
+    return results, valid_users
+
+
+# Report the outcomes of crud.create_users_bulk in the results of the valid users,
+# return the number of created users
+def apply_bulk_outcomes(valid_users: list, outcomes: List):
+    created = 0
+    for (result, _), outcome in zip(valid_users, outcomes):
+        if isinstance(outcome, int):
+            result["id"] = outcome
+            created += 1
+        else:
+            result["error"] = outcome
+    return created
+
+
+# Decode a period given as its first and last days, e.g. "2021-03-01/2021-05-31"
+def parse_period(period: Optional[str], name: str):
+    if period is None:
+        return None
+    try:
+        start, end = (date.fromisoformat(day) for day in period.split("/"))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid %s, expected first and last days as 2021-03-01/2021-05-31" % name)
+    if start > end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid %s, the first day is after the last day" % name)
+    return start, end
+
+
+# Dependency reading the property filters from the query parameters
+def get_property_filter(city: Optional[str] = Query(None, max_length=50),
+                        min_price: Optional[int] = Query(None, ge=0),
+                        max_price: Optional[int] = Query(None, ge=0),
+                        min_surface: Optional[float] = Query(None, ge=0),
+                        rooms: Optional[int] = Query(None, gt=0),
+                        is_available: Optional[bool] = None,
+                        is_flat: Optional[bool] = None,
+                        available_between: Optional[str] = None):
+    return schemas.PropertyFilter(city=city, min_price=min_price, max_price=max_price,
+                                  min_surface=min_surface, rooms=rooms,
+                                  is_available=is_available, is_flat=is_flat,
+                                  available_between=parse_period(available_between, "available_between"))
+
+
+# The ETag of a user or a property is its version
+def make_etag(version: int):
+    return '"%d"' % version
+
+
+def _etag_versions(header: str, weak: bool):
+    versions = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if len(tag) > 2 and tag[0] == tag[-1] == '"' and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
+
+
+# If-None-Match uses the weak comparison, "*" matches any existing resource
+def etag_matches(if_none_match: Optional[str], version: int):
+    if if_none_match is None:
+        return False
+    return if_none_match.strip() == "*" or version in _etag_versions(if_none_match, weak=True)
+
+
+# Versions accepted by an If-Match header, None if any version is (no header or "*").
+# If-Match uses the strong comparison so weak ETags never match.
+def if_match_versions(if_match: Optional[str]):
+    if if_match is None or if_match.strip() == "*":
+        return None
+    return _etag_versions(if_match, weak=False)
+
+
+def not_modified(version: int):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": make_etag(version)})
+
+
+def precondition_failed():
+    return HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED,
+                         detail="The resource was modified, its ETag doesn't match If-Match")
+
+
+def _json_response(body: bytes, version: int, cache_status: str):
+    return Response(content=body, media_type="application/json",
+                    headers={"ETag": make_etag(version), "X-Cache": cache_status})
+
+
+# Serve a JSON response from the response cache, or a 304 when If-None-Match matches
+# its version. On a miss, get_version() looks up the version alone to answer a
+# conditional request which matches without reading and serializing the whole
+# resource, then load() reads the database and returns the response model with
+# the tags of the entry and its version. get_version and load are coroutine
+# functions. The entry is stored serialized. The X-Cache header tells whether
+# the response came from the cache.
+async def cached_json_response(key, load, get_version, if_none_match: Optional[str] = None):
+    cached = response_cache.get(key)
+    if cached is not None:
+        body, version = cached
+        if etag_matches(if_none_match, version):
+            return not_modified(version)
+        return _json_response(body, version, "HIT")
+    if if_none_match is not None:
+        version = await get_version()
+        if etag_matches(if_none_match, version):
+            return not_modified(version)
+    generation = response_cache.generation
+    model, tags, version = await load()
+    body = JSONResponse(content=jsonable_encoder(model)).body
+    response_cache.set(key, (body, version), tags=tags, generation=generation)
+    return _json_response(body, version, "MISS")
@@ -0,0 +1,248 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .database import async_query_listeners
+
+# Set METRICS=0 to disable the instrumentation of the requests and of the SQL queries
+METRICS_ENABLED = os.environ.get("METRICS", "1") == "1"
+
+# Media type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+# Minimal Prometheus metrics: a metric holds one value per combination of its label
+# values. The updates take a lock, which costs far less than a request.
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _label_text(self, values: tuple, extra: str = "") -> str:
+        pairs = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                 for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{%s}" % ",".join(pairs) if pairs else ""
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return ["%s%s %s" % (self.name, self._label_text(labels), _number(value))
+                    for labels, value in sorted(self._values.items())]
+
+    def render(self) -> str:
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.type)]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+
+# Gauge whose values are read by a function when the metrics are rendered
+class CallbackGauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...], collect: Callable[[], Dict]):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def samples(self) -> List[str]:
+        return ["%s%s %s" % (self.name, self._label_text(labels), _number(value))
+                for labels, value in sorted(self.collect().items())]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels: tuple, value: float):
+        # count per bucket, the cumulated counts are computed when rendering
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in values:
+            cumulated = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulated += count
+                lines.append("%s_bucket%s %d" % (
+                    self.name, self._label_text(labels, 'le="%s"' % _number(bound)), cumulated))
+            lines.append("%s_sum%s %s" % (self.name, self._label_text(labels), _number(counts[-1])))
+            lines.append("%s_count%s %d" % (self.name, self._label_text(labels), cumulated))
+        return lines
+
+
+def _number(value) -> str:
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being served")
+REQUESTS = Counter("http_requests_total", "Requests served, by route and status code",
+                   ("method", "route", "status"))
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Latency of the requests, by route",
+                             ("method", "route"))
+REQUEST_QUERIES = Histogram("http_request_db_queries", "SQL queries run by a request, by route",
+                            ("method", "route"), buckets=QUERY_COUNT_BUCKETS)
+REQUEST_DB_DURATION = Histogram("http_request_db_duration_seconds", "Time spent in SQL queries by a request, by route",
+                                ("method", "route"))
+QUERIES = Counter("db_queries_total", "SQL queries, by connection pool", ("pool",))
+QUERY_DURATION = Histogram("db_query_duration_seconds", "Latency of the SQL queries, by connection pool", ("pool",))
+
+# Engines instrumented by instrument_engine, by pool name
+_engines = {}
+
+
+def _pool_status(read: Callable) -> Callable[[], Dict]:
+    return lambda: {(name,): read(engine.pool) for name, engine in _engines.items()
+                    if hasattr(engine.pool, "checkedout")}
+
+
+POOL_CHECKED_OUT = CallbackGauge("db_pool_checked_out_connections", "Connections in use, by connection pool",
+                                 ("pool",), _pool_status(lambda pool: pool.checkedout()))
+POOL_SIZE = CallbackGauge("db_pool_size", "Size of the connection pools", ("pool",),
+                          _pool_status(lambda pool: pool.size()))
+
+REGISTRY = [REQUESTS_IN_FLIGHT, REQUESTS, REQUEST_DURATION, REQUEST_QUERIES, REQUEST_DB_DURATION,
+            QUERIES, QUERY_DURATION, POOL_CHECKED_OUT, POOL_SIZE]
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# SQL queries and time of the current request, [queries, seconds]. The sync path
+# operations run in a thread pool on a copy of the context of the request, which
+# shares this list.
+_request_queries = ContextVar("request_queries", default=None)
+
+# Middleware and ASGI scope of the current request, to find its route template
+_request_scope = ContextVar("request_scope", default=None)
+
+
+# Route template of the current request, None outside of a request served through
+# the MetricsMiddleware
+def current_route() -> str:
+    request = _request_scope.get()
+    if request is None:
+        return None
+    middleware, scope = request
+    return middleware.route_template(scope)
+
+
+def instrument_engine(engine: Engine, pool: str):
+    if not METRICS_ENABLED or pool in _engines:
+        return
+    _engines[pool] = engine
+    labels = (pool,)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        _count_query(labels, time.perf_counter() - context._metrics_start)
+
+
+def _count_query(labels: tuple, elapsed: float):
+    QUERIES.inc(labels)
+    QUERY_DURATION.observe(labels, elapsed)
+    request = _request_queries.get()
+    if request is not None:
+        request[0] += 1
+        request[1] += elapsed
+
+
+async def _count_async_query(connection, query, values, elapsed: float):
+    _count_query(("async",), elapsed)
+
+
+# Count the queries of the async connections (see database.AsyncConnection) under the "async" pool
+def instrument_async_queries():
+    if METRICS_ENABLED and _count_async_query not in async_query_listeners:
+        async_query_listeners.append(_count_async_query)
+
+
+# ASGI middleware recording the latency, the status code and the SQL queries of each request
+class MetricsMiddleware:
+    def __init__(self, app, api):
+        self.app = app
+        self.api = api
+        self._templates = None
+
+    # Route template of a request, e.g. /users/{user_id}, found from the endpoint set
+    # in the scope by the router. The requests matching no route share a single label
+    # so that unknown paths don't create new series.
+    def route_template(self, scope) -> str:
+        if self._templates is None:
+            self._templates = {getattr(route, "endpoint", None): route.path
+                               for route in self.api.routes if hasattr(route, "path")}
+        return self._templates.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        queries = [0, 0.0]
+        token = _request_queries.set(queries)
+        scope_token = _request_scope.set((self, scope))
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            _request_queries.reset(token)
+            _request_scope.reset(scope_token)
+            labels = (scope["method"], self.route_template(scope))
+            REQUESTS.inc(labels + (status[0],))
+            REQUEST_DURATION.observe(labels, elapsed)
+            REQUEST_QUERIES.observe(labels, queries[0])
+            REQUEST_DB_DURATION.observe(labels, queries[1])
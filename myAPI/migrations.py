@@ -0,0 +1,457 @@
+"""
+Bring the database schema up to date with the models.
+
+    python -m myAPI.migrations
+
+The database is the one of the DATABASE_URL setting (./database.db by default)
+or --database-url. The API does it too when it starts, running it beforehand
+keeps a long rebuild out of the startup of the server.
+"""
+import argparse
+import re
+import sys
+
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn, CreateTable
+
+from . import stats
+from .database import SQLALCHEMY_DATABASE_URL, create_sqlite_engine
+from .models import Base
+
+
+# create_all only creates the missing tables, the columns added later to a model
+# are added to the existing tables. They need a server default when not nullable.
+def add_missing_columns(engine: Engine):
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute("ALTER TABLE %s ADD COLUMN %s" % (
+                    table.name, CreateColumn(column).compile(dialect=engine.dialect)))
+
+
+CONSTRAINT_NAMES = re.compile(r"CONSTRAINT (\w+) ")
+
+
+# Names of the constraints of a model which are missing from the SQL of its SQLite table
+def missing_constraints(engine: Engine, table) -> list:
+    sql = engine.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                         table.name).scalar() or ""
+    existing = set(CONSTRAINT_NAMES.findall(sql))
+    model = str(CreateTable(table).compile(dialect=engine.dialect))
+    return [name for name in CONSTRAINT_NAMES.findall(model) if name not in existing]
+
+
+# SQLite can't add a constraint to an existing table, the tables created without
+# some constraints of their model are rebuilt: a new table is created from the
+# model, filled with the rows and renamed, in a single transaction (see "Making
+# Other Kinds Of Table Schema Changes" in the SQLite documentation). The indexes
+# and the triggers of the table are dropped with it and created again by upgrade.
+# If the rows break a constraint, the rebuild is rolled back and the error raised.
+def rebuild_tables_with_missing_constraints(engine: Engine):
+    if engine.dialect.name != "sqlite":
+        return
+    for table in Base.metadata.sorted_tables:
+        if not missing_constraints(engine, table):
+            continue
+        columns = ", ".join(column.name for column in table.columns)
+        create = str(CreateTable(table).compile(dialect=engine.dialect)).strip()
+        create = create.replace("CREATE TABLE %s " % table.name, "CREATE TABLE %s_rebuild " % table.name, 1)
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            # the foreign keys can't be switched off in a transaction
+            foreign_keys = cursor.execute("PRAGMA foreign_keys").fetchone()[0]
+            cursor.execute("PRAGMA foreign_keys = OFF")
+            try:
+                cursor.execute("BEGIN")
+                cursor.execute(create)
+                cursor.execute("INSERT INTO %s_rebuild (%s) SELECT %s FROM %s" % (
+                    table.name, columns, columns, table.name))
+                cursor.execute("DROP TABLE %s" % table.name)
+                cursor.execute("ALTER TABLE %s_rebuild RENAME TO %s" % (table.name, table.name))
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                cursor.execute("PRAGMA foreign_keys = %d" % foreign_keys)
+        finally:
+            connection.close()
+
+
+# The version columns are bumped by triggers so that every write path (ORM, bulk
+# statements, async path) keeps them up to date. A change of a property also
+# changes the representation of its former and new owner (GET /users/{user_id}
+# embeds the properties), so it bumps their version too.
+SQLITE_TRIGGERS = {
+    "users_version_on_update": """
+        CREATE TRIGGER users_version_on_update AFTER UPDATE ON users
+        WHEN NEW.version = OLD.version
+        BEGIN
+            UPDATE users SET version = OLD.version + 1 WHERE id = NEW.id;
+        END""",
+    "properties_version_on_update": """
+        CREATE TRIGGER properties_version_on_update AFTER UPDATE ON properties
+        WHEN NEW.version = OLD.version
+        BEGIN
+            UPDATE properties SET version = OLD.version + 1 WHERE id = NEW.id;
+            UPDATE users SET version = version + 1 WHERE id IN (OLD.owner_id, NEW.owner_id);
+        END""",
+    "properties_version_on_insert": """
+        CREATE TRIGGER properties_version_on_insert AFTER INSERT ON properties
+        WHEN NEW.owner_id IS NOT NULL
+        BEGIN
+            UPDATE users SET version = version + 1 WHERE id = NEW.owner_id;
+        END""",
+    "properties_version_on_delete": """
+        CREATE TRIGGER properties_version_on_delete AFTER DELETE ON properties
+        WHEN OLD.owner_id IS NOT NULL
+        BEGIN
+            UPDATE users SET version = version + 1 WHERE id = OLD.owner_id;
+        END""",
+}
+
+
+# Change of the statistics of the city of a property (row is NEW or OLD) when it is
+# added (sign is +) or removed (sign is -), see stats.city_stats_query
+def _city_stats_change(row: str, sign: str) -> str:
+    has_rent_per_m2 = "{row}.rental_price IS NOT NULL AND IFNULL({row}.surface, 0) > 0".format(row=row)
+    return """
+            UPDATE city_stats SET
+                property_count = property_count {sign} 1,
+                available_count = available_count {sign} {row}.is_available,
+                rented_count = rented_count {sign} {row}.is_rented,
+                sold_count = sold_count {sign} {row}.is_sold,
+                selling_price_count = selling_price_count {sign} ({row}.selling_price IS NOT NULL),
+                selling_price_sum = selling_price_sum {sign} IFNULL({row}.selling_price, 0),
+                rent_per_m2_count = rent_per_m2_count {sign} ({has_rent_per_m2}),
+                rent_per_m2_sum = rent_per_m2_sum {sign}
+                    CASE WHEN {has_rent_per_m2} THEN {row}.rental_price * 1.0 / {row}.surface ELSE 0 END,
+                version = version + 1
+            WHERE city = {row}.city;""".format(row=row, sign=sign, has_rent_per_m2=has_rent_per_m2)
+
+
+_ADD_NEW = "\n            INSERT OR IGNORE INTO city_stats (city) VALUES (NEW.city);" + _city_stats_change("NEW", "+")
+_REMOVE_OLD = _city_stats_change("OLD", "-") + \
+    "\n            DELETE FROM city_stats WHERE city = OLD.city AND property_count = 0;"
+
+# Columns of the properties counted in the statistics of the cities
+_CITY_STATS_COLUMNS = ("city", "is_available", "is_rented", "is_sold", "selling_price", "rental_price", "surface")
+
+# The statistics of the cities are updated in the transaction of the writes of the
+# properties, whatever the write path. A city without properties is removed.
+CITY_STATS_TRIGGERS = {
+    "properties_city_stats_on_insert": """
+        CREATE TRIGGER properties_city_stats_on_insert AFTER INSERT ON properties
+        BEGIN%s
+        END""" % _ADD_NEW,
+    "properties_city_stats_on_update": """
+        CREATE TRIGGER properties_city_stats_on_update AFTER UPDATE ON properties
+        WHEN %s
+        BEGIN%s%s
+        END""" % (" OR ".join("OLD.%s IS NOT NEW.%s" % (column, column) for column in _CITY_STATS_COLUMNS),
+                  _REMOVE_OLD, _ADD_NEW),
+    "properties_city_stats_on_delete": """
+        CREATE TRIGGER properties_city_stats_on_delete AFTER DELETE ON properties
+        BEGIN%s
+        END""" % _REMOVE_OLD,
+}
+SQLITE_TRIGGERS.update(CITY_STATS_TRIGGERS)
+
+
+# Change of the counters of the owner of a property (row is NEW or OLD) when it is
+# added (sign is +) or removed (sign is -), see stats.owner_counters_query. The
+# version is bumped by the same statement.
+def _owner_counters_change(row: str, sign: str) -> str:
+    return """
+            UPDATE users SET
+                property_count = property_count {sign} 1,
+                rented_count = rented_count {sign} {row}.is_rented,
+                total_rental_income = total_rental_income {sign}
+                    CASE WHEN {row}.is_rented THEN IFNULL({row}.rental_price, 0) ELSE 0 END,
+                version = version + 1
+            WHERE id = {row}.owner_id;""".format(row=row, sign=sign)
+
+
+# The counters of the owners are updated in the transaction of the writes of the properties
+OWNER_COUNTERS_TRIGGERS = {
+    "properties_owner_counters_on_insert": """
+        CREATE TRIGGER properties_owner_counters_on_insert AFTER INSERT ON properties
+        WHEN NEW.owner_id IS NOT NULL
+        BEGIN%s
+        END""" % _owner_counters_change("NEW", "+"),
+    "properties_owner_counters_on_update": """
+        CREATE TRIGGER properties_owner_counters_on_update AFTER UPDATE ON properties
+        WHEN OLD.owner_id IS NOT NEW.owner_id OR OLD.is_rented IS NOT NEW.is_rented
+            OR OLD.rental_price IS NOT NEW.rental_price
+        BEGIN%s%s
+        END""" % (_owner_counters_change("OLD", "-"), _owner_counters_change("NEW", "+")),
+    "properties_owner_counters_on_delete": """
+        CREATE TRIGGER properties_owner_counters_on_delete AFTER DELETE ON properties
+        WHEN OLD.owner_id IS NOT NULL
+        BEGIN%s
+        END""" % _owner_counters_change("OLD", "-"),
+}
+SQLITE_TRIGGERS.update(OWNER_COUNTERS_TRIGGERS)
+
+# Full text indexes of GET /search, FTS5 tables whose content is read from the
+# tables they index. The tokens are matched without accents. The prefixes of up to
+# 6 characters are indexed, which doubles the size of the index: without them a
+# prefix query merges the lists of rows of all the words starting with the prefix,
+# 10 ms for a common word at a million rows.
+SQLITE_FTS_TABLES = {
+    "properties_fts": """
+        CREATE VIRTUAL TABLE properties_fts USING fts5(
+            adress, city, content='properties', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='1 2 3 4 5 6')""",
+    "users_fts": """
+        CREATE VIRTUAL TABLE users_fts USING fts5(
+            full_name, email, content='users', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='1 2 3 4 5 6')""",
+}
+
+
+# Triggers copying the indexed columns of a table to its FTS5 table
+def _fts_triggers(table: str, columns: tuple) -> dict:
+    fts = "%s_fts" % table
+    names = ", ".join(columns)
+    new = ", ".join("NEW.%s" % column for column in columns)
+    old = ", ".join("OLD.%s" % column for column in columns)
+    insert = "INSERT INTO %s (rowid, %s) VALUES (NEW.id, %s);" % (fts, names, new)
+    delete = "INSERT INTO %s (%s, rowid, %s) VALUES ('delete', OLD.id, %s);" % (fts, fts, names, old)
+    return {
+        "%s_on_insert" % fts: """
+        CREATE TRIGGER %s_on_insert AFTER INSERT ON %s
+        BEGIN
+            %s
+        END""" % (fts, table, insert),
+        "%s_on_update" % fts: """
+        CREATE TRIGGER %s_on_update AFTER UPDATE ON %s
+        WHEN %s
+        BEGIN
+            %s
+            %s
+        END""" % (fts, table, " OR ".join("OLD.%s IS NOT NEW.%s" % (column, column) for column in columns),
+                  delete, insert),
+        "%s_on_delete" % fts: """
+        CREATE TRIGGER %s_on_delete AFTER DELETE ON %s
+        BEGIN
+            %s
+        END""" % (fts, table, delete),
+    }
+
+
+SEARCH_TRIGGERS = dict(_fts_triggers("properties", ("adress", "city")),
+                       **_fts_triggers("users", ("full_name", "email")))
+SQLITE_TRIGGERS.update(SEARCH_TRIGGERS)
+
+
+# Spatial index of GET /properties/near and GET /properties/in-bbox, a R*Tree of
+# the located properties. The R*Tree stores its bounds as 32 bits floats rounded
+# outwards, it preselects the properties of a box whose exact location is then
+# compared to the box.
+SQLITE_RTREE_TABLES = {
+    "properties_rtree": """
+        CREATE VIRTUAL TABLE properties_rtree USING rtree(
+            id, min_latitude, max_latitude, min_longitude, max_longitude)""",
+    # Interval index of the booked periods for the availability searches of GET /properties/,
+    # their days are integers stored exactly by rtree_i32
+    "bookings_rtree": """
+        CREATE VIRTUAL TABLE bookings_rtree USING rtree_i32(id, min_day, max_day, +property_id)""",
+}
+
+_LOCATED = "NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL"
+_INSERT_LOCATION = """
+            INSERT INTO properties_rtree
+            SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude WHERE %s;""" % _LOCATED
+
+GEO_TRIGGERS = {
+    "properties_rtree_on_insert": """
+        CREATE TRIGGER properties_rtree_on_insert AFTER INSERT ON properties
+        WHEN %s
+        BEGIN%s
+        END""" % (_LOCATED, _INSERT_LOCATION),
+    "properties_rtree_on_update": """
+        CREATE TRIGGER properties_rtree_on_update AFTER UPDATE ON properties
+        WHEN OLD.latitude IS NOT NEW.latitude OR OLD.longitude IS NOT NEW.longitude OR OLD.id != NEW.id
+        BEGIN
+            DELETE FROM properties_rtree WHERE id = OLD.id;%s
+        END""" % _INSERT_LOCATION,
+    "properties_rtree_on_delete": """
+        CREATE TRIGGER properties_rtree_on_delete AFTER DELETE ON properties
+        WHEN OLD.latitude IS NOT NULL AND OLD.longitude IS NOT NULL
+        BEGIN
+            DELETE FROM properties_rtree WHERE id = OLD.id;
+        END""",
+}
+SQLITE_TRIGGERS.update(GEO_TRIGGERS)
+
+# Message of the error raised by the write of a booking which overlaps another
+# booking of the property
+BOOKING_OVERLAP = "The booking overlaps another booking of the property"
+
+
+# Abort the write of a booking which overlaps another booking of its property. The
+# bookings of a property don't overlap, so the last one starting before the end of
+# the new booking is the one which ends last: a single seek of the
+# ix_bookings_property_start index tells whether there is an overlap.
+def _booking_overlap_check(other: str) -> str:
+    return """
+            SELECT RAISE(ABORT, '%s')
+            WHERE (SELECT end_date FROM bookings
+                   WHERE property_id = NEW.property_id AND start_date <= NEW.end_date%s
+                   ORDER BY start_date DESC LIMIT 1) >= NEW.start_date;""" % (BOOKING_OVERLAP, other)
+
+
+# Day numbers of the booked periods, as days since 1970-01-01
+def _epoch_day(value: str) -> str:
+    return "CAST(julianday(%s) - 2440587.5 AS INTEGER)" % value
+
+
+_INSERT_BOOKED_DAYS = """
+            INSERT INTO bookings_rtree VALUES (NEW.id, %s, %s, NEW.property_id);""" % (
+    _epoch_day("NEW.start_date"), _epoch_day("NEW.end_date"))
+
+BOOKING_CHECK_TRIGGERS = {
+    "bookings_overlap_on_insert": """
+        CREATE TRIGGER bookings_overlap_on_insert BEFORE INSERT ON bookings
+        BEGIN%s
+        END""" % _booking_overlap_check(""),
+    "bookings_overlap_on_update": """
+        CREATE TRIGGER bookings_overlap_on_update BEFORE UPDATE OF property_id, start_date, end_date ON bookings
+        BEGIN%s
+        END""" % _booking_overlap_check(" AND id != OLD.id"),
+}
+SQLITE_TRIGGERS.update(BOOKING_CHECK_TRIGGERS)
+
+BOOKING_INDEX_TRIGGERS = {
+    "bookings_rtree_on_insert": """
+        CREATE TRIGGER bookings_rtree_on_insert AFTER INSERT ON bookings
+        BEGIN%s
+        END""" % _INSERT_BOOKED_DAYS,
+    "bookings_rtree_on_update": """
+        CREATE TRIGGER bookings_rtree_on_update AFTER UPDATE ON bookings
+        BEGIN
+            DELETE FROM bookings_rtree WHERE id = OLD.id;%s
+        END""" % _INSERT_BOOKED_DAYS,
+    "bookings_rtree_on_delete": """
+        CREATE TRIGGER bookings_rtree_on_delete AFTER DELETE ON bookings
+        BEGIN
+            DELETE FROM bookings_rtree WHERE id = OLD.id;
+        END""",
+}
+SQLITE_TRIGGERS.update(BOOKING_INDEX_TRIGGERS)
+
+
+# Create the FTS5 and R*Tree tables which don't exist yet
+def create_missing_virtual_tables(engine: Engine):
+    if engine.dialect.name != "sqlite":
+        return
+    existing = {row[0] for row in engine.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for name, ddl in dict(SQLITE_FTS_TABLES, **SQLITE_RTREE_TABLES).items():
+        if name not in existing:
+            engine.execute(ddl)
+
+
+# Index again all the rows of the FTS5 tables
+def rebuild_search_index(engine: Engine):
+    for name in SQLITE_FTS_TABLES:
+        engine.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (name, name))
+
+
+# Index again the locations of all the properties, in a single transaction
+def rebuild_geo_index(engine: Engine):
+    with engine.begin() as connection:
+        connection.execute("DELETE FROM properties_rtree")
+        connection.execute("""
+            INSERT INTO properties_rtree
+            SELECT id, latitude, latitude, longitude, longitude FROM properties
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL""")
+
+
+# Index again the booked periods, in a single transaction
+def rebuild_booking_index(engine: Engine):
+    with engine.begin() as connection:
+        connection.execute("DELETE FROM bookings_rtree")
+        connection.execute("INSERT INTO bookings_rtree SELECT id, %s, %s, property_id FROM bookings" % (
+            _epoch_day("start_date"), _epoch_day("end_date")))
+
+
+# Return the names of the created triggers
+def create_missing_triggers(engine: Engine) -> list:
+    if engine.dialect.name != "sqlite":
+        return []
+    existing = {row[0] for row in engine.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    created = []
+    for name, ddl in SQLITE_TRIGGERS.items():
+        if name not in existing:
+            engine.execute(ddl)
+            created.append(name)
+    return created
+
+
+# create_all only creates the missing tables, the indexes added later to an
+# existing table have to be created separately on databases created before them.
+def create_missing_indexes(engine: Engine):
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+
+
+# Indexes removed from the models, dropped from the databases created before
+DROPPED_INDEXES = ["ix_properties_city_price"]
+
+
+def drop_obsolete_indexes(engine: Engine):
+    for name in DROPPED_INDEXES:
+        engine.execute('DROP INDEX IF EXISTS "%s"' % name)
+
+
+# Derived data with the triggers which maintain it and the function which rebuilds it
+DERIVED_DATA = [
+    (CITY_STATS_TRIGGERS, stats.rebuild_city_stats),
+    (OWNER_COUNTERS_TRIGGERS, stats.rebuild_owner_counters),
+    (SEARCH_TRIGGERS, rebuild_search_index),
+    (GEO_TRIGGERS, rebuild_geo_index),
+    (BOOKING_INDEX_TRIGGERS, rebuild_booking_index),
+]
+
+
+# Bring the database schema up to date with the models
+def upgrade(engine: Engine):
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+    rebuild_tables_with_missing_constraints(engine)
+    create_missing_indexes(engine)
+    drop_obsolete_indexes(engine)
+    create_missing_virtual_tables(engine)
+    created = set(create_missing_triggers(engine))
+    # the rows written while the triggers of the derived data didn't exist aren't counted
+    for triggers, rebuild in DERIVED_DATA:
+        if created & set(triggers):
+            rebuild(engine)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database-url", default=SQLALCHEMY_DATABASE_URL)
+    args = parser.parse_args(argv)
+    if not args.database_url.startswith("sqlite"):
+        parser.error("only SQLite databases are supported")
+
+    engine = create_sqlite_engine(args.database_url)
+    upgrade(engine)
+    engine.dispose()
+    print("upgraded %s" % args.database_url)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
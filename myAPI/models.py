@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Enum, Numeric, Boolean, Date, UniqueConstraint, CheckConstraint
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Enum, Numeric, Boolean, Date, UniqueConstraint, CheckConstraint, Index, Float
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -16,6 +16,13 @@ class User(Base):
     phone = Column(String(50), unique=True)
     salary = Column(Integer)
     job = Column(String(50))
+    # Bumped by every write of the user or of one of its properties (see migrations.py), used as ETag
+    version = Column(Integer, nullable=False, server_default="1")
+    # Portfolio of the user as an owner: number of properties, number of rented
+    # properties and sum of their rents, updated by triggers (see migrations.py)
+    property_count = Column(Integer, nullable=False, server_default="0")
+    rented_count = Column(Integer, nullable=False, server_default="0")
+    total_rental_income = Column(Integer, nullable=False, server_default="0")
 
     properties = relationship("Property", back_populates="owner")
 
@@ -41,15 +48,80 @@ class Property(Base):
     availability_date = Column(Date)
     is_available = Column(Boolean, nullable=False)
     owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    # Location in degrees (WGS 84), indexed in the properties_rtree table (see migrations.py)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    # Bumped by every write of the property (see migrations.py), used as ETag
+    version = Column(Integer, nullable=False, server_default="1")
 
-    # Two properties can't be located at the same place
-    __table_args__ = (UniqueConstraint(
-        'adress', 'city', name='_adress_city_uc'),)
-    # A property can't be a house and a flat at the same time
-    __table_args__ = (CheckConstraint(
-        'is_home != is_flat', name='_is_home_is_flat_cc'),)
-    # A property can't be sold and rented at the same time
-    __table_args__ = (CheckConstraint(
-        'is_sold + is_rented <= 1', name='_is_sold_is_rented_cc'),)
+    __table_args__ = (
+        # Two properties can't be located at the same place. The unique index also
+        # serves the lookups by city and adress, and the searches by city.
+        UniqueConstraint('city', 'adress', name='_adress_city_uc'),
+        # A property can't be a house and a flat at the same time
+        CheckConstraint('is_home != is_flat', name='_is_home_is_flat_cc'),
+        # A property can't be sold and rented at the same time
+        CheckConstraint('is_sold + is_rented <= 1', name='_is_sold_is_rented_cc'),
+        # A property is located by both coordinates or not at all
+        CheckConstraint('(latitude IS NULL) = (longitude IS NULL)', name='_latitude_longitude_cc'),
+    )
 
     owner = relationship("User", back_populates="properties")
+
+
+# Composite indexes matching the filters of the property search (GET /properties/).
+# The equality filters come first and the range/sort column last, so a search
+# is an index seek followed by an ordered range scan.
+# The first one also covers the selling prices of a city for the medians of GET /stats/cities.
+Index('ix_properties_city_available_price',
+      Property.city, Property.is_available, Property.selling_price)
+Index('ix_properties_available_price',
+      Property.is_available, Property.selling_price)
+Index('ix_properties_selling_price', Property.selling_price)
+Index('ix_properties_flat_rooms', Property.is_flat, Property.rooms)
+# The rooms and the minimal surface filter the search alone too
+Index('ix_properties_rooms', Property.rooms)
+Index('ix_properties_surface', Property.surface)
+
+
+# SQL Alchemy model of the bookings of the properties: a property is booked from
+# start_date to end_date, both included. The bookings of a property don't overlap,
+# this is checked by triggers and they are indexed by a R*Tree of their periods
+# for the availability searches (see migrations.py).
+class Booking(Base):
+    __tablename__ = "bookings"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    property_id = Column(Integer, ForeignKey("properties.id", ondelete="CASCADE"), nullable=False)
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False)
+
+    __table_args__ = (
+        CheckConstraint('start_date <= end_date', name='_start_date_end_date_cc'),
+    )
+
+
+# Bookings of a property in order, the overlap check reads the last booking of
+# the property starting before the end of the new one
+Index('ix_bookings_property_start', Booking.property_id, Booking.start_date)
+
+
+# SQL Alchemy model of the statistics of the properties of each city. The rows are
+# updated by triggers in the transaction of every write of the properties (see
+# migrations.py) and can be rebuilt from the properties with python -m myAPI.stats.
+class CityStats(Base):
+    __tablename__ = "city_stats"
+
+    city = Column(String(50), primary_key=True)
+    property_count = Column(Integer, nullable=False, server_default="0")
+    available_count = Column(Integer, nullable=False, server_default="0")
+    rented_count = Column(Integer, nullable=False, server_default="0")
+    sold_count = Column(Integer, nullable=False, server_default="0")
+    # properties with a selling price and sum of their prices
+    selling_price_count = Column(Integer, nullable=False, server_default="0")
+    selling_price_sum = Column(Integer, nullable=False, server_default="0")
+    # properties with a rental price and a surface and sum of their rents per m2
+    rent_per_m2_count = Column(Integer, nullable=False, server_default="0")
+    rent_per_m2_sum = Column(Float, nullable=False, server_default="0")
+    # Bumped by every change of the row, the cached medians of an older version are stale
+    version = Column(Integer, nullable=False, server_default="1")
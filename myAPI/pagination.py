@@ -0,0 +1,50 @@
+import base64
+import json
+from typing import Any, List
+
+
+# Keyset pagination cursors. A cursor holds the sort key values of the last row
+# of a page, the next page then starts with a "WHERE key > cursor" condition
+# which is resolved with an index seek instead of scanning and discarding rows
+# like OFFSET does. The cursor is base64 encoded so clients treat it as opaque.
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(*values: Any) -> str:
+    """
+    Encode the sort key values of the last row of a page into an opaque cursor.
+    """
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str, size: int = 1) -> List[Any]:
+    """
+    Decode a cursor built by encode_cursor, raise a ValueError if it is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def decode_int_cursor(cursor: str, size: int = 1) -> List[int]:
+    """
+    Decode a cursor whose sort key is made of integer columns.
+    """
+    values = decode_cursor(cursor, size)
+    for value in values:
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError("Invalid cursor")
+    return values
+
+
+def decode_id_cursor(cursor: str) -> int:
+    """
+    Decode a cursor keyed on an integer primary key.
+    """
+    return decode_int_cursor(cursor)[0]
@@ -0,0 +1,808 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from . import crud, export, metrics, schemas, serialization, slow_queries, stats
+from .cache import fields_key, property_key, response_cache, user_key, user_summary_key
+from .crud import INTEGRITY_ERRORS
+from .helpers import (PROPERTY_FIELDS, USER_FIELDS, USER_INCLUDES, apply_bulk_outcomes, cached_json_response,
+                      etag_matches, get_property_filter, if_match_versions, make_etag, not_modified, paginate,
+                      parse_bulk_body, parse_cursor, parse_fields, parse_include, parse_search_cursor,
+                      precondition_failed, raise_integrity_error, validate_bulk_users)
+
+
+# Path operations of the API, shared by the sync app (main.py) and the async one (async_main.py).
+# They don't know the database: they await the functions of a store, which have the names and
+# the arguments of crud.py without the db. The sync app runs crud.py in the threadpool, the
+# async app awaits async_crud.py. A store also has stream_export(format, table) giving the
+# chunks of GET /export.
+
+router = APIRouter()
+
+
+# Store of the write path operations, bound by the app including the router
+def get_store():
+    raise NotImplementedError
+
+
+# Store of the read only path operations, bound by the app including the router
+def get_read_store():
+    raise NotImplementedError
+
+
+def include_routes(app, store_dependency, read_store_dependency):
+    """
+    Serve the path operations on app, with the stores given by its dependencies.
+    """
+    app.dependency_overrides[get_store] = store_dependency
+    app.dependency_overrides[get_read_store] = read_store_dependency
+    app.include_router(router)
+
+
+# -------------------------------------------- User operations --------------------------------------------
+
+
+# Path operation to create a user, the operation take in input a UserCreate schema
+# and return a User schema. The store dependency gives a single session or connection
+# per request, open before the request and close when it's finished.
+@router.post("/users/",
+             response_model=schemas.User,
+             status_code=status.HTTP_201_CREATED,
+             response_description="The created user")
+async def create_user(user: schemas.UserCreate, store=Depends(get_store)):
+    """
+    Create an user with all the information:
+
+    - **full_name**: name and firstname, UNIQUE and REQUIRED
+    - **age**: between 18 and 120
+    - **gender**: male or female
+    - **phone**: phone number, UNIQUE
+    - **job**: current profession
+    - **email**: mail adress, UNIQUE and REQUIRED
+    - **salary**: monthly salary in euros
+    """
+    try:
+        return await store.create_user(user=user)
+    except INTEGRITY_ERRORS as exc:
+        raise_integrity_error(exc)
+
+
+@router.post("/users/bulk",
+             response_model=schemas.BulkUserReport,
+             status_code=status.HTTP_200_OK,
+             response_description="The result of each user")
+async def create_users_bulk(request: Request, store=Depends(get_store)):
+    """
+    Create many users at once. The body is either a JSON array of users or, with the
+    **application/x-ndjson** content type, one JSON user per line. Each user has the
+    same fields as in the creation of a single user.
+
+    The valid users are created in a single transaction, the report gives for each
+    user, by its position in the body, either its id or the reason why it was rejected.
+    """
+    items = parse_bulk_body(await request.body(), request.headers.get("content-type", ""))
+    results, valid_users = validate_bulk_users(items)
+    outcomes = await store.create_users_bulk([user for _, user in valid_users])
+    created = apply_bulk_outcomes(valid_users, outcomes)
+    return JSONResponse(content={"created": created, "results": results})
+
+
+@router.post("/users/bulk-delete",
+             response_model=schemas.BulkDeleteReport,
+             status_code=status.HTTP_200_OK,
+             response_description="Counts of the deleted users and of their properties")
+async def remove_users_bulk(users: schemas.UserBulkDelete, store=Depends(get_store)):
+    """
+    Delete the users of **ids** in a single transaction. **properties** tells what becomes of
+    their properties: "detach" (the default) keeps them without owner, as **DELETE /users/{user_id}**
+    does, "delete" deletes them too.
+
+    The response counts the deleted users (the unknown ids are ignored) and the detached or
+    deleted properties.
+    """
+    return await store.delete_users_bulk(ids=users.ids, properties=users.properties)
+
+
+@router.get("/users/",
+            response_model=List[schemas.User],
+            status_code=status.HTTP_200_OK,
+            response_description="All users")
+async def read_users(response: Response, skip: int = 0, limit: int = Query(100, gt=0), cursor: Optional[str] = None,
+                     include: str = "properties", fields: Optional[str] = None, store=Depends(get_read_store)):
+    """
+    Get all users, ordered by id.
+
+    - **skip** / **limit**: offset pagination, kept for compatibility
+    - **cursor**: opaque cursor returned in the **X-Next-Cursor** header of the previous page,
+    when given **skip** is ignored and every page costs the same whatever its depth
+    - **include**: "properties" (the default) embeds the properties of the users, when empty
+    the users only have the summary of their properties (**property_count**, **rented_count**
+    and **total_rental_income**) and the properties aren't read
+    - **fields**: comma separated fields of the users, e.g. "id,full_name,email", only these
+    columns are read. The id is always returned.
+    """
+    after_id = parse_cursor(cursor)
+    with_properties = "properties" in parse_include(include, USER_INCLUDES)
+    user_fields = parse_fields(fields, USER_FIELDS)
+    if serialization.FAST_SERIALIZATION or user_fields is not None:
+        user_rows = paginate(await store.get_users_rows(skip=skip, limit=limit + 1, after_id=after_id,
+                                                        columns=user_fields), limit, response)
+        property_rows = (await store.get_properties_by_owners_rows(owner_ids=[row.id for row in user_rows])
+                         if with_properties else None)
+        content = serialization.users_content(user_rows, property_rows, fields=user_fields)
+        return serialization.fast_json_response(content, response)
+    users = await store.get_users(skip=skip, limit=limit + 1,
+                                  after_id=after_id, load_properties="selectin" if with_properties else None)
+    users = paginate(users, limit, response)
+    if with_properties:
+        return users
+    # the response model would load the properties of each user
+    return serialization.json_response(
+        jsonable_encoder([schemas.UserSummary.from_orm(user) for user in users]), response)
+
+
+@router.get("/users/{user_id}",
+            response_model=schemas.User,
+            status_code=status.HTTP_200_OK,
+            response_description="Selected user")
+async def read_user(user_id: int, include: str = "properties", fields: Optional[str] = None,
+                    if_none_match: Optional[str] = Header(None), store=Depends(get_read_store)):
+    """
+    Get a user with the user id.
+
+    **include** is "properties" (the default) to embed the properties of the user, when empty
+    the user only has the summary of its properties and they aren't read. **fields** are the
+    comma separated fields of the user to return, e.g. "id,full_name,email", only these
+    columns are read. The id is always returned.
+
+    The **ETag** header is the version of the user, it changes with every change of the
+    user or of its properties. When **If-None-Match** matches it the response is a 304
+    without body.
+    """
+    with_properties = "properties" in parse_include(include, USER_INCLUDES)
+    user_fields = parse_fields(fields, USER_FIELDS)
+
+    async def get_version():
+        version = await store.get_user_version(user_id=user_id)
+        if version is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        return version
+
+    async def load_fields():
+        row = await store.get_user_row(user_id=user_id, columns=user_fields + ["version"])
+        if row is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        property_rows = await store.get_properties_by_owner_rows(owner_id=user_id) if with_properties else None
+        content = serialization.users_content([row], property_rows, fields=user_fields)[0]
+        # without the properties and their counters, only the changes of the user matter
+        if with_properties:
+            property_ids = [property_row.id for property_row in property_rows]
+        elif set(user_fields) & set(stats.OWNER_COUNTERS):
+            property_ids = await store.get_property_ids_by_owner(owner_id=user_id)
+        else:
+            property_ids = []
+        return content, [user_key(user_id)] + [property_key(property_id) for property_id in property_ids], row.version
+
+    async def load():
+        if user_fields is not None:
+            return await load_fields()
+        db_user = await store.get_user(user_id=user_id, load_properties="joined" if with_properties else None)
+        if db_user is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        # the response embeds the properties of the user or their summary, a change of one
+        # of them invalidates it. The writes only invalidate the new owner of a property,
+        # the former one is invalidated by the property tag.
+        if with_properties:
+            tags = [user_key(user_id)] + [property_key(p.id) for p in db_user.properties]
+            return schemas.User.from_orm(db_user), tags, db_user.version
+        tags = [user_key(user_id)] + [property_key(property_id)
+                                      for property_id in await store.get_property_ids_by_owner(owner_id=user_id)]
+        return schemas.UserSummary.from_orm(db_user), tags, db_user.version
+
+    key = user_key(user_id) if with_properties else user_summary_key(user_id)
+    if user_fields is not None:
+        key = fields_key(key, user_fields)
+    return await cached_json_response(key, load, get_version, if_none_match)
+
+
+@router.put("/users/{user_id}",
+            response_model=schemas.User,
+            status_code=status.HTTP_200_OK,
+            response_description="Updated user")
+async def change_user(response: Response, user_id: int, user: schemas.UserUpdate,
+                      if_match: Optional[str] = Header(None), store=Depends(get_store)):
+    """
+    Update user data with the following fields:
+
+    - **full_name**: name and firstname, UNIQUE and REQUIRED
+    - **age**: between 18 and 120
+    - **gender**: male or female
+    - **phone**: phone number, UNIQUE
+    - **job**: current profession
+    - **email**: mail adress, UNIQUE and REQUIRED
+    - **salary**: monthly salary in euros
+
+    With **If-Match**, the user is only updated if its ETag matches, otherwise the response is a 412.
+    """
+    try:
+        db_user = await store.update_user(user=user, user_id=user_id,
+                                          expected_versions=if_match_versions(if_match))
+    except INTEGRITY_ERRORS as exc:
+        raise_integrity_error(exc)
+    except crud.StaleVersionError:
+        raise precondition_failed()
+    if db_user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    response.headers["ETag"] = make_etag(db_user.version)
+    return db_user
+
+
+@router.patch("/users/{user_id}",
+              response_model=schemas.UserSummary,
+              status_code=status.HTTP_200_OK,
+              response_description="Updated user")
+async def patch_user(response: Response, user_id: int, user: schemas.UserPatch,
+                     if_match: Optional[str] = Header(None), store=Depends(get_store)):
+    """
+    Update only the given fields of a user, the other ones are kept. The fields are the ones of
+    **PUT /users/{user_id}**, **full_name** and **email** can be omitted but not null.
+
+    The response is the updated user with the summary of its properties, written and read
+    back with a single UPDATE. With **If-Match**, the user is only updated if its ETag matches,
+    otherwise the response is a 412.
+    """
+    try:
+        row = await store.patch_user(user=user, user_id=user_id, expected_versions=if_match_versions(if_match))
+    except INTEGRITY_ERRORS as exc:
+        raise_integrity_error(exc)
+    except crud.StaleVersionError:
+        raise precondition_failed()
+    if row is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    response.headers["ETag"] = make_etag(row.version)
+    return row
+
+
+@router.delete("/users/{user_id}",
+               response_model=schemas.User,
+               status_code=status.HTTP_200_OK,
+               response_description="Deleted user")
+async def remove_user(user_id: int, if_match: Optional[str] = Header(None), store=Depends(get_store)):
+    """
+    Delete a user with the user id.
+
+    With **If-Match**, the user is only deleted if its ETag matches, otherwise the response is a 412.
+    """
+    try:
+        db_user = await store.delete_user(user_id=user_id,
+                                          expected_versions=if_match_versions(if_match))
+    except crud.StaleVersionError:
+        raise precondition_failed()
+    if db_user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return db_user
+
+
+# -------------------------------------------- Property operations --------------------------------------------
+
+
+@router.post("/properties/",
+             response_model=schemas.Property,
+             status_code=status.HTTP_201_CREATED,
+             response_description="Created property")
+async def create_property(property: schemas.PropertyCreate, store=Depends(get_store)):
+    """
+    Create a property with all the information:
+
+    - **adress**: home adress, REQUIRED
+    - **city**: city, REQUIRED
+    - **is_sold**: boolean, can't be true if "is_rented" is true
+    - **is_rented**: boolean, can't be true if "is_sold" is true
+    - **is_available**: boolean, can't be true if "is_rented" and "is_sold" are true
+    - **surface**: numeric value, must be greater than 0
+    - **rooms**: number of rooms, must be greater than 0
+    - **is_home**: boolean, can't be equal to "is_flat"
+    - **is_flat**: boolean, can't be equal to "is_home"
+    - **age**: age of the house, must be greater than 0
+    - **selling_price**: selling price, must be greater than 0
+    - **sale_date**: datetime
+    - **rental_price**: rental price, must be greater than 0
+    - **rental_start_date**: datetime
+    - **availability_date**: datetime
+    - **owner_id** : user id, this id must match one in the user table
+    - **latitude** / **longitude**: location in degrees, set together
+    """
+    # the unique constraint on (city, adress) rejects the duplicates
+    try:
+        return await store.create_property(property=property)
+    except INTEGRITY_ERRORS as exc:
+        raise_integrity_error(exc)
+
+
+@router.post("/properties/bulk-delete",
+             response_model=schemas.BulkDeleteReport,
+             status_code=status.HTTP_200_OK,
+             response_description="Count of the deleted properties")
+async def remove_properties_bulk(properties: schemas.PropertyBulkDelete, store=Depends(get_store)):
+    """
+    Delete properties in a single transaction, the ones of **ids**, the ones matching **filters**,
+    or the ones of **ids** matching **filters**. The filters are the ones of **GET /properties/**
+    and:
+
+    - **owner_id**: id of the owner
+    - **is_sold** / **is_rented**: boolean
+
+    e.g. {"filters": {"city": "Paris", "is_sold": true}} deletes the sold properties of Paris.
+    The response counts the deleted properties.
+    """
+    return await store.delete_properties_bulk(ids=properties.ids, filters=properties.filters)
+
+
+@router.get("/properties/",
+            response_model=List[schemas.Property],
+            status_code=status.HTTP_200_OK,
+            response_description="Matching properties")
+async def read_properties(response: Response, filters: schemas.PropertyFilter = Depends(get_property_filter),
+                          sort: schemas.PropertySortEnum = schemas.PropertySortEnum.id,
+                          limit: int = Query(100, gt=0, le=1000), cursor: Optional[str] = None,
+                          fields: Optional[str] = None, store=Depends(get_read_store)):
+    """
+    Search properties with the following filters, all optional:
+
+    - **city**: city
+    - **min_price** / **max_price**: selling price range
+    - **min_surface**: minimal surface
+    - **rooms**: number of rooms
+    - **is_available**: boolean
+    - **is_flat**: boolean
+    - **available_between**: first and last days of a period without booking, e.g. 2021-03-01/2021-05-31
+
+    The results are sorted by **sort**: "id", "selling_price" or "-selling_price", the properties
+    without a selling price are left out of the price sorts. The pages are read with the opaque
+    **cursor** returned in the **X-Next-Cursor** header of the previous page.
+
+    **fields** are the comma separated fields of the properties to return, e.g. "id,city,selling_price",
+    only these columns are read. The id is always returned.
+    """
+    after, key = parse_search_cursor(sort, cursor)
+    property_fields = parse_fields(fields, PROPERTY_FIELDS)
+    if property_fields is not None:
+        property_rows = await store.search_properties_rows(filters=filters, columns=property_fields, sort=sort,
+                                                           limit=limit + 1, after=after)
+        property_rows = paginate(property_rows, limit, response, key=key)
+        return serialization.fast_json_response(
+            serialization.properties_content(property_rows, fields=property_fields), response)
+    db_properties = await store.search_properties(filters=filters, sort=sort, limit=limit + 1, after=after)
+    return paginate(db_properties, limit, response, key=key)
+
+
+@router.get("/properties/near",
+            response_model=List[schemas.PropertyDistance],
+            status_code=status.HTTP_200_OK,
+            response_description="Properties around the point, nearest first")
+async def read_properties_near(lat: float = Query(..., ge=-90, le=90), lon: float = Query(..., ge=-180, le=180),
+                               radius_km: float = Query(..., gt=0, le=100),
+                               filters: schemas.PropertyFilter = Depends(get_property_filter),
+                               limit: int = Query(100, gt=0, le=1000), store=Depends(get_read_store)):
+    """
+    Get the properties within **radius_km** km of the point (**lat**, **lon**), nearest first, with
+    their **distance_km**. The filters of **GET /properties/** apply, only the located properties
+    are returned.
+    """
+    return [dict(schemas.Property.from_orm(db_property).dict(), distance_km=distance)
+            for db_property, distance in await store.get_properties_near(
+                latitude=lat, longitude=lon, radius_km=radius_km, filters=filters, limit=limit)]
+
+
+@router.get("/properties/in-bbox",
+            response_model=List[schemas.Property],
+            status_code=status.HTTP_200_OK,
+            response_description="Properties of the box")
+async def read_properties_in_bbox(response: Response, min_lat: float = Query(..., ge=-90, le=90),
+                                  max_lat: float = Query(..., ge=-90, le=90),
+                                  min_lon: float = Query(..., ge=-180, le=180),
+                                  max_lon: float = Query(..., ge=-180, le=180),
+                                  filters: schemas.PropertyFilter = Depends(get_property_filter),
+                                  limit: int = Query(100, gt=0, le=1000), cursor: Optional[str] = None,
+                                  store=Depends(get_read_store)):
+    """
+    Get the properties located in the box of a map, ordered by id. The box crosses the
+    antimeridian when **min_lon** is greater than **max_lon**. The filters of **GET /properties/**
+    apply. The pages are read with the opaque **cursor** returned in the **X-Next-Cursor** header
+    of the previous page.
+    """
+    if min_lat > max_lat:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="min_lat can't be greater than max_lat")
+    db_properties = await store.get_properties_in_bbox(
+        min_latitude=min_lat, max_latitude=max_lat, min_longitude=min_lon, max_longitude=max_lon,
+        filters=filters, limit=limit + 1, after_id=parse_cursor(cursor))
+    return paginate(db_properties, limit, response)
+
+
+# This endpoint is just here for testing purposes, so it will be not displayed in Swagger UI.
+@router.get("/properties/{property_id}",
+            response_model=schemas.Property,
+            status_code=status.HTTP_200_OK,
+            response_description="Selected property",
+            include_in_schema=False)
+async def read_property(property_id: int, fields: Optional[str] = None, if_none_match: Optional[str] = Header(None),
+                        store=Depends(get_read_store)):
+    """
+    Get a property with the property id, only with the comma separated **fields** if given.
+    """
+    property_fields = parse_fields(fields, PROPERTY_FIELDS)
+
+    async def get_version():
+        version = await store.get_property_version(property_id=property_id)
+        if version is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Property not found")
+        return version
+
+    async def load():
+        if property_fields is not None:
+            row = await store.get_property_row(property_id=property_id, columns=property_fields + ["version"])
+            if row is None:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND, detail="Property not found")
+            content = serialization.properties_content([row], fields=property_fields)[0]
+            return content, [property_key(property_id)], row.version
+        db_property = await store.get_property(property_id=property_id)
+        if db_property is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Property not found")
+        return schemas.Property.from_orm(db_property), [property_key(property_id)], db_property.version
+
+    key = property_key(property_id)
+    if property_fields is not None:
+        key = fields_key(key, property_fields)
+    return await cached_json_response(key, load, get_version, if_none_match)
+
+
+@router.get("/users/{user_id}/properties/",
+            response_model=List[schemas.Property],
+            status_code=status.HTTP_200_OK,
+            response_description="Selected property")
+async def read_properties_from_user(response: Response, user_id: int, limit: Optional[int] = Query(None, gt=0),
+                                    cursor: Optional[str] = None, fields: Optional[str] = None,
+                                    if_none_match: Optional[str] = Header(None), store=Depends(get_read_store)):
+    """
+    Get the properties of a user, ordered by id.
+
+    - **limit**: maximum number of properties, all of them are returned if not set
+    - **cursor**: opaque cursor returned in the **X-Next-Cursor** header of the previous page
+    - **fields**: comma separated fields of the properties, only these columns are read. The id
+    is always returned.
+
+    The **ETag** header is the version of the user, as in **GET /users/{user_id}**. When
+    **If-None-Match** matches it the response is a 304 without body.
+    """
+    after_id = parse_cursor(cursor)
+    property_fields = parse_fields(fields, PROPERTY_FIELDS)
+    version = await store.get_user_version(user_id=user_id)
+    if version is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    if etag_matches(if_none_match, version):
+        return not_modified(version)
+    response.headers["ETag"] = make_etag(version)
+    if serialization.FAST_SERIALIZATION or property_fields is not None:
+        property_rows = await store.get_properties_by_owner_rows(
+            owner_id=user_id, limit=None if limit is None else limit + 1, after_id=after_id, columns=property_fields)
+        if limit is not None:
+            property_rows = paginate(property_rows, limit, response)
+        content = serialization.properties_content(property_rows, fields=property_fields)
+        return serialization.fast_json_response(content, response)
+    if limit is None:
+        return await store.get_properties_by_owner(owner_id=user_id, after_id=after_id)
+    db_properties = await store.get_properties_by_owner(owner_id=user_id, limit=limit + 1, after_id=after_id)
+    return paginate(db_properties, limit, response)
+
+
+@router.put("/properties/{property_id}",
+            response_model=schemas.Property,
+            status_code=status.HTTP_200_OK,
+            response_description="Updated property")
+async def change_property(response: Response, property_id: int, property: schemas.PropertyUpdate,
+                          if_match: Optional[str] = Header(None), store=Depends(get_store)):
+    """
+    Update property data with the following fields:
+
+    - **adress**: home adress, REQUIRED
+    - **city**: city, REQUIRED
+    - **is_sold**: boolean, can't be true if "is_rented" is true
+    - **is_rented**: boolean, can't be true if "is_sold" is true
+    - **is_available**: boolean, can't be true if "is_rented" and "is_sold" are true
+    - **surface**: numeric value, must be greater than 0
+    - **rooms**: number of rooms, must be greater than 0
+    - **is_home**: boolean, can't be equal to "is_flat"
+    - **is_flat**: boolean, can't be equal to "is_home"
+    - **age**: age of the house, must be greater than 0
+    - **selling_price**: selling price, must be greater than 0
+    - **sale_date**: datetime
+    - **rental_price**: rental price, must be greater than 0
+    - **rental_start_date**: datetime
+    - **availability_date**: datetime
+    - **owner_id** : user id, this id must match one in the user table
+
+    With **If-Match**, the property is only updated if its ETag matches, otherwise the response is a 412.
+    """
+    try:
+        db_property = await store.update_property(property=property, property_id=property_id,
+                                                  expected_versions=if_match_versions(if_match))
+    except INTEGRITY_ERRORS as exc:
+        raise_integrity_error(exc)
+    except crud.StaleVersionError:
+        raise precondition_failed()
+    if db_property is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Property not found")
+    response.headers["ETag"] = make_etag(db_property.version)
+    return db_property
+
+
+@router.patch("/properties/{property_id}",
+              response_model=schemas.Property,
+              status_code=status.HTTP_200_OK,
+              response_description="Updated property")
+async def patch_property(response: Response, property_id: int, property: schemas.PropertyPatch,
+                         if_match: Optional[str] = Header(None), store=Depends(get_store)):
+    """
+    Update only the given fields of a property, the other ones are kept. The fields are the
+    ones of **PUT /properties/{property_id}**, the booleans can be omitted but not null. The
+    rules between fields ("is_home" and "is_flat", "is_sold" and "is_rented") are checked on
+    the updated property, **latitude** and **longitude** are set together.
+
+    The property is written and read back with a single UPDATE. With **If-Match**, the property
+    is only updated if its ETag matches, otherwise the response is a 412.
+    """
+    try:
+        row = await store.patch_property(property=property, property_id=property_id,
+                                         expected_versions=if_match_versions(if_match))
+    except INTEGRITY_ERRORS as exc:
+        raise_integrity_error(exc)
+    except crud.StaleVersionError:
+        raise precondition_failed()
+    if row is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Property not found")
+    response.headers["ETag"] = make_etag(row.version)
+    return row
+
+
+@router.put("/properties/{property_id}/{owner_id}",
+            response_model=schemas.Property,
+            status_code=status.HTTP_200_OK,
+            response_description="Updated property")
+async def change_property_owner(response: Response, property_id: int, owner_id: int,
+                                if_match: Optional[str] = Header(None), store=Depends(get_store)):
+    """
+    Update a property owner with the property id and the new owner id.
+
+    With **If-Match**, the owner is only changed if the ETag of the property matches,
+    otherwise the response is a 412.
+    """
+    try:
+        db_property = await store.update_property_owner(property_id=property_id, owner_id=owner_id,
+                                                        expected_versions=if_match_versions(if_match))
+    except INTEGRITY_ERRORS as exc:
+        raise_integrity_error(exc)
+    except crud.StaleVersionError:
+        raise precondition_failed()
+    if db_property is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Property not found")
+    response.headers["ETag"] = make_etag(db_property.version)
+    return db_property
+
+
+@router.post("/users/{from_id}/transfer/{to_id}",
+             response_model=schemas.TransferReport,
+             status_code=status.HTTP_200_OK,
+             response_description="Transferred properties")
+async def transfer_properties(from_id: int, to_id: int, transfer: Optional[schemas.PropertyTransfer] = None,
+                              store=Depends(get_store)):
+    """
+    Transfer the properties of the user **from_id** to the user **to_id** in a single transaction,
+    all of them or only the ones selected by the body:
+
+    - **ids**: ids of the properties, the ones of another owner are ignored
+    - **filters**: filters of **GET /properties/**, e.g. {"city": "Paris"}
+
+    The response lists the ids of the transferred properties.
+    """
+    if from_id == to_id:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="The properties can't be transferred to their owner")
+    transfer = transfer or schemas.PropertyTransfer()
+    property_ids = await store.transfer_properties(from_owner_id=from_id, to_owner_id=to_id,
+                                                   ids=transfer.ids, filters=transfer.filters)
+    if property_ids is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return {"transferred": len(property_ids), "property_ids": property_ids}
+
+
+@router.delete("/properties/{property_id}",
+               response_model=schemas.Property,
+               status_code=status.HTTP_200_OK,
+               response_description="Deleted property")
+async def remove_property(property_id: int, if_match: Optional[str] = Header(None), store=Depends(get_store)):
+    """
+    Delete a property with the property id.
+
+    With **If-Match**, the property is only deleted if its ETag matches, otherwise the response is a 412.
+    """
+    try:
+        db_property = await store.delete_property(property_id=property_id,
+                                                  expected_versions=if_match_versions(if_match))
+    except crud.StaleVersionError:
+        raise precondition_failed()
+    if db_property is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Property not found")
+    return db_property
+
+
+# -------------------------------------------- Booking operations --------------------------------------------
+
+
+@router.post("/properties/{property_id}/bookings",
+             response_model=schemas.Booking,
+             status_code=status.HTTP_201_CREATED,
+             response_description="Booking created")
+async def create_booking(property_id: int, booking: schemas.BookingCreate, store=Depends(get_store)):
+    """
+    Book a property with the following fields:
+
+    - **start_date**: first day of the booking, REQUIRED
+    - **end_date**: last day of the booking, on or after start_date, REQUIRED
+
+    Both days are booked. A booking overlapping another booking of the property is a 409.
+    """
+    try:
+        return await store.create_booking(property_id=property_id, booking=booking)
+    except INTEGRITY_ERRORS as exc:
+        if crud.is_foreign_key_violation(exc):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Property not found")
+        raise_integrity_error(exc)
+
+
+@router.get("/properties/{property_id}/bookings",
+            response_model=List[schemas.Booking],
+            status_code=status.HTTP_200_OK,
+            response_description="Bookings of the property")
+async def read_bookings(property_id: int, store=Depends(get_read_store)):
+    """
+    Get the bookings of a property sorted by start date.
+    """
+    if await store.get_property_version(property_id=property_id) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Property not found")
+    return await store.get_bookings(property_id=property_id)
+
+
+@router.delete("/properties/{property_id}/bookings/{booking_id}",
+               response_model=schemas.Booking,
+               status_code=status.HTTP_200_OK,
+               response_description="Booking deleted")
+async def remove_booking(property_id: int, booking_id: int, store=Depends(get_store)):
+    """
+    Cancel a booking of a property with the booking id.
+    """
+    db_booking = await store.delete_booking(property_id=property_id, booking_id=booking_id)
+    if db_booking is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Booking not found")
+    return db_booking
+
+
+# -------------------------------------------- Export operations --------------------------------------------
+
+
+@router.get("/export/{table}.{format}",
+            status_code=status.HTTP_200_OK,
+            response_description="All the rows of the table")
+async def export_table(table: export.ExportTableEnum, format: export.ExportFormatEnum,
+                       store=Depends(get_read_store)):
+    """
+    Export a whole table, **users** or **properties**, as **ndjson** or **csv**.
+
+    The rows are read by chunks and streamed to the client as they are read,
+    so the memory used by the API doesn't depend on the size of the table.
+    """
+    db_table = export.EXPORT_TABLES[table]
+    return StreamingResponse(store.stream_export(format, db_table), media_type=export.EXPORT_MEDIA_TYPES[format])
+
+
+# -------------------------------------------- Search operations --------------------------------------------
+
+
+@router.get("/search",
+            response_model=schemas.SearchResults,
+            status_code=status.HTTP_200_OK,
+            response_description="Matching users and properties")
+async def search(q: str = Query(..., min_length=1, max_length=100),
+                 scope: schemas.SearchScopeEnum = schemas.SearchScopeEnum.all,
+                 limit: int = Query(10, gt=0, le=100), store=Depends(get_read_store)):
+    """
+    Search users by full name and email and properties by adress and city, best matches first:
+
+    - **q**: words of the search, each word is a prefix, e.g. "rue marg" matches "12 rue Margueritte"
+    - **scope**: all, users or properties
+    - **limit**: maximal number of users and of properties
+    """
+    results = {}
+    if scope in (schemas.SearchScopeEnum.all, schemas.SearchScopeEnum.users):
+        results["users"] = await store.search_users_text(text_query=q, limit=limit)
+    if scope in (schemas.SearchScopeEnum.all, schemas.SearchScopeEnum.properties):
+        results["properties"] = await store.search_properties_text(text_query=q, limit=limit)
+    return results
+
+
+# -------------------------------------------- Statistics operations --------------------------------------------
+
+
+@router.get("/stats/cities",
+            response_model=List[schemas.CityStats],
+            status_code=status.HTTP_200_OK,
+            response_description="Statistics of the cities")
+async def read_city_stats(city: Optional[str] = None, store=Depends(get_read_store)):
+    """
+    Get the statistics of the properties of each city, or of **city** only:
+
+    - **property_count**, **available_count**, **rented_count** and **sold_count**
+    - **average_selling_price** and **median_selling_price** of the properties with a selling price
+    - **average_rent_per_m2** of the properties with a rental price and a surface
+
+    The statistics are maintained on every write of the properties, they aren't computed by the request.
+    """
+    return await store.get_city_stats(city=city)
+
+
+# -------------------------------------------- Debug operations --------------------------------------------
+
+
+@router.get("/debug/cache",
+            status_code=status.HTTP_200_OK,
+            response_description="Counters of the response cache")
+async def read_cache_stats():
+    """
+    Get the size and the hit, miss, eviction, expiration and invalidation counters
+    of the cache of **GET /users/{user_id}** and **GET /properties/{property_id}**.
+    """
+    return response_cache.stats()
+
+
+@router.get("/debug/slow-queries",
+            status_code=status.HTTP_200_OK,
+            response_description="Slowest normalized SQL statements")
+async def read_slow_queries(limit: int = Query(20, ge=1, le=500)):
+    """
+    Get the SQL statements which took more than SLOW_QUERY_MS milliseconds, grouped by
+    normalized statement and ordered by total time:
+
+    - **count**, **total_ms**, **mean_ms** and **max_ms** of the slow executions
+    - **routes** which ran them
+    - **plan** given by EXPLAIN QUERY PLAN
+    """
+    return {"threshold_ms": slow_queries.SLOW_QUERY_MS, "statements": slow_queries.slow_query_log.top(limit)}
+
+
+# Scraped by Prometheus, so it is not displayed in Swagger UI
+@router.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    """
+    Get the request and SQL query metrics in the Prometheus text format.
+    """
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
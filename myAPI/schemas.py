@@ -1,10 +1,16 @@
 from datetime import date
 from enum import Enum
 
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 from pydantic import BaseModel, Field, validator
 
 
+# Messages of the rules between fields of the properties, also checked by the constraints of the table
+IS_HOME_IS_FLAT_ERROR = 'The property need to be a home or a flat, please set up correctly these fields'
+IS_SOLD_IS_RENTED_ERROR = "The property can't be sold or rented at the same time, please set up correctly these fields"
+LATITUDE_LONGITUDE_ERROR = 'The latitude and the longitude of the property must be set together'
+
+
 # Enum class for the gender field
 class GenderEnum(str, Enum):
     male = 'M'
@@ -29,24 +35,32 @@ class PropertyBase(BaseModel):
     rental_start_date: Optional[date] = None
     availability_date: Optional[date] = None
     owner_id: Optional[int] = Field(gt=0)
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
 
     @validator('is_flat')
     def check_is_home_is_flat_integrity(cls, is_flat: bool, values: Dict[str, Optional[str]]):
         is_home = values.get('is_home')
         if is_home == is_flat:
-            raise ValueError(
-                'The property need to be a home or a flat, please set up correctly these fields')
+            raise ValueError(IS_HOME_IS_FLAT_ERROR)
         return is_flat
 
     @validator('is_rented')
     def check_is_sold_is_rented_integrity(cls, is_rented: bool, values: Dict[str, Optional[str]]):
         is_sold = values.get('is_sold')
         if is_sold is True and is_rented is True:
-            raise ValueError(
-                "The property can't be sold or rented at the same time, please set up correctly these fields")
+            raise ValueError(IS_SOLD_IS_RENTED_ERROR)
         return is_rented
 
 
+# Validator of the schemas of the whole property, an omitted coordinate is None. A patch
+# is checked on the updated property, by the constraint of the table.
+def check_latitude_longitude_integrity(cls, longitude: Optional[float], values: Dict[str, Optional[str]]):
+    if 'latitude' in values and (values['latitude'] is None) != (longitude is None):
+        raise ValueError(LATITUDE_LONGITUDE_ERROR)
+    return longitude
+
+
 class PropertyCreate(PropertyBase):
     """
     Pydantic schema to create a property.
@@ -54,12 +68,32 @@ class PropertyCreate(PropertyBase):
     adress: str = Field(max_length=50)
     city: str = Field(max_length=50)
 
+    _check_location = validator('longitude', always=True, allow_reuse=True)(check_latitude_longitude_integrity)
+
 
 class PropertyUpdate(PropertyBase):
     """
     Pydantic schema to update a property.
     """
-    pass
+    _check_location = validator('longitude', always=True, allow_reuse=True)(check_latitude_longitude_integrity)
+
+
+class PropertyPatch(PropertyBase):
+    """
+    Pydantic schema to update some fields of a property, the fields which aren't set are kept.
+    The rules between fields which aren't both set are checked on the updated property.
+    """
+    is_sold: Optional[bool] = None
+    is_rented: Optional[bool] = None
+    is_available: Optional[bool] = None
+    is_home: Optional[bool] = None
+    is_flat: Optional[bool] = None
+
+    @validator('is_sold', 'is_rented', 'is_available', 'is_home', 'is_flat', pre=True)
+    def check_not_null(cls, value):
+        if value is None:
+            raise ValueError('This field can be omitted but not null')
+        return value
 
 
 class Property(PropertyBase):
@@ -70,11 +104,99 @@ class Property(PropertyBase):
     adress: str = Field(max_length=50)
     city: str = Field(max_length=50)
 
+    _check_location = validator('longitude', always=True, allow_reuse=True)(check_latitude_longitude_integrity)
+
     # Required to validate from ORMs
     class Config:
         orm_mode = True
 
 
+class PropertyDistance(Property):
+    """
+    Pydantic schema to read a property found around a point.
+    """
+    distance_km: float
+
+
+# Enum class for the sort order of the property search
+class PropertySortEnum(str, Enum):
+    id = 'id'
+    selling_price = 'selling_price'
+    selling_price_desc = '-selling_price'
+
+
+class PropertyFilter(BaseModel):
+    """
+    Pydantic schema to filter the properties, unset fields are ignored.
+    """
+    city: Optional[str] = Field(None, max_length=50)
+    min_price: Optional[int] = Field(None, ge=0)
+    max_price: Optional[int] = Field(None, ge=0)
+    min_surface: Optional[float] = Field(None, ge=0)
+    rooms: Optional[int] = Field(None, gt=0)
+    is_available: Optional[bool] = None
+    is_flat: Optional[bool] = None
+    # first and last days of a period without any booking of the property
+    available_between: Optional[Tuple[date, date]] = None
+
+    @validator('available_between')
+    def check_period_integrity(cls, period: Optional[Tuple[date, date]]):
+        if period is not None and period[0] > period[1]:
+            raise ValueError('The first day of the period is after its last day')
+        return period
+
+
+class PropertyDeleteFilter(PropertyFilter):
+    """
+    Pydantic schema to select the properties to delete, the filters of the search and the
+    owner and state of the properties.
+    """
+    owner_id: Optional[int] = Field(None, gt=0)
+    is_sold: Optional[bool] = None
+    is_rented: Optional[bool] = None
+
+
+class PropertyBulkDelete(BaseModel):
+    """
+    Pydantic schema to delete properties by id, by filter, or the properties of the ids
+    matching the filter. The ids or a filter are required.
+    """
+    ids: Optional[List[int]] = None
+    filters: Optional[PropertyDeleteFilter] = None
+
+    @validator('filters', always=True)
+    def check_ids_or_filters(cls, filters: Optional[PropertyDeleteFilter], values: Dict[str, Optional[List[int]]]):
+        if values.get('ids') is None and (filters is None or not filters.dict(exclude_none=True)):
+            raise ValueError('Give the ids or at least one filter of the properties to delete')
+        return filters
+
+
+class BookingCreate(BaseModel):
+    """
+    Pydantic schema to book a property, from start_date to end_date included.
+    """
+    start_date: date
+    end_date: date
+
+    @validator('end_date')
+    def check_start_date_end_date_integrity(cls, end_date: date, values: Dict[str, Optional[date]]):
+        start_date = values.get('start_date')
+        if start_date is not None and end_date < start_date:
+            raise ValueError('The booking must end on or after its start date')
+        return end_date
+
+
+class Booking(BookingCreate):
+    """
+    Pydantic schema to read a booking.
+    """
+    id: int
+    property_id: int
+
+    class Config:
+        orm_mode = True
+
+
 class UserBase(BaseModel):
     """
     Basic Pydantic schema for the user.
@@ -102,12 +224,122 @@ class UserUpdate(UserBase):
     pass
 
 
-class User(UserBase):
+class UserPatch(UserBase):
     """
-    Pydantic schema to read a user.
+    Pydantic schema to update some fields of a user, the fields which aren't set are kept.
+    """
+    full_name: Optional[str] = Field(None, max_length=50)
+    email: Optional[str] = Field(None, max_length=50)
+
+    @validator('full_name', 'email', pre=True)
+    def check_not_null(cls, value):
+        if value is None:
+            raise ValueError('This field can be omitted but not null')
+        return value
+
+
+class PropertyTransfer(BaseModel):
+    """
+    Pydantic schema to select the properties of an owner to transfer, the ones of ids, the ones
+    matching the filters, or the ones of ids matching the filters. All of them when not set.
+    """
+    ids: Optional[List[int]] = None
+    filters: Optional[PropertyFilter] = None
+
+
+class TransferReport(BaseModel):
+    """
+    Pydantic schema to read the properties moved by an ownership transfer.
+    """
+    transferred: int
+    property_ids: List[int]
+
+
+# Enum class for what becomes of the properties of the deleted users
+class OwnedPropertiesEnum(str, Enum):
+    detach = 'detach'
+    delete = 'delete'
+
+
+class UserBulkDelete(BaseModel):
+    """
+    Pydantic schema to delete users by id. Their properties are detached from them (the
+    default) or deleted with them.
+    """
+    ids: List[int] = Field(..., min_items=1)
+    properties: OwnedPropertiesEnum = OwnedPropertiesEnum.detach
+
+
+class UserSummary(UserBase):
+    """
+    Pydantic schema to read a user with the summary of its properties.
     """
     id: int
-    properties: List[Property] = []
+    property_count: int = 0
+    rented_count: int = 0
+    total_rental_income: int = 0
 
     class Config:
         orm_mode = True
+
+
+class User(UserSummary):
+    """
+    Pydantic schema to read a user with its properties.
+    """
+    properties: List[Property] = []
+
+
+class BulkUserResult(BaseModel):
+    """
+    Pydantic schema of the result of a row of a bulk user import.
+    """
+    index: int
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+
+class BulkUserReport(BaseModel):
+    """
+    Pydantic schema to read the report of a bulk user import.
+    """
+    created: int
+    results: List[BulkUserResult]
+
+
+class BulkDeleteReport(BaseModel):
+    """
+    Pydantic schema to read the counts of rows of a bulk deletion.
+    """
+    deleted: int
+    properties_deleted: int = 0
+    properties_detached: int = 0
+
+
+class CityStats(BaseModel):
+    """
+    Pydantic schema to read the statistics of the properties of a city.
+    """
+    city: str
+    property_count: int
+    available_count: int
+    rented_count: int
+    sold_count: int
+    average_selling_price: Optional[float] = None
+    median_selling_price: Optional[float] = None
+    average_rent_per_m2: Optional[float] = None
+
+
+# Enum class of the tables searched by GET /search
+class SearchScopeEnum(str, Enum):
+    all = 'all'
+    users = 'users'
+    properties = 'properties'
+
+
+class SearchResults(BaseModel):
+    """
+    Pydantic schema to read the results of a full text search.
+    """
+    users: List[UserSummary] = []
+    properties: List[Property] = []
@@ -0,0 +1,96 @@
+import json
+import os
+from datetime import date
+from typing import List, Optional
+
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+from . import schemas
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Set FAST_SERIALIZATION=1 to serve the user lists (GET /users/ and
+# GET /users/{user_id}/properties/) with the fast path: the rows are read with
+# SQL Alchemy Core instead of the ORM and turned into the response dicts
+# directly, without the orm_mode validation of the response models, then
+# encoded with orjson. The dicts have the fields of schemas.User and
+# schemas.Property, the rows come from the database so they are already valid.
+FAST_SERIALIZATION = os.environ.get("FAST_SERIALIZATION", "0") == "1"
+
+
+def _json_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+# JSON response encoded with orjson, or with the standard json module if orjson isn't installed
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content)
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":"),
+                          default=_json_default).encode("utf-8")
+
+
+# Build a function turning a row into the dict of a response model, or of the only
+# fields of a sparse fieldset. The float fields are Numeric columns read as Decimal,
+# they are converted like pydantic does.
+def _row_builder(schema, exclude=(), only: Optional[List[str]] = None):
+    fields = [(name, float if isinstance(field.type_, type) and issubclass(field.type_, float) else None)
+              for name, field in schema.__fields__.items()
+              if name not in exclude and (only is None or name in only)]
+
+    def build(row) -> dict:
+        values = {}
+        for name, convert in fields:
+            value = row[name]
+            if convert is not None and value is not None:
+                value = convert(value)
+            values[name] = value
+        return values
+
+    return build
+
+
+property_dict = _row_builder(schemas.Property)
+user_dict = _row_builder(schemas.UserSummary)
+
+
+def properties_content(property_rows: List, fields: Optional[List[str]] = None) -> List[dict]:
+    build = property_dict if fields is None else _row_builder(schemas.Property, only=fields)
+    return [build(row) for row in property_rows]
+
+
+# Nest the properties rows, ordered by id, into the dicts of their owners. Without
+# properties rows the dicts are the summaries of the users, with fields they only
+# have these fields.
+def users_content(user_rows: List, property_rows: Optional[List] = None,
+                  fields: Optional[List[str]] = None) -> List[dict]:
+    build = user_dict if fields is None else _row_builder(schemas.UserSummary, only=fields)
+    users = [build(row) for row in user_rows]
+    if property_rows is None:
+        return users
+    by_id = {}
+    for user in users:
+        user["properties"] = []
+        by_id[user["id"]] = user
+    for row in property_rows:
+        by_id[row["owner_id"]]["properties"].append(property_dict(row))
+    return users
+
+
+# The handlers which return their response directly get the headers they set on
+# the "response" parameter (ETag, X-Next-Cursor) copied to it
+def json_response(content, response: Response, response_class=JSONResponse) -> JSONResponse:
+    headers = {name: value for name, value in response.headers.items()
+               if name not in ("content-length", "content-type")}
+    return response_class(content=content, headers=headers)
+
+
+def fast_json_response(content, response: Response) -> FastJSONResponse:
+    return json_response(content, response, FastJSONResponse)
@@ -0,0 +1,193 @@
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, List
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .database import async_query_listeners, compile_async_query
+from .metrics import current_route
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than SLOW_QUERY_MS milliseconds are logged with their plan and
+# aggregated for GET /debug/slow-queries, a negative value disables the log
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+
+# Number of distinct normalized statements kept by the aggregation
+SLOW_QUERY_STATEMENTS = int(os.environ.get("SLOW_QUERY_STATEMENTS", 500))
+
+# Seconds during which the plan of a statement is reused instead of explained again
+PLAN_TTL = 300
+
+# Routes kept per statement
+MAX_ROUTES = 10
+
+_EXPLAINED = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+_PLACEHOLDER_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_VALUES_LISTS = re.compile(r"(\(\?\.\.\.\))(?:\s*,\s*\(\?\.\.\.\))+")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACES = re.compile(r"\s+")
+
+
+# Statement with its literals and the lengths of its lists of placeholders removed,
+# so that the same query with other values or another number of ids is grouped.
+def normalize(statement: str) -> str:
+    statement = _SPACES.sub(" ", statement).strip()
+    statement = _LITERALS.sub("?", statement)
+    statement = _PLACEHOLDER_LISTS.sub("(?...)", statement)
+    return _VALUES_LISTS.sub(r"\1, ...", statement)
+
+
+# Types of the bound parameters, their values aren't logged
+def parameter_shape(parameters, executemany: bool) -> str:
+    if executemany:
+        count = len(parameters)
+        return "%d x %s" % (count, parameter_shape(parameters[0], False) if count else "()")
+    if isinstance(parameters, dict):
+        return "{%s}" % ", ".join("%s: %s" % (name, type(value).__name__) for name, value in parameters.items())
+    return "(%s)" % ", ".join(type(value).__name__ for value in parameters or ())
+
+
+class SlowQueryLog:
+    def __init__(self, max_statements: int = SLOW_QUERY_STATEMENTS):
+        self.max_statements = max_statements
+        self._statements = {}
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    # Plan of a statement explained less than PLAN_TTL seconds ago, an empty plan for
+    # the statements which can't be explained, None if it has to be explained
+    def _cached_plan(self, statement: str, now: float):
+        cached = self._plans.get(statement)
+        if cached is not None and now - cached[0] < PLAN_TTL:
+            return cached[1]
+        if not statement.lstrip()[:7].upper().startswith(_EXPLAINED):
+            return []
+        return None
+
+    def _set_plan(self, statement: str, now: float, plan: List[str]) -> List[str]:
+        with self._lock:
+            if len(self._plans) >= self.max_statements:
+                self._plans.clear()
+            self._plans[statement] = (now, plan)
+        return plan
+
+    # EXPLAIN QUERY PLAN of a statement, run on the connection which executed it with
+    # the same parameters. The plan is kept PLAN_TTL seconds per statement.
+    def plan(self, dbapi_connection, statement: str, parameters) -> List[str]:
+        now = time.monotonic()
+        plan = self._cached_plan(statement, now)
+        if plan is not None:
+            return plan
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters or ())
+            plan = _format_plan(cursor.fetchall())
+        except Exception as exc:
+            plan = ["EXPLAIN failed: %s" % exc]
+        finally:
+            cursor.close()
+        return self._set_plan(statement, now, plan)
+
+    # plan() on the aiosqlite connection of an async connection
+    async def aplan(self, raw_connection, statement: str, parameters) -> List[str]:
+        now = time.monotonic()
+        plan = self._cached_plan(statement, now)
+        if plan is not None:
+            return plan
+        try:
+            async with raw_connection.execute("EXPLAIN QUERY PLAN " + statement, parameters or ()) as cursor:
+                plan = _format_plan(await cursor.fetchall())
+        except Exception as exc:
+            plan = ["EXPLAIN failed: %s" % exc]
+        return self._set_plan(statement, now, plan)
+
+    def record(self, dbapi_connection, statement: str, parameters, executemany: bool, elapsed: float):
+        first_parameters = parameters[0] if executemany and parameters else parameters
+        self._add(statement, parameters, executemany, elapsed,
+                  self.plan(dbapi_connection, statement, first_parameters))
+
+    async def arecord(self, raw_connection, statement: str, parameters, elapsed: float):
+        self._add(statement, parameters, False, elapsed, await self.aplan(raw_connection, statement, parameters))
+
+    def _add(self, statement: str, parameters, executemany: bool, elapsed: float, plan: List[str]):
+        route = current_route()
+        logger.warning("slow query %.1f ms on %s: %s parameters=%s plan=%s", elapsed * 1e3, route or "-",
+                       statement, parameter_shape(parameters, executemany), " | ".join(plan))
+        key = normalize(statement)
+        with self._lock:
+            entry = self._statements.get(key)
+            if entry is None:
+                if len(self._statements) >= self.max_statements:
+                    # make room by forgetting the statement of least total time
+                    del self._statements[min(self._statements, key=lambda k: self._statements[k]["total"])]
+                entry = self._statements[key] = {"count": 0, "total": 0.0, "max": 0.0, "routes": []}
+            entry["count"] += 1
+            entry["total"] += elapsed
+            entry["max"] = max(entry["max"], elapsed)
+            entry["plan"] = plan
+            if route is not None and route not in entry["routes"] and len(entry["routes"]) < MAX_ROUTES:
+                entry["routes"].append(route)
+
+    # Normalized statements of largest total time first
+    def top(self, limit: int = 20) -> List[Dict]:
+        with self._lock:
+            entries = sorted(self._statements.items(), key=lambda item: item[1]["total"], reverse=True)[:limit]
+            return [{"statement": statement, "count": entry["count"],
+                     "total_ms": round(entry["total"] * 1e3, 3),
+                     "mean_ms": round(entry["total"] * 1e3 / entry["count"], 3),
+                     "max_ms": round(entry["max"] * 1e3, 3),
+                     "routes": list(entry["routes"]), "plan": list(entry["plan"])}
+                    for statement, entry in entries]
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+            self._plans.clear()
+
+
+# Rows of (id, parent, notused, detail) of EXPLAIN QUERY PLAN, the depth is shown by the indentation
+def _format_plan(rows) -> List[str]:
+    depths = {0: -1}
+    plan = []
+    for row_id, parent, _, detail in rows:
+        depths[row_id] = depths.get(parent, -1) + 1
+        plan.append("  " * depths[row_id] + detail)
+    return plan
+
+
+slow_query_log = SlowQueryLog()
+
+
+# Time the statements of an engine and record those slower than SLOW_QUERY_MS. The
+# threshold is read at each statement so it can be changed at run time. The plans
+# are only explained on SQLite.
+def instrument_engine(engine: Engine):
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        context._slow_query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._slow_query_start
+        if 0 <= SLOW_QUERY_MS <= elapsed * 1e3:
+            slow_query_log.record(conn.connection, statement, parameters, executemany, elapsed)
+
+
+async def _record_async_query(connection, query, values, elapsed: float):
+    if 0 <= SLOW_QUERY_MS <= elapsed * 1e3:
+        statement, parameters = compile_async_query(query, values)
+        await slow_query_log.arecord(connection.raw_connection, statement, parameters, elapsed)
+
+
+# instrument_engine for the async connections (see database.AsyncConnection)
+def instrument_async_queries():
+    if _record_async_query not in async_query_listeners:
+        async_query_listeners.append(_record_async_query)
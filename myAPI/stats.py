@@ -0,0 +1,208 @@
+"""
+Rebuild the statistics of the cities (GET /stats/cities) and the counters of the owners
+from the properties and verify them.
+
+    python -m myAPI.stats
+    python -m myAPI.stats --verify-only
+
+The database is the one of the DATABASE_URL setting (./database.db by default)
+or --database-url. They are kept up to date by triggers, a rebuild is only
+needed if the properties were written while the triggers didn't exist. The exit
+status is 1 if they don't match the properties.
+"""
+import argparse
+import sys
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import Float, Integer, and_, bindparam, case, cast, func, or_, select
+from sqlalchemy.engine import Engine
+
+from . import models
+from .database import SQLALCHEMY_DATABASE_URL, create_sqlite_engine
+
+# Columns of city_stats which are compared by verify_city_stats
+STATS_COLUMNS = ["property_count", "available_count", "rented_count", "sold_count",
+                 "selling_price_count", "selling_price_sum", "rent_per_m2_count", "rent_per_m2_sum"]
+
+# Counters of the users maintained from their properties
+OWNER_COUNTERS = ["property_count", "rented_count", "total_rental_income"]
+
+# Relative tolerance of the comparison of the float sums, which are updated by additions
+# and subtractions and can drift a little from the sums computed in one pass
+FLOAT_TOLERANCE = 1e-9
+
+
+# Statistics of each city computed from the properties, the same values as the triggers maintain
+def city_stats_query():
+    properties = models.Property.__table__
+    has_rent_per_m2 = and_(properties.c.rental_price.isnot(None), properties.c.surface > 0)
+    return select([
+        properties.c.city,
+        func.count().label("property_count"),
+        func.sum(cast(properties.c.is_available, Integer)).label("available_count"),
+        func.sum(cast(properties.c.is_rented, Integer)).label("rented_count"),
+        func.sum(cast(properties.c.is_sold, Integer)).label("sold_count"),
+        func.count(properties.c.selling_price).label("selling_price_count"),
+        func.coalesce(func.sum(properties.c.selling_price), 0).label("selling_price_sum"),
+        func.sum(case([(has_rent_per_m2, 1)], else_=0)).label("rent_per_m2_count"),
+        func.coalesce(func.sum(case([(has_rent_per_m2, properties.c.rental_price * 1.0 / properties.c.surface)])),
+                      0, type_=Float).label("rent_per_m2_sum"),
+    ]).group_by(properties.c.city)
+
+
+# Replace the statistics by the ones computed from the properties, in a single transaction.
+# The versions are raised above the former ones so that no cached median is reused.
+def rebuild_city_stats(engine: Engine) -> int:
+    city_stats = models.CityStats.__table__
+    with engine.begin() as connection:
+        version = (connection.execute(select([func.max(city_stats.c.version)])).scalar() or 0) + 1
+        connection.execute(city_stats.delete())
+        rows = [dict(row, version=version) for row in connection.execute(city_stats_query())]
+        if rows:
+            connection.execute(city_stats.insert(), rows)
+    medians.clear()
+    return len(rows)
+
+
+def _same(column: str, expected, actual) -> bool:
+    if column == "rent_per_m2_sum":
+        return abs(expected - actual) <= FLOAT_TOLERANCE * max(abs(expected), 1)
+    return expected == actual
+
+
+# Differences between the statistics and the ones computed from the properties,
+# as (city, column, expected, actual), the column is None for a missing or extra city
+def verify_city_stats(engine: Engine) -> List[tuple]:
+    city_stats = models.CityStats.__table__
+    with engine.connect() as connection:
+        expected = {row["city"]: row for row in connection.execute(city_stats_query())}
+        actual = {row["city"]: row for row in connection.execute(select([city_stats]))}
+    differences = []
+    for city in sorted(set(expected) | set(actual)):
+        if city not in expected or city not in actual:
+            differences.append((city, None, city in expected, city in actual))
+            continue
+        for column in STATS_COLUMNS:
+            if not _same(column, expected[city][column], actual[city][column]):
+                differences.append((city, column, expected[city][column], actual[city][column]))
+    return differences
+
+
+# Counters of each owner computed from the properties, the same values as the triggers maintain
+def owner_counters_query():
+    properties = models.Property.__table__
+    return select([
+        properties.c.owner_id,
+        func.count().label("property_count"),
+        func.sum(cast(properties.c.is_rented, Integer)).label("rented_count"),
+        func.coalesce(func.sum(case([(properties.c.is_rented, properties.c.rental_price)])),
+                      0).label("total_rental_income"),
+    ]).where(properties.c.owner_id.isnot(None)).group_by(properties.c.owner_id)
+
+
+# Reset the counters of every user and set the ones of the owners, in a single transaction
+def rebuild_owner_counters(engine: Engine) -> int:
+    users = models.User.__table__
+    with engine.begin() as connection:
+        # the names of the parameters can't be the ones of the columns
+        counters = [{"_" + name: value for name, value in row.items()}
+                    for row in connection.execute(owner_counters_query())]
+        connection.execute(users.update().where(or_(*[users.c[column] != 0 for column in OWNER_COUNTERS]))
+                           .values(**{column: 0 for column in OWNER_COUNTERS}))
+        if counters:
+            connection.execute(users.update().where(users.c.id == bindparam("_owner_id"))
+                               .values(**{column: bindparam("_" + column) for column in OWNER_COUNTERS}), counters)
+    return len(counters)
+
+
+# Differences between the counters of the users and the ones computed from the
+# properties, as (user id, column, expected, actual)
+def verify_owner_counters(engine: Engine) -> List[tuple]:
+    users = models.User.__table__
+    with engine.connect() as connection:
+        expected = {row["owner_id"]: row for row in connection.execute(owner_counters_query())}
+        actual = connection.execute(select([users.c.id] + [users.c[column] for column in OWNER_COUNTERS])).fetchall()
+    differences = []
+    for row in actual:
+        for column in OWNER_COUNTERS:
+            value = expected[row.id][column] if row.id in expected else 0
+            if row[column] != value:
+                differences.append((row.id, column, value, row[column]))
+    return differences
+
+
+# Median selling price of each city, kept until the version of its statistics changes
+class MedianCache:
+    def __init__(self):
+        self._medians = {}
+        self._lock = threading.Lock()
+
+    def get(self, city: str, version: int, compute: Callable[[], Optional[float]]) -> Optional[float]:
+        cached = self._medians.get(city)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        return self._set(city, version, compute())
+
+    # get() with a coroutine function computing the median, for the async mode
+    async def aget(self, city: str, version: int, compute: Callable[[], Awaitable]) -> Optional[float]:
+        cached = self._medians.get(city)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        return self._set(city, version, await compute())
+
+    def _set(self, city: str, version: int, median: Optional[float]) -> Optional[float]:
+        with self._lock:
+            self._medians[city] = (version, median)
+        return median
+
+    def clear(self):
+        with self._lock:
+            self._medians.clear()
+
+
+medians = MedianCache()
+
+
+def _average(total, count) -> Optional[float]:
+    return total / count if count else None
+
+
+# Response dict of schemas.CityStats
+def city_summary(row, median_selling_price: Optional[float]) -> Dict:
+    return {"city": row.city, "property_count": row.property_count, "available_count": row.available_count,
+            "rented_count": row.rented_count, "sold_count": row.sold_count,
+            "average_selling_price": _average(row.selling_price_sum, row.selling_price_count),
+            "median_selling_price": median_selling_price,
+            "average_rent_per_m2": _average(row.rent_per_m2_sum, row.rent_per_m2_count)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database-url", default=SQLALCHEMY_DATABASE_URL)
+    parser.add_argument("--verify-only", action="store_true", help="only compare the statistics to the properties")
+    args = parser.parse_args(argv)
+    if not args.database_url.startswith("sqlite"):
+        parser.error("only SQLite databases are supported")
+
+    engine = create_sqlite_engine(args.database_url)
+    models.Base.metadata.create_all(bind=engine)
+    if not args.verify_only:
+        print("rebuilt the statistics of %d cities" % rebuild_city_stats(engine))
+        print("rebuilt the counters of %d owners" % rebuild_owner_counters(engine))
+    city_differences = verify_city_stats(engine)
+    owner_differences = verify_owner_counters(engine)
+    engine.dispose()
+    for city, column, expected, actual in city_differences:
+        if column is None:
+            print("%s: %s" % (city, "missing" if expected else "no property"))
+        else:
+            print("%s: %s is %r instead of %r" % (city, column, actual, expected))
+    for user_id, column, expected, actual in owner_differences:
+        print("user %d: %s is %r instead of %r" % (user_id, column, actual, expected))
+    print("%d differences" % (len(city_differences) + len(owner_differences)))
+    return 1 if city_differences or owner_differences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
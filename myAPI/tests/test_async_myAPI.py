@@ -0,0 +1,247 @@
+import asyncio
+from contextlib import contextmanager
+
+import pytest
+from fastapi.testclient import TestClient
+
+from .. import database, slow_queries, stats
+from ..database import async_connection
+from ..async_main import app, get_async_db, upgrade_database
+from . import test_myAPI
+from .test_myAPI import create_property, create_property_owner, create_user, engine, metric_value  # noqa: F401
+
+test_database = database.AsyncDatabase(test_myAPI.SQLALCHEMY_DATABASE_URL, size=4)
+
+
+async def override_get_async_db():
+    async with async_connection(test_database) as connection:
+        yield connection
+
+
+# Here we create an other dependency for the test database
+app.dependency_overrides[get_async_db] = override_get_async_db
+app.router.on_startup.append(test_database.connect)
+# The test database is upgraded by test_myAPI.py, the one of the app is left untouched
+app.router.on_startup.remove(upgrade_database)
+app.router.on_shutdown.append(test_database.disconnect)
+
+
+# Count the SQL statements sent by the async connections
+@contextmanager
+def count_async_queries():
+    statements = []
+
+    async def listener(connection, query, values, elapsed):
+        statements.append(database.compile_async_query(query, values)[0])
+
+    database.async_query_listeners.append(listener)
+    try:
+        yield statements
+    finally:
+        database.async_query_listeners.remove(listener)
+
+
+# The tests of test_myAPI.py run against the async app too, their client and their query
+# counter are the ones of the async app. These ones test the sync engine, the command line
+# tools or the helpers and are left out.
+SYNC_ONLY_TESTS = {
+    "test_search_properties_uses_index", "test_export_in_chunks", "test_sqlite_profile_read_pool",
+    "test_only_sqlite_databases", "test_sqlite_version", "test_update_returning_only_on_its_statements",
+    "test_rebuild_missing_constraints", "test_rebuild_rolled_back_on_invalid_rows", "test_radius_boxes",
+    "test_city_stats_rebuild", "test_cache_lru_ttl_and_tags", "test_generate_dataset", "test_metrics",
+    "test_metrics_histogram", "test_slow_queries", "test_slow_queries_normalize",
+    "test_upgrade_drops_obsolete_indexes", "test_migrations_command",
+}
+globals().update({name: test for name, test in vars(test_myAPI).items()
+                  if name.startswith("test_") and name not in SYNC_ONLY_TESTS})
+
+
+@pytest.fixture(autouse=True)
+def client(monkeypatch):
+    with TestClient(app) as client:
+        monkeypatch.setattr(test_myAPI, "client", client)
+        monkeypatch.setattr(test_myAPI, "count_queries", count_async_queries)
+        yield client
+
+
+# ---------------------------------- Unit tests for the async API ----------------------------------
+
+
+def test_async_user_operations(client):
+    created = client.post("/users/", json={
+        "full_name": "Async User",
+        "email": "async.user@gmail.com",
+        "age": 30,
+        "gender": "F",
+        "phone": "0799999999"
+    })
+    user_id = created.json()["id"]
+    duplicated = client.post("/users/", json={
+        "full_name": "Async User",
+        "email": "async.user2@gmail.com"
+    })
+    property_id = client.post("/properties/", json={
+        "adress": "1 rue Async",
+        "city": "Paris",
+        "surface": 30,
+        "owner_id": user_id
+    }).json()["id"]
+    read = client.get("/users/%d" % user_id)
+    updated = client.put("/users/%d" % user_id, json={
+        "full_name": "Async User",
+        "email": "async.user@hotmail.fr",
+        "age": 31
+    })
+    listed = client.get("/users/%d/properties/" % user_id)
+    client.delete("/properties/%d" % property_id)
+    deleted = client.delete("/users/%d" % user_id)
+    assert created.status_code == 201
+    assert created.json()["gender"] == "F"
+    assert duplicated.status_code == 400
+    assert duplicated.json() == {'detail': 'User with the same full name is already registered'}
+    assert read.json()["properties"][0]["adress"] == "1 rue Async"
+    assert read.json()["properties"][0]["surface"] == 30
+    assert updated.json()["email"] == "async.user@hotmail.fr"
+    assert [p["id"] for p in listed.json()] == [property_id]
+    assert deleted.status_code == 200
+    assert client.get("/users/%d" % user_id).status_code == 404
+
+
+def test_async_users_bulk_and_pagination(client):
+    report = client.post("/users/bulk", json=[
+        {"full_name": "Async Bulk %d" % i, "email": "async.bulk%d@gmail.com" % i} for i in range(3)
+    ] + [{"full_name": "Async Bulk 0", "email": "async.bulk@gmail.com"}]).json()
+    ids = [result["id"] for result in report["results"][:3]]
+    first_page = client.get("/users/", params={"limit": 2})
+    second_page = client.get(
+        "/users/", params={"limit": 2, "cursor": first_page.headers["X-Next-Cursor"]})
+    export = client.get("/export/users.ndjson")
+    for user_id in ids:
+        client.delete("/users/%d" % user_id)
+    assert report["created"] == 3
+    assert report["results"][3]["error"] == "User with the same full name is already in the batch"
+    assert [user["id"] for user in first_page.json() + second_page.json()] == ids
+    assert len(export.text.splitlines()) == 3
+
+
+def test_async_search_properties(client):
+    ids = [client.post("/properties/", json={
+        "adress": "%d rue Async" % i,
+        "city": "Async City",
+        "selling_price": price
+    }).json()["id"] for i, price in enumerate([300000, 100000, 200000])]
+    response = client.get("/properties/", params={
+        "city": "Async City", "sort": "-selling_price", "limit": 2})
+    for property_id in ids:
+        client.delete("/properties/%d" % property_id)
+    assert [p["selling_price"] for p in response.json()] == [300000, 200000]
+    assert "X-Next-Cursor" in response.headers
+
+
+def test_async_delete_user_detaches_properties(client):
+    user_id = client.post("/users/", json={"full_name": "Async Seller", "email": "async.seller@gmail.com"}).json()["id"]
+    property_id = client.post("/properties/", json={"adress": "2 rue Async", "city": "Paris",
+                                                    "owner_id": user_id}).json()["id"]
+    deleted = client.delete("/users/%d" % user_id)
+    # the next user may reuse the id of the deleted one, it doesn't inherit its properties
+    new_user = client.post("/users/", json={"full_name": "Async Buyer", "email": "async.buyer@gmail.com"}).json()
+    detached = client.get("/properties/%d" % property_id).json()
+    unknown_owner = client.post("/properties/", json={"adress": "3 rue Async", "city": "Paris",
+                                                      "owner_id": 10 ** 9})
+    client.delete("/properties/%d" % property_id)
+    client.delete("/users/%d" % new_user["id"])
+    assert [p["id"] for p in deleted.json()["properties"]] == [property_id]
+    assert detached["owner_id"] is None
+    assert (new_user["property_count"], new_user["properties"]) == (0, [])
+    assert unknown_owner.status_code == 404
+    assert stats.verify_owner_counters(engine) == []
+
+
+def test_async_conditional_writes(client):
+    property_id = client.post("/properties/", json={"adress": "4 rue Async", "city": "Paris",
+                                                    "surface": 40}).json()["id"]
+    etag = client.get("/properties/%d" % property_id).headers["ETag"]
+    client.put("/properties/%d" % property_id, json={"surface": 41})
+    client.get("/properties/%d" % property_id)
+    invalidations = client.get("/debug/cache").json()["invalidations"]
+    stale_update = client.put("/properties/%d" % property_id, headers={"If-Match": etag}, json={"surface": 42})
+    with count_async_queries() as delete_queries:
+        stale_delete = client.delete("/properties/%d" % property_id, headers={"If-Match": etag})
+    # the failed writes keep the cached property
+    cached = client.get("/properties/%d" % property_id)
+    current = cached.headers["ETag"]
+    with count_async_queries() as delete_queries_ok:
+        deleted = client.delete("/properties/%d" % property_id, headers={"If-Match": current})
+    assert (stale_update.status_code, stale_delete.status_code) == (412, 412)
+    # only the successful deletion invalidated the cache
+    assert client.get("/debug/cache").json()["invalidations"] == invalidations + 1
+    assert cached.headers["X-Cache"] == "HIT" and cached.json()["surface"] == 41
+    # the version is checked by the DELETE itself, the stale one reads it to tell a 412 from a 404
+    assert len(delete_queries) == 2 and delete_queries[0].startswith("DELETE")
+    assert len(delete_queries_ok) == 1
+    assert deleted.status_code == 200 and deleted.json()["surface"] == 41
+    assert client.get("/properties/%d" % property_id).status_code == 404
+
+
+# Run a coroutine on the event loop of the test client, where the pool was connected
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def test_async_connection_profile(client):
+    async def read_pragmas():
+        async with async_connection(test_database) as connection:
+            return {name: await connection.fetch_val("PRAGMA %s" % name)
+                    for name in ("foreign_keys", "journal_mode", "busy_timeout")}
+
+    assert run(read_pragmas()) == {"foreign_keys": 1, "journal_mode": "wal", "busy_timeout": 5000}
+
+
+def test_async_pool_reuses_connections(client):
+    pool = test_database._backend.pool
+    raw_connections = []
+
+    async def read(delay):
+        async with async_connection(test_database) as connection:
+            raw_connections.append(connection.raw_connection)
+            await asyncio.sleep(delay)
+            return await connection.fetch_val("SELECT COUNT(*) FROM users")
+
+    async def read_concurrently(count):
+        return await asyncio.gather(*(read(0.01) for _ in range(count)))
+
+    for _ in range(5):
+        client.get("/users/1")
+    opened = pool.opened
+    counts = run(read_concurrently(20))
+    # the connections stay open between the requests, which wait for one of the pool.size connections
+    assert opened == 1
+    assert pool.opened == pool.size == len(set(map(id, raw_connections))) == 4
+    assert len(set(counts)) == 1
+
+
+
+def test_async_metrics(client):
+    single_query = 'http_request_db_queries_bucket{method="GET",route="/users/{user_id}",le="1"}'
+    client.get("/users/123456")
+    before = client.get("/metrics").text.splitlines()
+    client.get("/users/123456")
+    client.get("/users/123456")
+    lines = client.get("/metrics").text.splitlines()
+    # each of the requests ran a single query, the lookup of the user
+    assert metric_value(lines, single_query) == metric_value(before, single_query) + 2
+    assert metric_value(lines, 'db_queries_total{pool="async"}') >= metric_value(
+        before, 'db_queries_total{pool="async"}') + 2
+
+
+def test_async_slow_queries(client, monkeypatch):
+    monkeypatch.setattr(slow_queries, "SLOW_QUERY_MS", 0)
+    slow_queries.slow_query_log.clear()
+    client.get("/users/123456")
+    client.get("/users/123457")
+    statements = {entry["statement"]: entry for entry in client.get("/debug/slow-queries").json()["statements"]}
+    user_lookup = next(entry for statement, entry in statements.items()
+                       if "WHERE users.id = ?" in statement)
+    assert user_lookup["count"] == 2
+    assert user_lookup["routes"] == ["/users/{user_id}"]
+    assert "SEARCH users USING INTEGER PRIMARY KEY (rowid=?)" in user_lookup["plan"]